@@ -1,5 +1,15 @@
 import math
 
+try:
+    import numpy as np
+except:
+    np = None
+
+try:
+    import scipy.sparse
+except:
+    scipy = None
+
 #Returns a new list that has a euclidean norm as given
 def euclidean_norm(input_list, desired_norm = 1.0):
     new_list = []
@@ -12,33 +22,78 @@ def euclidean_norm(input_list, desired_norm = 1.0):
 def dot_product(list_one, list_two):
     return sum([a*b for a,b in zip(list_one,list_two)])
 
+###
+ # Average intensity of the bottom 25% of peaks. The bottom quarter is selected in linear time with
+ # numpy.partition, or a quickselect without numpy, instead of sorting all the peaks. The selected peaks come
+ # out in no particular order, math.fsum adds them exactly rounded so the result does not depend on that order.
+ # It can differ in the last bit from the ascending order sum of a full sort
+###
 def calculate_noise_level_in_peaks(peaks):
-    #Take bottom 25% of peaks
-    sorted_peaks = sorted(peaks, key=lambda peak: peak[1])
+    return calculate_noise_level_in_intensities(get_peak_intensities(peaks))
 
-    number_of_peaks = len(sorted_peaks)
+def calculate_noise_level_in_intensities(intensities):
+    number_of_peaks = len(intensities)
     number_of_peaks_bottom = int(number_of_peaks/4)
 
     if number_of_peaks_bottom == 0:
         return -1.0
 
-    sum_intensity = 0.0
-    for i in range(number_of_peaks_bottom):
-        intensity = sorted_peaks[i][1]
-        sum_intensity += intensity
-    average_noise_intensity = sum_intensity/float(number_of_peaks_bottom)
-
-    return average_noise_intensity
-
-#Determines the number of signal peaks in a set of peaks
-def calculate_signal_peaks_in_peaklist(peaks, SNR_Threshold):
-    average_noise_intensity = calculate_noise_level_in_peaks(peaks)
+    if np is not None:
+        bottom_intensities = np.partition(np.asarray(intensities, dtype=np.float64), number_of_peaks_bottom - 1)[:number_of_peaks_bottom].tolist()
+    else:
+        bottom_intensities = select_smallest_values(list(intensities), number_of_peaks_bottom)
+
+    return math.fsum(bottom_intensities)/float(number_of_peaks_bottom)
+
+#The k smallest values in no particular order, by quickselect with a median of three pivot
+def select_smallest_values(values, k):
+    selected_values = []
+    while k > 0 and len(values) > 0:
+        pivot = sorted([values[0], values[len(values) // 2], values[-1]])[1]
+        lower_values = [value for value in values if value < pivot]
+        if len(lower_values) >= k:
+            values = lower_values
+            continue
+        selected_values += lower_values
+        k -= len(lower_values)
+
+        pivot_values = [value for value in values if value == pivot]
+        selected_values += pivot_values[:k]
+        k -= len(pivot_values[:k])
+        values = [value for value in values if value > pivot]
+
+    return selected_values
+
+#Intensities of a list of peaks, array backed peak lists already hold them
+def get_peak_intensities(peaks):
+    if hasattr(peaks, "intensity"):
+        return peaks.intensity
+    return [peak[1] for peak in peaks]
+
+###
+ # calculate_noise_level_in_peaks for many spectra at once, the intensities of spectrum i are peak_offsets[i]
+ # to peak_offsets[i + 1]. The bottom quarter of each spectrum is selected with numpy.partition and summed
+ # with math.fsum like calculate_noise_level_in_peaks, so the noise levels are the same
+###
+def calculate_noise_levels_in_peak_arrays(intensity, peak_offsets):
+    peak_offsets = np.asarray(peak_offsets).tolist()
+
+    noise_levels = np.empty(len(peak_offsets) - 1)
+    for i in range(len(peak_offsets) - 1):
+        noise_levels[i] = calculate_noise_level_in_intensities(intensity[peak_offsets[i]:peak_offsets[i + 1]])
+
+    return noise_levels
+
+#Determines the number of signal peaks in a set of peaks, the noise level is computed unless it is given
+def calculate_signal_peaks_in_peaklist(peaks, SNR_Threshold, average_noise_intensity=None):
+    if average_noise_intensity == None:
+        average_noise_intensity = calculate_noise_level_in_peaks(peaks)
     if average_noise_intensity < 0.00001:
         return 0.0
 
     total_signal_peaks = 0
-    for peak in peaks:
-        snr_of_peak = peak[1]/average_noise_intensity
+    for intensity in get_peak_intensities(peaks):
+        snr_of_peak = intensity/average_noise_intensity
         if snr_of_peak > SNR_Threshold:
             total_signal_peaks += 1
 
@@ -76,6 +131,113 @@ def vectorize_peaks(peaks, max_mass, bin_size, sqrt_peaks=True):
 
     return peak_vector
 
+###
+ # Sparse version of vectorize_peaks, only the bins with peaks are kept as a (bin_indices, values) pair of
+ # numpy arrays sorted by bin, or of lists without numpy. The values are the same as the non-zero bins of
+ # vectorize_peaks, a spectrum without intensity gives empty arrays
+###
+def vectorize_peaks_sparse(peaks, max_mass, bin_size, sqrt_peaks=True):
+    number_of_bins = int(max_mass / bin_size)
+
+    if np == None:
+        bin_intensities = {}
+        for peak in peaks:
+            bin_index = int(peak[0] / bin_size)
+            if bin_index >= 0 and bin_index < number_of_bins:
+                bin_intensities[bin_index] = bin_intensities.get(bin_index, 0.0) + peak[1]
+        bin_indices = sorted(bin_intensities)
+        bin_values = [bin_intensities[bin_index] for bin_index in bin_indices]
+
+        if sqrt_peaks == True:
+            acc_norm = sum(bin_values)
+            bin_values = [math.sqrt(value) for value in bin_values]
+        else:
+            acc_norm = sum([value * value for value in bin_values])
+
+        if acc_norm == 0.0:
+            return [], []
+
+        normed_value = math.sqrt(acc_norm)
+        return bin_indices, [value / normed_value for value in bin_values]
+
+    if hasattr(peaks, "mz"):
+        mz = np.asarray(peaks.mz, dtype=np.float64)
+        intensity = np.asarray(peaks.intensity, dtype=np.float64)
+    else:
+        mz = np.array([peak[0] for peak in peaks], dtype=np.float64)
+        intensity = np.array([peak[1] for peak in peaks], dtype=np.float64)
+
+    peak_bins = (mz / bin_size).astype(np.int64)
+    in_range = (peak_bins >= 0) & (peak_bins < number_of_bins)
+    bin_indices, peak_bin_positions = np.unique(peak_bins[in_range], return_inverse=True)
+    bin_values = np.zeros(len(bin_indices))
+    np.add.at(bin_values, peak_bin_positions, intensity[in_range])
+
+    #Summed in bin order like vectorize_peaks
+    if sqrt_peaks == True:
+        acc_norm = sum(bin_values.tolist())
+        bin_values = np.sqrt(bin_values)
+    else:
+        acc_norm = sum((bin_values * bin_values).tolist())
+
+    if acc_norm == 0.0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    return bin_indices, bin_values / math.sqrt(acc_norm)
+
+def sparse_dot_product(vector_one, vector_two):
+    if np == None:
+        bin_values_two = dict(zip(vector_two[0], vector_two[1]))
+        return sum([value * bin_values_two[bin_index] for bin_index, value in zip(vector_one[0], vector_one[1]) if bin_index in bin_values_two])
+
+    common_bins, indices_one, indices_two = np.intersect1d(vector_one[0], vector_two[0], assume_unique=True, return_indices=True)
+    return float(np.dot(vector_one[1][indices_one], vector_two[1][indices_two]))
+
+#Stacks sparse peak vectors as the rows of a scipy CSR matrix
+def sparse_vectors_to_matrix(sparse_vectors, number_of_bins):
+    row_lengths = [len(vector[0]) for vector in sparse_vectors]
+    row_offsets = np.zeros(len(sparse_vectors) + 1, dtype=np.int64)
+    row_offsets[1:] = np.cumsum(row_lengths)
+
+    if len(sparse_vectors) > 0:
+        bin_indices = np.concatenate([vector[0] for vector in sparse_vectors])
+        bin_values = np.concatenate([vector[1] for vector in sparse_vectors])
+    else:
+        bin_indices = np.zeros(0, dtype=np.int64)
+        bin_values = np.zeros(0)
+
+    return scipy.sparse.csr_matrix((bin_values, bin_indices, row_offsets), shape=(len(sparse_vectors), number_of_bins))
+
+###
+ # Dot products of all the query sparse peak vectors against all the library ones as one CSR matrix product.
+ # Returns (query index, library index, score) for the pairs scoring above min_score, sorted by query and
+ # library index. It is an approximate binned cosine, meant to prefilter pairs before an exact alignment.
+ # The library is scored in chunks of chunk_size vectors to bound the memory of the product. Without scipy
+ # or numpy the vectors are compared one pair at a time
+###
+def calculate_sparse_similarities(query_vectors, library_vectors, number_of_bins, min_score=0.0, chunk_size=10000):
+    similarities = []
+
+    if scipy == None or np == None:
+        for i, query_vector in enumerate(query_vectors):
+            for j, library_vector in enumerate(library_vectors):
+                score = sparse_dot_product(query_vector, library_vector)
+                if score > min_score:
+                    similarities.append((i, j, score))
+        return similarities
+
+    query_matrix = sparse_vectors_to_matrix(query_vectors, number_of_bins)
+    for chunk_start in range(0, len(library_vectors), chunk_size):
+        library_matrix = sparse_vectors_to_matrix(library_vectors[chunk_start:chunk_start + chunk_size], number_of_bins)
+        score_matrix = (query_matrix @ library_matrix.T).tocoo()
+
+        above_threshold = score_matrix.data > min_score
+        for i, j, score in zip(score_matrix.row[above_threshold].tolist(), score_matrix.col[above_threshold].tolist(), score_matrix.data[above_threshold].tolist()):
+            similarities.append((i, j + chunk_start, score))
+
+    similarities.sort(key=lambda similarity: (similarity[0], similarity[1]))
+    return similarities
+
 def unvectorize_peaks(peaks, bin_size):
     output_peaks = []
 
@@ -10,6 +10,13 @@ import ming_fileio_library
 import math
 import re
 import random
+import functools
+import bisect
+
+try:
+    import numpy as np
+except:
+    np = None
 
 try:
     from pyteomics import mass
@@ -386,7 +393,7 @@ class PeptideVariantSet:
         for variant in self.peptide_list:
             self.peptide_map[variant.variant_sequence] = variant
 
-    def filter_to_local_fdr_by_length(self, fdr):
+    def filter_to_local_fdr_by_length(self, fdr, local_window_size=500):
         output_peptides = []
         peptide_length_map = {}
         for peptide_obj in self.peptide_list:
@@ -396,7 +403,7 @@ class PeptideVariantSet:
             peptide_length_map[peptide_length].append(peptide_obj)
 
         for peptide_length in peptide_length_map:
-            filtered_peptides = filter_psm_local_fdr(peptide_length_map[peptide_length], fdr)
+            filtered_peptides = filter_psm_local_fdr(peptide_length_map[peptide_length], fdr, local_window_size)
             print("Filtered Length " + str(peptide_length) + " " + str(len(peptide_length_map[peptide_length])) + " to " + str(len(filtered_peptides)))
             output_peptides += filtered_peptides
         self.peptide_list = output_peptides
@@ -464,7 +471,18 @@ def get_peptide_modification_list_inspect_format(peptide):
 
 
 
+#Number of peptide/ion type/charge combinations create_theoretical_peak_map keeps, least recently used are dropped first
+THEORETICAL_PEAK_MAP_CACHE_SIZE = 10000
+
+###
+ # Mass of every fragment ion of a peptide, keyed by "ion_type:length:charge". Peptides repeat a lot across
+ # PSMs, so the maps are kept in a bounded LRU cache and a copy is returned
+###
 def create_theoretical_peak_map(peptide, ion_type_list, charge_set=[1]):
+    return dict(_create_theoretical_peak_map_cached(peptide, tuple(ion_type_list), tuple(charge_set)))
+
+@functools.lru_cache(maxsize=THEORETICAL_PEAK_MAP_CACHE_SIZE)
+def _create_theoretical_peak_map_cached(peptide, ion_type_list, charge_set):
     amino_acid_list = get_peptide_modification_list_inspect_format(peptide)
     #print(amino_acid_list)
 
@@ -478,6 +496,14 @@ def create_theoretical_peak_map(peptide, ion_type_list, charge_set=[1]):
             mod_mass_to_add += float(mod_tokenized)
         only_mods_mass_add_list.append(mod_mass_to_add)
 
+    #Residue and mod masses of every prefix and suffix, each fragment is then a lookup instead of a sum
+    number_of_fragments = len(amino_acid_list)
+    residue_masses = [mass.std_aa_mass[letter] for letter in only_letters_list]
+    prefix_residue_masses = cumulative_sums(residue_masses[:number_of_fragments])
+    prefix_mod_masses = cumulative_sums(only_mods_mass_add_list)
+    suffix_residue_masses = cumulative_sums(residue_masses[number_of_fragments - 1::-1] if number_of_fragments > 0 else [])[::-1]
+    suffix_mod_masses = cumulative_sums(only_mods_mass_add_list[::-1])[::-1]
+
     ion_to_mass_mapping = {}
     #print(peptide)
     #print(only_mods_mass_add_list)
@@ -490,20 +516,43 @@ def create_theoretical_peak_map(peptide, ion_type_list, charge_set=[1]):
                 iso_topic_added_mass = 1.007276 / float(charge)
                 real_ion_type = ion_type[:-4]
 
-            for i in range(len(amino_acid_list)):
+            ion_type_mass = get_ion_type_added_mass(real_ion_type)
+
+            for i in range(number_of_fragments):
                 peak_mass = 0.0
                 if real_ion_type[0] in "abc":
                     peak_annotation = ion_type + ":" + str(i+1) + ":" + str(charge)
-                    peak_mass = mass.fast_mass("".join(only_letters_list[:i+1]), ion_type=real_ion_type, charge=charge) + sum(only_mods_mass_add_list[:i+1])/(float(charge)) + iso_topic_added_mass
+                    peak_mass = fragment_mz(prefix_residue_masses[i], ion_type_mass, charge) + prefix_mod_masses[i]/(float(charge)) + iso_topic_added_mass
                     #print(ion_type, i, charge, peak_mass, real_ion_type)
                 else:
                     peak_annotation = ion_type + ":" + str(len(amino_acid_list) - i) + ":" + str(charge)
-                    peak_mass = mass.fast_mass("".join(only_letters_list[i:]), ion_type=real_ion_type, charge=charge) + sum(only_mods_mass_add_list[i:])/(float(charge)) + iso_topic_added_mass
+                    peak_mass = fragment_mz(suffix_residue_masses[i], ion_type_mass, charge) + suffix_mod_masses[i]/(float(charge)) + iso_topic_added_mass
                     #print(ion_type, i, charge, peak_mass)
                 ion_to_mass_mapping[peak_annotation] = peak_mass
 
     return ion_to_mass_mapping
 
+def cumulative_sums(values):
+    sums = []
+    running_sum = 0
+    for value in values:
+        running_sum += value
+        sums.append(running_sum)
+    return sums
+
+#Water plus the composition of the ion type, what mass.fast_mass adds to the residue masses
+def get_ion_type_added_mass(ion_type):
+    added_mass = mass.nist_mass['H'][0][0] * 2 + mass.nist_mass['O'][0][0]
+    ion_mass = sum(mass.nist_mass[element][0][0] * count for element, count in mass.std_ion_comp[ion_type].items())
+    return added_mass, ion_mass
+
+#m/z of a fragment from its residue mass, computed in the same order as mass.fast_mass
+def fragment_mz(residue_mass, ion_type_mass, charge):
+    fragment_mass = residue_mass
+    fragment_mass += ion_type_mass[0]
+    fragment_mass += ion_type_mass[1]
+    return (fragment_mass + mass.nist_mass['H+'][0][0] * charge) / charge
+
 def calculate_theoretical_peptide_mass(peptide_sequence, charge):
     amino_acid_list = get_peptide_modification_list_inspect_format(peptide_sequence)
     only_letters_list = [letter for letter in peptide_sequence if letter.isalpha()]
@@ -523,19 +572,43 @@ def calculate_theoretical_peptide_mass(peptide_sequence, charge):
 
 
 
+###
+ # Theoretical ions of each peak mass, all the ions within tolerance of the peak in the order of ion_peak_mapping.
+ # The ion masses are sorted once and the tolerance window of each peak is found by binary search, instead
+ # of comparing every peak against every ion
+###
+def match_peaks_to_ions(ion_peak_mapping, peak_masses, tolerance):
+    sorted_ions = sorted([(ion_mass, ion_order, ion_peak) for ion_order, (ion_peak, ion_mass) in enumerate(ion_peak_mapping.items())])
+    sorted_ion_masses = [ion[0] for ion in sorted_ions]
+
+    peak_ions = []
+    for mass in peak_masses:
+        window_start = bisect.bisect_left(sorted_ion_masses, mass - tolerance)
+        #Rounding of mass - tolerance can put the first ion in the window just before window_start
+        while window_start > 0 and abs(mass - sorted_ion_masses[window_start - 1]) < tolerance:
+            window_start -= 1
+
+        matched_ions = []
+        for i in range(window_start, len(sorted_ions)):
+            ion_mass = sorted_ion_masses[i]
+            if abs(mass - ion_mass) < tolerance:
+                matched_ions.append(sorted_ions[i])
+            elif ion_mass > mass:
+                break
+
+        if len(matched_ions) > 1:
+            matched_ions.sort(key=lambda ion: ion[1])
+        peak_ions.append([ion[2] for ion in matched_ions])
+
+    return peak_ions
+
 #Returns both annotated and unannotated peaks
 def extract_annotated_peaks(ion_peak_mapping, peak_list, tolerance):
     extracted_peaks = []
     unannotated_peaks = []
-    for peak in peak_list:
-        mass = peak[0]
-        isAnnotated = False
-        for ion_peak in ion_peak_mapping:
-            if abs(mass - ion_peak_mapping[ion_peak]) < tolerance:
-                #extracted_peaks.append(peak)
-                isAnnotated = True
-                break
-        if isAnnotated:
+    peak_ions = match_peaks_to_ions(ion_peak_mapping, [peak[0] for peak in peak_list], tolerance)
+    for peak, ions in zip(peak_list, peak_ions):
+        if len(ions) > 0:
             extracted_peaks.append(peak)
         else:
             unannotated_peaks.append(peak)
@@ -799,29 +872,14 @@ def calculate_fdr_by_length(input_psms):
     return input_psms
 
 def calculate_psm_fdr(input_psms):
-    input_psms = sorted(input_psms, key=lambda psm: psm.sorting_value(), reverse=True)
-
-    running_target_count = 1
-    running_decoy_count = 0
+    order, q_values = calculate_target_decoy_q_values([psm.sorting_value() for psm in input_psms], [psm.is_decoy() == 0 for psm in input_psms])
 
-    output_psms = []
-
-    for psm in input_psms:
-        if psm.is_decoy() == 0:
-            running_target_count += 1
-        else:
-            running_decoy_count += 1
-
-        current_fdr = float(running_decoy_count) / float(running_target_count)
+    input_psms = [input_psms[i] for i in order]
+    for psm, q_value in zip(input_psms, q_values):
+        psm.fdr = q_value
 
-        psm.fdr = current_fdr
-
-    #Properly finding the min q value for PSM
-    min_fdr = 1
+    #Lowest scoring first
     input_psms.reverse()
-    for psm in input_psms:
-        min_fdr = min(min_fdr, psm.fdr)
-        psm.fdr = min_fdr
 
     return input_psms
 
@@ -830,45 +888,52 @@ def calculate_psm_fdr(input_psms):
  # prescribed FDR
 ###
 def filter_psm_fdr(input_psms, fdr_percentage):
-    #TODO Add Sorting
-    #Sorting
-    #print "Sorting shit to " + str(fdr_percentage*100) + "%"
-    #input_psms = sorted(input_psms, key=PSM.sorting_value)
-    input_psms = sorted(input_psms, key=lambda psm: psm.sorting_value(), reverse=True)
-
-    running_target_count = 1
-    running_decoy_count = 0
+    order, q_values = calculate_target_decoy_q_values([psm.sorting_value() for psm in input_psms], [psm.is_decoy() == 0 for psm in input_psms])
 
     output_psms = []
+    for i, q_value in zip(order, q_values):
+        input_psms[i].fdr = q_value
+        if q_value < fdr_percentage:
+            output_psms.append(input_psms[i])
 
-    for psm in input_psms:
-        if psm.is_decoy() == 0:
+    return output_psms
+
+###
+ # Target-decoy q values of a set of scores. Returns the indices of the scores from highest to lowest,
+ # ties keeping their input order, and the q value at each of those positions: the running decoys over
+ # targets plus one, minimized from the bottom up and capped at 1. Numeric scores are done as numpy
+ # cumulative sums, other scores are compared as Python objects one at a time
+###
+def calculate_target_decoy_q_values(scores, target_flags):
+    if np is not None and all(isinstance(score, (int, float)) for score in scores):
+        scores = np.array(scores, dtype=np.float64)
+        order = np.argsort(-scores, kind="stable")
+        target_counts = np.cumsum(np.array(target_flags, dtype=bool)[order]) + 1
+        decoy_counts = np.arange(1, len(order) + 1) - (target_counts - 1)
+        fdr = decoy_counts / target_counts.astype(np.float64)
+        q_values = np.minimum.accumulate(fdr[::-1])[::-1]
+        #Capped q values are the integer 1, as from the min below
+        return order.tolist(), [q_value if q_value < 1.0 else 1 for q_value in q_values.tolist()]
+
+    order = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+
+    running_target_count = 1
+    running_decoy_count = 0
+    q_values = []
+    for i in order:
+        if target_flags[i]:
             running_target_count += 1
         else:
             running_decoy_count += 1
-
-        current_fdr = float(running_decoy_count) / float(running_target_count)
-
-        psm.fdr = current_fdr
+        q_values.append(float(running_decoy_count) / float(running_target_count))
 
     #Properly finding the min q value for PSM
     min_fdr = 1
-    input_psms.reverse()
-    for psm in input_psms:
-        min_fdr = min(min_fdr, psm.fdr)
-        psm.fdr = min_fdr
-
-    input_psms.reverse()
-    #for i in range(len(input_psms)):
-    #    index_to_check = len(input_psms) - i - 1
-    #    min_fdr = min(min_fdr, input_psms[index_to_check].fdr)
-    #    input_psms[index_to_check].fdr = min_fdr
+    for i in range(len(q_values) - 1, -1, -1):
+        min_fdr = min(min_fdr, q_values[i])
+        q_values[i] = min_fdr
 
-    for psm in input_psms:
-        if psm.fdr < fdr_percentage:
-            output_psms.append(psm)
-
-    return output_psms
+    return order, q_values
 
 def filter_synthetic_psms(input_psms, target_filename_list, decoy_filename_list, fdr=0.00000000001):
     target_filelist_psm_list = []
@@ -938,57 +1003,84 @@ def get_synthetic_decoy_psms(input_psms, target_filename_list, decoy_filename_li
  # Filtering PSM results so that the returned set is at the
  # prescribed local FDR
 ###
-def filter_psm_local_fdr(input_psms, fdr_percentage):
-    local_window_size = 500
+def filter_psm_local_fdr(input_psms, fdr_percentage, local_window_size=500):
+    order, fdr_values, local_q_values = calculate_local_target_decoy_fdr([psm.sorting_value() for psm in input_psms], [psm.is_decoy() == 0 for psm in input_psms], local_window_size)
+
+    output_psms = []
+    for i, fdr, local_q_value in zip(order, fdr_values, local_q_values):
+        psm = input_psms[i]
+        psm.fdr = fdr
+        psm.local_fdr = local_q_value
+        if local_q_value < fdr_percentage:
+            output_psms.append(psm)
 
-    input_psms = sorted(input_psms, key=lambda psm: psm.sorting_value(), reverse=True)
+    return output_psms
 
-    running_target_count = 1
-    running_decoy_count = 0
+###
+ # Local FDR over a sliding window of the local_window_size highest scoring entries ending at each position,
+ # in the order of calculate_target_decoy_q_values. Returns that order, the running FDR (not minimized) and the
+ # local q values: decoys over targets in the window, minimized from the bottom up and capped at 1. A window
+ # without targets has a local FDR of inf, so its q value is capped to 1 unless a lower entry is below that.
+ # Window counts are differences of cumulative sums for numeric scores, otherwise running counters updated as the window moves
+###
+def calculate_local_target_decoy_fdr(scores, target_flags, local_window_size=500):
+    if local_window_size < 1:
+        raise ValueError("local_window_size must be at least 1, got " + str(local_window_size))
 
-    recent_target_numbers = []
-    recent_decoy_numbers = []
+    if np is not None and all(isinstance(score, (int, float)) for score in scores):
+        scores = np.array(scores, dtype=np.float64)
+        order = np.argsort(-scores, kind="stable")
+        target_counts = np.cumsum(np.array(target_flags, dtype=bool)[order])
+        positions = np.arange(1, len(order) + 1)
 
-    output_psms = []
+        window_target_counts = target_counts.copy()
+        window_target_counts[local_window_size:] -= target_counts[:-local_window_size]
+        window_decoy_counts = np.minimum(positions, local_window_size) - window_target_counts
 
-    for psm in input_psms:
-        if psm.is_decoy() == 0:
-            recent_target_numbers.append(1)
-            recent_decoy_numbers.append(0)
+        fdr = (positions - target_counts) / (target_counts + 1).astype(np.float64)
+        with np.errstate(divide="ignore"):
+            local_fdr = window_decoy_counts / window_target_counts.astype(np.float64)
+        local_q_values = np.minimum.accumulate(local_fdr[::-1])[::-1]
+        #Capped q values are the integer 1, as from the min below
+        return order.tolist(), fdr.tolist(), [q_value if q_value < 1.0 else 1 for q_value in local_q_values.tolist()]
+
+    order = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+
+    running_target_count = 1
+    running_decoy_count = 0
+    window_target_count = 0
+    window_decoy_count = 0
+
+    fdr_values = []
+    local_q_values = []
+    for position, i in enumerate(order):
+        if target_flags[i]:
+            window_target_count += 1
             running_target_count += 1
         else:
-            recent_decoy_numbers.append(1)
-            recent_target_numbers.append(0)
+            window_decoy_count += 1
             running_decoy_count += 1
 
-        recent_target_numbers = recent_target_numbers[-local_window_size:]
-        recent_decoy_numbers = recent_decoy_numbers[-local_window_size:]
-
-        local_fdr = float(sum(recent_decoy_numbers)) / float(sum(recent_target_numbers))
-        current_fdr = float(running_decoy_count) / float(running_target_count)
-        #print(local_fdr, current_fdr)
+        #Dropping the entry that left the window
+        if position >= local_window_size:
+            if target_flags[order[position - local_window_size]]:
+                window_target_count -= 1
+            else:
+                window_decoy_count -= 1
 
-        psm.local_fdr = local_fdr
-        psm.fdr = current_fdr
+        if window_target_count == 0:
+            local_q_values.append(float("inf"))
+        else:
+            local_q_values.append(float(window_decoy_count) / float(window_target_count))
+        fdr_values.append(float(running_decoy_count) / float(running_target_count))
 
     #Properly finding the min q value for PSM
     min_fdr = 1
-    input_psms.reverse()
-    for psm in input_psms:
-        min_fdr = min(min_fdr, psm.local_fdr)
-        psm.local_fdr = min_fdr
-
-    input_psms.reverse()
-    #for i in range(len(input_psms)):
-    #    index_to_check = len(input_psms) - i - 1
-    #    min_fdr = min(min_fdr, input_psms[index_to_check].fdr)
-    #    input_psms[index_to_check].fdr = min_fdr
+    for i in range(len(local_q_values) - 1, -1, -1):
+        min_fdr = min(min_fdr, local_q_values[i])
+        local_q_values[i] = min_fdr
 
-    for psm in input_psms:
-        if psm.local_fdr < fdr_percentage:
-            output_psms.append(psm)
-
-    return output_psms
+    return order, fdr_values, local_q_values
 
 def strip_sequence(input_sequence):
     p = re.compile('\W|\d')
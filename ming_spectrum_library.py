@@ -1,68 +1,168 @@
 #!/usr/bin/python
 import re
-import xmltodict
+import sys
+import array
+import bisect
+import heapq
 import base64
 import binascii
-import struct
 import os
 import time
 import zlib
+import math
+import json
+import threading
+import xml.etree.ElementTree as ElementTree
 import spectrum_alignment
 import ming_fileio_library
 import ming_psm_library
 import ming_numerical_utilities
 import ming_sptxt_library
 from collections import defaultdict
+from collections import namedtuple
 
 try:
     from pyteomics import mass
     from pyteomics import mzml as pyteomicsmzml
 except:
     print("no pyteomics")
+
+try:
+    import numpy as np
+except:
+    np = None
+
+try:
+    import ming_parallel_library
+except:
+    ming_parallel_library = None
 """
 
 Spectrum Utilities to manipulate and do things with spectra
 
 """
 
+SpectrumMatch = namedtuple('SpectrumMatch', ['filename', 'scan', 'queryfilename', 'queryscan', 'cosine', 'matchedpeaks', 'mzerror'])
+PreprocessingStepReport = namedtuple('PreprocessingStepReport', ['step', 'time', 'peaks_removed'])
+PSMAnnotationMetrics = namedtuple('PSMAnnotationMetrics', ['annotated_peaks', 'explained_intensity', 'signal_peaks', 'number_of_peaks_within_1_percent_of_max', 'number_of_peaks_within_5_percent_of_max', 'annotated_ions', 'number_of_b_y_breaks'])
+
+#Spectrum peak filters that can be steps of SpectrumCollection.preprocess
+PREPROCESSING_STEPS = ["filter_precursor_peaks", "filter_peak_mass_range", "filter_noise_peaks", "window_filter_peaks", "filter_peaks_noise_or_window", "filter_to_top_peaks"]
+
 class SpectrumCollection:
     def __init__(self, filename):
         self.filename = filename
+        self.version = 0
         self.spectrum_list = []
         self.scandict = {}
+        self.library_arrays = None
+        self.library_arrays_version = None
+        self.precursor_index_mz = None
+        self.precursor_index_positions = None
+        self.precursor_index_version = None
+
+    ###
+    # The search arrays and the precursor index are built from the spectra and rebuilt on their next use
+    # once version changes. The loaders, the collection filters and assigning spectrum_list bump it, after
+    # changing spectrum_list or its spectra in place call invalidate_search_cache
+    ###
+    @property
+    def spectrum_list(self):
+        #Collections loaded with load_from_mzXML_indexed decode all their spectra on first use
+        if self._spectrum_list is None:
+            self._spectrum_list = self.scandict.get_spectra()
+        return self._spectrum_list
+
+    @spectrum_list.setter
+    def spectrum_list(self, spectrum_list):
+        self._spectrum_list = spectrum_list
+        self.invalidate_search_cache()
+
+    def invalidate_search_cache(self):
+        self.version += 1
+
+    ###
+    # workers sets how many processes decode the scans of mzXML and mzML files. With use_cache the spectra
+    # are loaded from the binary cache next to the file when it is up to date, otherwise the cache is
+    # written after loading the file so the next load is fast
+    ###
+    def load_from_file(self, drop_ms1=False, workers=1, use_cache=False):
+        use_cache = use_cache and np is not None
+        if use_cache and self.load_from_cache(drop_ms1=drop_ms1):
+            return
 
-    def load_from_file(self, drop_ms1=False):
         extension = ming_fileio_library.get_filename_extension(self.filename)
         if extension == ".mzXML":
-            self.load_from_mzXML(drop_ms1=drop_ms1)
+            self.load_from_mzXML(drop_ms1=drop_ms1, workers=workers)
 
         if extension == ".mzML":
-            self.load_from_mzML(drop_ms1=drop_ms1)
+            self.load_from_mzML(drop_ms1=drop_ms1, workers=workers)
 
         if extension == ".mgf":
             self.load_from_mgf()
 
-    def load_from_mgf(self):
-        self.spectrum_list = load_mgf_file(self.filename)
-        #Only keep non-None spectra
-        new_spectrum_list = []
-        for spectrum in self.spectrum_list:
-            if spectrum != None:
-                new_spectrum_list.append(spectrum)
-        self.spectrum_list = new_spectrum_list
+        if use_cache:
+            self.save_to_cache(drop_ms1=drop_ms1)
+
+    #Writes the spectra to the binary cache, drop_ms1 records how the spectra were loaded
+    def save_to_cache(self, cache_filename=None, drop_ms1=False):
+        if cache_filename == None:
+            cache_filename = get_spectrum_cache_filename(self.filename)
+        write_spectrum_cache(self.spectrum_list, cache_filename, self.filename, {"drop_ms1": drop_ms1})
+
+    #Loads the spectra from the binary cache, returns False when it is missing or stale
+    def load_from_cache(self, cache_filename=None, drop_ms1=False):
+        if np is None:
+            return False
+        if cache_filename == None:
+            cache_filename = get_spectrum_cache_filename(self.filename)
+        spectrum_cache = read_spectrum_cache(cache_filename, self.filename, {"drop_ms1": drop_ms1})
+        if spectrum_cache == None:
+            return False
+
+        meta, columns = spectrum_cache
+        self.spectrum_list = load_spectra_from_cache(meta, columns)
+        self.scandict = {}
+        extension = ming_fileio_library.get_filename_extension(self.filename)
+        file_idx = os.path.split(self.filename)[1]
         for spectrum in self.spectrum_list:
             self.scandict[spectrum.scan] = spectrum
+            if extension == ".mzXML" or extension == ".mzML":
+                self.scandict[file_idx + ":" + str(spectrum.scan)] = spectrum
+        return True
+
+    def load_from_mgf(self):
+        self.spectrum_list = []
+        self.load_from_iterator(iter_mgf_file(self.filename))
+
+    #Adds the spectra of any spectrum iterator, e.g. iter_mgf_file, only keeping non-None spectra
+    def load_from_iterator(self, spectrum_iterator):
+        for spectrum in spectrum_iterator:
+            if spectrum == None:
+                continue
+            self.spectrum_list.append(spectrum)
+            self.scandict[spectrum.scan] = spectrum
+        self.invalidate_search_cache()
 
-    def load_from_mzXML(self, drop_ms1=False):
-        self.spectrum_list = load_mzxml_file(self.filename, drop_ms1=drop_ms1)
+    def load_from_mzXML(self, drop_ms1=False, workers=1):
+        self.spectrum_list = load_mzxml_file(self.filename, drop_ms1=drop_ms1, workers=workers)
         file_idx = os.path.split(self.filename)[1]
         #Do indexing on scan number
         for spectrum in self.spectrum_list:
             self.scandict[spectrum.scan] = spectrum
             self.scandict[file_idx + ":" + str(spectrum.scan)] = spectrum
 
-    def load_from_mzML(self, drop_ms1=False):
-        self.spectrum_list = load_mzml_file(self.filename, drop_ms1=drop_ms1)
+    ###
+    # Only reads the scan index, spectra are decoded when looked up in scandict and spectrum_list decodes
+    # them all the first time it is used. index_filename saves the scan index of an mzXML without one, see
+    # load_mzxml_scan_offsets
+    ###
+    def load_from_mzXML_indexed(self, drop_ms1=False, index_filename=None):
+        self.scandict = IndexedMzXMLFile(self.filename, drop_ms1=drop_ms1, index_filename=index_filename)
+        self.spectrum_list = None
+
+    def load_from_mzML(self, drop_ms1=False, workers=1):
+        self.spectrum_list = load_mzml_file(self.filename, drop_ms1=drop_ms1, workers=workers)
         file_idx = os.path.split(self.filename)[1]
         #Do indexing on scan number
         for spectrum in self.spectrum_list:
@@ -73,11 +173,16 @@ class SpectrumCollection:
         if otherspectrum == None:
             return []
 
-        if len(otherspectrum.peaks) < min_matched_peaks:
+        if len(otherspectrum.peaks) < min_matched_peaks or top_k < 1:
             return []
 
-        match_list = []
-        for myspectrum in self.spectrum_list:
+        candidate_spectra = self.spectrum_list
+        if analog_search == False:
+            candidate_spectra = [self.spectrum_list[i] for i in self.get_precursor_candidates(otherspectrum.mz, pm_tolerance)]
+
+        #Bounded min heap of the best top_k matches, ties keep the earlier spectrum
+        top_matches = []
+        for match_order, myspectrum in enumerate(candidate_spectra):
             if myspectrum == None:
                 continue
 
@@ -89,23 +194,103 @@ class SpectrumCollection:
                 cosine_score, matched_peaks = myspectrum.cosine_spectrum(otherspectrum, peak_tolerance)
                 #Also check for min matched peaks
                 if cosine_score > min_score and matched_peaks >= min_matched_peaks:
-                    #print(cosine_score, matched_peaks, mz_delta)
-                    match_obj = {}
-                    match_obj["filename"] = myspectrum.filename
-                    match_obj["scan"] = myspectrum.scan
-                    match_obj["queryfilename"] = otherspectrum.filename
-                    match_obj["queryscan"] = otherspectrum.scan
-                    match_obj["cosine"] = cosine_score
-                    match_obj["matchedpeaks"] = matched_peaks
-                    match_obj["mzerror"] = abs(myspectrum.mz - otherspectrum.mz)
+                    if len(top_matches) == top_k and (cosine_score, -match_order) < top_matches[0][:2]:
+                        continue
+                    match_obj = SpectrumMatch(myspectrum.filename, myspectrum.scan, otherspectrum.filename, otherspectrum.scan, cosine_score, matched_peaks, mz_delta)
+                    if len(top_matches) < top_k:
+                        heapq.heappush(top_matches, (cosine_score, -match_order, match_obj))
+                    else:
+                        heapq.heapreplace(top_matches, (cosine_score, -match_order, match_obj))
+
+        top_matches.sort(reverse=True)
+
+        return [heap_entry[2] for heap_entry in top_matches]
+
+    #Normalizes and packs every spectrum once so many queries can be searched against this collection, search_spectrum_batch calls it again when version changes
+    def prepare_library_search(self):
+        if np is None:
+            raise ImportError("prepare_library_search needs numpy")
+
+        normalized_peak_arrays = []
+        precursor_masses = []
+        charges = []
+        self.library_peak_counts = np.zeros(len(self.spectrum_list), dtype=np.int64)
+        for i, myspectrum in enumerate(self.spectrum_list):
+            if myspectrum == None:
+                normalized_peak_arrays.append((np.zeros(0), np.zeros(0)))
+                precursor_masses.append(0.0)
+                charges.append(0)
+                self.library_peak_counts[i] = -1
+                continue
+            normalized_peak_arrays.append(myspectrum.get_normalized_peaks())
+            precursor_masses.append(myspectrum.mz * myspectrum.charge)
+            charges.append(myspectrum.charge)
+            self.library_peak_counts[i] = len(myspectrum.peaks)
+
+        self.library_arrays = spectrum_alignment.prepare_library_arrays(normalized_peak_arrays, precursor_masses, charges)
+        self.library_arrays_version = self.version
+
+    #Same search as search_spectrum, but the query is normalized once and scored against all candidates in one batched call, returns the best top_k hits. Without numpy this is search_spectrum
+    def search_spectrum_batch(self, otherspectrum, pm_tolerance, peak_tolerance, min_matched_peaks, min_score, analog_search=False, top_k=1):
+        if np is None:
+            return self.search_spectrum(otherspectrum, pm_tolerance, peak_tolerance, min_matched_peaks, min_score, analog_search=analog_search, top_k=top_k)
+
+        if otherspectrum == None:
+            return []
+
+        if len(otherspectrum.peaks) < min_matched_peaks:
+            return []
+
+        if self.library_arrays is None or self.library_arrays_version != self.version:
+            self.prepare_library_search()
+
+        if analog_search == False:
+            candidate_indices = np.array(self.get_precursor_candidates(otherspectrum.mz, pm_tolerance), dtype=np.int64)
+        else:
+            candidate_indices = np.arange(len(self.spectrum_list))
+        candidate_peak_counts = self.library_peak_counts[candidate_indices]
+        candidate_indices = candidate_indices[(candidate_peak_counts >= 0) & (candidate_peak_counts >= min_matched_peaks)]
+
+        query_mz, query_intensity = otherspectrum.get_normalized_peaks()
+        cosine_scores, matched_peaks = spectrum_alignment.score_alignment_one_vs_many(query_mz, query_intensity, otherspectrum.mz * otherspectrum.charge, self.library_arrays, peak_tolerance, candidate_indices=candidate_indices)
+
+        hits = np.nonzero((cosine_scores > min_score) & (matched_peaks >= min_matched_peaks))[0]
+        hits = hits[np.argsort(-cosine_scores[hits], kind="stable")][:top_k]
+
+        match_list = []
+        for hit in hits.tolist():
+            myspectrum = self.spectrum_list[candidate_indices[hit]]
+            match_list.append(SpectrumMatch(myspectrum.filename, myspectrum.scan, otherspectrum.filename, otherspectrum.scan, float(cosine_scores[hit]), int(matched_peaks[hit]), abs(myspectrum.mz - otherspectrum.mz)))
+
+        return match_list
+
+    #Sorted precursor m/z index, candidates within a precursor tolerance are found by bisection instead of a linear scan. Built on the first lookup and again after version changes
+    def build_precursor_index(self):
+        indexed_precursors = []
+        for i, spectrum in enumerate(self.spectrum_list):
+            if spectrum != None:
+                indexed_precursors.append((spectrum.mz, i))
+        indexed_precursors.sort()
+        self.precursor_index_mz = [precursor[0] for precursor in indexed_precursors]
+        self.precursor_index_positions = [precursor[1] for precursor in indexed_precursors]
+        self.precursor_index_version = self.version
+
+    #Returns the positions in spectrum_list, in list order, of the spectra with precursor mz within pm_tolerance
+    def get_precursor_candidates(self, mz, pm_tolerance):
+        if self.precursor_index_mz is None or self.precursor_index_version != self.version:
+            self.build_precursor_index()
 
-                    match_list.append(match_obj)
+        left_bound_index = bisect.bisect_left(self.precursor_index_mz, mz - pm_tolerance)
+        right_bound_index = bisect.bisect_right(self.precursor_index_mz, mz + pm_tolerance)
 
-        match_list = sorted(match_list, key=lambda score_obj: score_obj["cosine"])
+        candidate_positions = []
+        for position in self.precursor_index_positions[left_bound_index:right_bound_index]:
+            if abs(self.spectrum_list[position].mz - mz) < pm_tolerance:
+                candidate_positions.append(position)
 
-        return match_list[:min(len(match_list), top_k)]
+        return sorted(candidate_positions)
 
-    #updates both the scans and the index, starting from 1
+    #updates both the scans and the index, starting from 1, the precursor index stays valid since the order does not change
     def make_scans_sequential(self):
         self.scandict = {}
         scan = 1
@@ -130,6 +315,113 @@ class SpectrumCollection:
         
         self.spectrum_list = new_spectrum_list
 
+    #window_filter_peaks on every spectrum, with numpy all the spectra are ranked together in one pass
+    def window_filter_peaks(self, window_size, top_peaks):
+        spectra = [spectrum for spectrum in self.spectrum_list if spectrum != None]
+        if np is None:
+            for spectrum in spectra:
+                spectrum.window_filter_peaks(window_size, top_peaks)
+            self.invalidate_search_cache()
+            return
+
+        mz, intensity, peak_offsets = get_spectra_peak_arrays(spectra)
+        peak_spectrum = np.repeat(np.arange(len(spectra)), np.diff(peak_offsets))
+        peak_indices = window_filter_peak_indices(mz, intensity, peak_spectrum, window_size, top_peaks)
+        spectrum_bounds = np.searchsorted(peak_spectrum[peak_indices], np.arange(len(spectra) + 1)).tolist()
+        for i, spectrum in enumerate(spectra):
+            spectrum_peak_indices = peak_indices[spectrum_bounds[i]:spectrum_bounds[i + 1]]
+            spectrum.peaks = PeakList.from_arrays(mz[spectrum_peak_indices], intensity[spectrum_peak_indices])
+        self.invalidate_search_cache()
+
+    #filter_peaks_noise_or_window on every spectrum, with numpy all the spectra are filtered together in one pass
+    def filter_peaks_noise_or_window(self, min_snr, window_size, top_peaks):
+        spectra = [spectrum for spectrum in self.spectrum_list if spectrum != None]
+        if np is None:
+            for spectrum in spectra:
+                spectrum.filter_peaks_noise_or_window(min_snr, window_size, top_peaks)
+            self.invalidate_search_cache()
+            return
+
+        mz, intensity, peak_offsets = get_spectra_peak_arrays(spectra)
+        peak_mask = noise_or_window_peak_mask(mz, intensity, peak_offsets, min_snr, window_size, top_peaks)
+        peak_offsets = peak_offsets.tolist()
+        for i, spectrum in enumerate(spectra):
+            spectrum_peak_mask = peak_mask[peak_offsets[i]:peak_offsets[i + 1]]
+            spectrum.peaks = PeakList.from_arrays(mz[peak_offsets[i]:peak_offsets[i + 1]][spectrum_peak_mask], intensity[peak_offsets[i]:peak_offsets[i + 1]][spectrum_peak_mask])
+        self.invalidate_search_cache()
+
+    ###
+    # Runs a chain of peak filters over all the spectra, every step on a spectrum before moving to the next one.
+    # A step is the name of a Spectrum filter in PREPROCESSING_STEPS followed by its arguments, e.g.
+    # [("filter_precursor_peaks",), ("window_filter_peaks", 50, 6)]. With more than one worker the spectra are
+    # filtered in chunks of chunk_size through ming_parallel_library. Returns a PreprocessingStepReport for
+    # each step with the time spent in it and the number of peaks it removed, verbose also prints them
+    ###
+    def preprocess(self, steps, workers=1, chunk_size=1000, verbose=False):
+        steps = [(step,) if isinstance(step, str) else tuple(step) for step in steps]
+        for step in steps:
+            if not step[0] in PREPROCESSING_STEPS:
+                raise ValueError("Unknown preprocessing step " + str(step[0]))
+
+        spectra = [spectrum for spectrum in self.spectrum_list if spectrum != None]
+        if workers == 1 or ming_parallel_library == None:
+            step_times, step_peaks_removed = preprocess_spectra(spectra, steps)
+        else:
+            job_parameters_list = []
+            for chunk_start in range(0, len(spectra), chunk_size):
+                job_parameters = {}
+                job_parameters["spectra"] = spectra[chunk_start:chunk_start + chunk_size]
+                job_parameters["steps"] = steps
+                job_parameters_list.append(job_parameters)
+            results = ming_parallel_library.run_parallel_job(preprocess_spectra_job, job_parameters_list, workers)
+
+            #The workers filter copies, their peaks are put back on the spectra of this collection
+            step_times = [0.0] * len(steps)
+            step_peaks_removed = [0] * len(steps)
+            for job_parameters, result in zip(job_parameters_list, results):
+                peak_arrays, job_step_times, job_step_peaks_removed = result
+                for spectrum, spectrum_peak_arrays in zip(job_parameters["spectra"], peak_arrays):
+                    spectrum.peaks = PeakList.from_arrays(spectrum_peak_arrays[0], spectrum_peak_arrays[1])
+                for i in range(len(steps)):
+                    step_times[i] += job_step_times[i]
+                    step_peaks_removed[i] += job_step_peaks_removed[i]
+        self.invalidate_search_cache()
+
+        report = []
+        for i, step in enumerate(steps):
+            report.append(PreprocessingStepReport(step[0], step_times[i], step_peaks_removed[i]))
+            if verbose:
+                print("Step\t%s\tTime\t%f\tPeaks Removed\t%d" % (step[0], step_times[i], step_peaks_removed[i]))
+        return report
+
+    ###
+    # Fills in the annotation metrics of all the PeptideLibrarySpectrum in the collection, see
+    # calculate_psm_annotation_metrics. With more than one worker the spectra are annotated in chunks
+    # of chunk_size through ming_parallel_library
+    ###
+    def calculate_annotation_metrics(self, tolerance, SNR=2.0, signal_SNR=5, workers=1, chunk_size=1000):
+        spectra = [spectrum for spectrum in self.spectrum_list if isinstance(spectrum, PeptideLibrarySpectrum)]
+
+        job_parameters_list = []
+        for chunk_start in range(0, len(spectra), chunk_size):
+            job_parameters = {}
+            job_parameters["spectra"] = [(spectrum.peaks, spectrum.charge, spectrum.peptide) for spectrum in spectra[chunk_start:chunk_start + chunk_size]]
+            job_parameters["tolerance"] = tolerance
+            job_parameters["SNR"] = SNR
+            job_parameters["signal_SNR"] = signal_SNR
+            job_parameters_list.append(job_parameters)
+
+        if workers == 1 or ming_parallel_library == None:
+            results = [calculate_psm_annotation_metrics_job(job_parameters) for job_parameters in job_parameters_list]
+        else:
+            results = ming_parallel_library.run_parallel_job(calculate_psm_annotation_metrics_job, job_parameters_list, workers)
+
+        all_metrics = []
+        for metrics_list in results:
+            all_metrics += metrics_list
+        for spectrum, metrics in zip(spectra, all_metrics):
+            spectrum.set_annotation_metrics(metrics)
+
     #outputs to an MGF and redoes the scan numbering
     def save_to_mgf(self, output_mgf, renumber_scans=True):
         if renumber_scans == True:
@@ -138,9 +430,12 @@ class SpectrumCollection:
             if spectrum != None:
                 output_mgf.write(spectrum.get_mgf_string() + "\n")
 
-    def save_to_tsv(self, output_tsv_file, mgf_filename="", renumber_scans=True):
+    #With an annotation_tolerance the annotation metrics of the peptide spectra are computed before writing
+    def save_to_tsv(self, output_tsv_file, mgf_filename="", renumber_scans=True, annotation_tolerance=None, workers=1):
         if renumber_scans == True:
             self.make_scans_sequential()
+        if annotation_tolerance != None:
+            self.calculate_annotation_metrics(annotation_tolerance, workers=workers)
         output_tsv_file.write(self.spectrum_list[0].get_tsv_header() + "\n")
         for spectrum in self.spectrum_list:
             if spectrum != None:
@@ -152,7 +447,419 @@ class SpectrumCollection:
                 output_sptxt_file.write(spectrum.get_sptxt_string() + "\n")
 
 
+SPECTRUM_CACHE_VERSION = 1
+SPECTRUM_CACHE_COLUMNS = ["scan", "index", "mz", "charge", "ms_level", "retention_time", "collision_energy", "precursor_intensity", "totIonCurrent", "filename_code", "fragmentation_code", "peak_offsets", "peak_mz", "peak_intensity"]
+
+MAPPED_LIBRARY_COLUMNS = ["normalized_intensity", "precursor_order", "precursor_sorted_mz"]
+
+def get_spectrum_cache_filename(filename):
+    return filename + ".spectracache"
+
+#Applies the preprocessing steps to each spectrum in turn, returns the time and peaks removed of every step
+def preprocess_spectra(spectra, steps):
+    step_times = [0.0] * len(steps)
+    step_peaks_removed = [0] * len(steps)
+    for spectrum in spectra:
+        spectrum_step_times, spectrum_step_peaks_removed = spectrum.apply_preprocessing_steps(steps)
+        for i in range(len(steps)):
+            step_times[i] += spectrum_step_times[i]
+            step_peaks_removed[i] += spectrum_step_peaks_removed[i]
+    return step_times, step_peaks_removed
+
+###
+# One preprocessing step on the peak arrays of a spectrum with precursor precursor_mz, returns the kept
+# mz and intensity arrays. The steps filter the same way as the Spectrum methods of the same name
+###
+def apply_preprocessing_step(mz, intensity, precursor_mz, step):
+    step_name = step[0]
+    if step_name == "filter_precursor_peaks":
+        peak_mask = np.abs(mz - precursor_mz) > 20.0
+    elif step_name == "filter_peak_mass_range":
+        lower, higher = step[1:]
+        peak_mask = (mz < lower) | (mz > higher)
+    elif step_name == "filter_noise_peaks":
+        min_snr = step[1]
+        peak_mask = intensity > ming_numerical_utilities.calculate_noise_level_in_intensities(intensity) * min_snr
+    elif step_name == "window_filter_peaks":
+        window_size, top_peaks = step[1:]
+        peak_indices = window_filter_peak_indices(mz, intensity, np.zeros(len(mz), dtype=np.int64), window_size, top_peaks)
+        return mz[peak_indices], intensity[peak_indices]
+    elif step_name == "filter_peaks_noise_or_window":
+        min_snr, window_size, top_peaks = step[1:]
+        peak_mask = noise_or_window_peak_mask(mz, intensity, np.array([0, len(mz)]), min_snr, window_size, top_peaks)
+    elif step_name == "filter_to_top_peaks":
+        top_k_peaks = step[1]
+        top_indices = np.argsort(-intensity, kind="stable")[:top_k_peaks]
+        top_indices = top_indices[np.argsort(mz[top_indices], kind="stable")]
+        return mz[top_indices], intensity[top_indices]
+    else:
+        raise ValueError("Unknown preprocessing step " + str(step_name))
+    return mz[peak_mask], intensity[peak_mask]
+
+def preprocess_spectra_job(job_parameters):
+    spectra = job_parameters["spectra"]
+    step_times, step_peaks_removed = preprocess_spectra(spectra, job_parameters["steps"])
+    peak_arrays = [(spectrum.peaks.mz, spectrum.peaks.intensity) for spectrum in spectra]
+    return peak_arrays, step_times, step_peaks_removed
+
+###
+# Binary columnar cache of a list of spectra, a directory with a .npy file per column and a meta.json.
+# The spectrum metadata are columns with a row per spectrum, filenames and fragmentation methods are
+# codes into lists in the meta. The peaks of all the spectra are concatenated in peak_mz and peak_intensity,
+# spectrum i has the peaks peak_offsets[i] to peak_offsets[i + 1], so they can be memory mapped.
+# The size and mtime of the source file and the load parameters are kept to tell when the cache is stale
+###
+def write_spectrum_cache(spectrum_list, cache_filename, source_filename, load_parameters={}):
+    spectra = [spectrum for spectrum in spectrum_list if spectrum != None]
+    filenames = sorted(set([spectrum.filename for spectrum in spectra]))
+    fragmentation_methods = sorted(set([spectrum.fragmenation_method for spectrum in spectra]))
+    filename_codes = dict([(filename, code) for code, filename in enumerate(filenames)])
+    fragmentation_codes = dict([(fragmentation_method, code) for code, fragmentation_method in enumerate(fragmentation_methods)])
+
+    columns = {}
+    columns["scan"] = np.array([spectrum.scan for spectrum in spectra], dtype=np.int64)
+    columns["index"] = np.array([spectrum.index for spectrum in spectra], dtype=np.int64)
+    columns["mz"] = np.array([spectrum.mz for spectrum in spectra], dtype=np.float64)
+    columns["charge"] = np.array([spectrum.charge for spectrum in spectra], dtype=np.int64)
+    columns["ms_level"] = np.array([spectrum.ms_level for spectrum in spectra], dtype=np.int64)
+    columns["retention_time"] = np.array([spectrum.retention_time for spectrum in spectra], dtype=np.float64)
+    columns["collision_energy"] = np.array([spectrum.collision_energy for spectrum in spectra], dtype=np.float64)
+    columns["precursor_intensity"] = np.array([spectrum.precursor_intensity for spectrum in spectra], dtype=np.float64)
+    columns["totIonCurrent"] = np.array([spectrum.totIonCurrent for spectrum in spectra], dtype=np.float64)
+    columns["filename_code"] = np.array([filename_codes[spectrum.filename] for spectrum in spectra], dtype=np.int32)
+    columns["fragmentation_code"] = np.array([fragmentation_codes[spectrum.fragmenation_method] for spectrum in spectra], dtype=np.int32)
+
+    peak_offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum([len(spectrum.peaks) for spectrum in spectra], out=peak_offsets[1:])
+    peak_mz = np.empty(peak_offsets[-1], dtype=np.float64)
+    peak_intensity = np.empty(peak_offsets[-1], dtype=np.float64)
+    for i, spectrum in enumerate(spectra):
+        if peak_offsets[i + 1] > peak_offsets[i]:
+            peak_mz[peak_offsets[i]:peak_offsets[i + 1]] = np.frombuffer(spectrum.peaks.mz, dtype=np.float64)
+            peak_intensity[peak_offsets[i]:peak_offsets[i + 1]] = np.frombuffer(spectrum.peaks.intensity, dtype=np.float64)
+    columns["peak_offsets"] = peak_offsets
+    columns["peak_mz"] = peak_mz
+    columns["peak_intensity"] = peak_intensity
+
+    #The meta is written last, a cache without one is incomplete. The MappedSpectrumLibrary columns are written with the cache
+    if not os.path.isdir(cache_filename):
+        os.makedirs(cache_filename)
+    meta_filename = os.path.join(cache_filename, "meta.json")
+    if os.path.exists(meta_filename):
+        os.remove(meta_filename)
+    for column_name in SPECTRUM_CACHE_COLUMNS:
+        save_cache_column(cache_filename, column_name, columns[column_name])
+    write_mapped_library_columns(columns, cache_filename)
+
+    source_stat = os.stat(source_filename)
+    meta = {}
+    meta["version"] = SPECTRUM_CACHE_VERSION
+    meta["source_size"] = source_stat.st_size
+    meta["source_mtime"] = source_stat.st_mtime
+    meta["load_parameters"] = load_parameters
+    meta["spectrum_count"] = len(spectra)
+    meta["filenames"] = filenames
+    meta["fragmentation_methods"] = fragmentation_methods
+    with open(meta_filename, "w") as meta_file:
+        json.dump(meta, meta_file)
+
+###
+# Returns the meta and the columns of a spectrum cache, memory mapped with mmap_mode. None when the cache
+# is missing or was written for other load parameters or another version of the source file, these are
+# only checked when given
+###
+def read_spectrum_cache(cache_filename, source_filename=None, load_parameters=None, mmap_mode="r"):
+    meta_filename = os.path.join(cache_filename, "meta.json")
+    if not os.path.exists(meta_filename):
+        return None
+    meta = json.load(open(meta_filename))
+    if meta["version"] != SPECTRUM_CACHE_VERSION:
+        return None
+    if load_parameters != None and meta["load_parameters"] != load_parameters:
+        return None
+    if source_filename != None and os.path.exists(source_filename):
+        source_stat = os.stat(source_filename)
+        if meta["source_size"] != source_stat.st_size or meta["source_mtime"] != source_stat.st_mtime:
+            return None
+
+    columns = {}
+    for column_name in SPECTRUM_CACHE_COLUMNS:
+        columns[column_name] = np.load(os.path.join(cache_filename, column_name + ".npy"), mmap_mode=mmap_mode)
+    return meta, columns
+
+#Creates the Spectrum objects of the rows start to end of the cache columns
+def load_spectra_from_cache(meta, columns, start=0, end=None):
+    if end == None:
+        end = meta["spectrum_count"]
+
+    row_columns = {}
+    for column_name in ["scan", "index", "mz", "charge", "ms_level", "retention_time", "collision_energy", "precursor_intensity", "totIonCurrent", "filename_code", "fragmentation_code"]:
+        row_columns[column_name] = columns[column_name][start:end].tolist()
+    peak_offsets = columns["peak_offsets"][start:end + 1].tolist()
+    peak_mz = np.asarray(columns["peak_mz"][peak_offsets[0]:peak_offsets[-1]])
+    peak_intensity = np.asarray(columns["peak_intensity"][peak_offsets[0]:peak_offsets[-1]])
+
+    spectra = []
+    for i in range(end - start):
+        peak_start = peak_offsets[i] - peak_offsets[0]
+        peak_end = peak_offsets[i + 1] - peak_offsets[0]
+        spectrum = Spectrum(
+            meta["filenames"][row_columns["filename_code"][i]],
+            row_columns["scan"][i],
+            row_columns["index"][i],
+            PeakList.from_arrays(peak_mz[peak_start:peak_end], peak_intensity[peak_start:peak_end]),
+            row_columns["mz"][i],
+            row_columns["charge"][i],
+            row_columns["ms_level"][i],
+            collision_energy=row_columns["collision_energy"][i],
+            fragmentation_method=meta["fragmentation_methods"][row_columns["fragmentation_code"][i]],
+            precursor_intensity=row_columns["precursor_intensity"][i],
+            totIonCurrent=row_columns["totIonCurrent"][i]
+        )
+        spectrum.retention_time = row_columns["retention_time"][i]
+        spectra.append(spectrum)
+    return spectra
+
+###
+# Read only spectrum library memory mapped from a spectrum cache, peaks and metadata stay in the flat
+# cache arrays so worker processes share the pages of a single copy. It pickles as its path and a worker
+# attaches by mapping the same files. Searching scores like SpectrumCollection.search_spectrum_batch with
+# the sqrt normalized intensities and precursor index written with the cache, attaching only reads files
+###
+class MappedSpectrumLibrary:
+    def __init__(self, cache_filename):
+        self.cache_filename = cache_filename
+        self.attach()
+
+    def attach(self):
+        spectrum_cache = read_spectrum_cache(self.cache_filename)
+        if spectrum_cache == None:
+            raise ValueError("No spectrum cache at " + self.cache_filename)
+        self.meta, self.columns = spectrum_cache
+
+        #Only write_spectrum_cache writes these columns, caches written before they existed have to be rebuilt
+        for column_name in MAPPED_LIBRARY_COLUMNS:
+            if not os.path.exists(os.path.join(self.cache_filename, column_name + ".npy")):
+                raise ValueError("Spectrum cache at " + self.cache_filename + " has no " + column_name + " column, rebuild the cache with save_to_cache")
+        for column_name in MAPPED_LIBRARY_COLUMNS:
+            self.columns[column_name] = np.load(os.path.join(self.cache_filename, column_name + ".npy"), mmap_mode="r")
+
+        self.peak_counts = np.diff(self.columns["peak_offsets"])
+        self.library_arrays = spectrum_alignment.LibraryArrays(
+            mz = self.columns["peak_mz"],
+            intensity = self.columns["normalized_intensity"],
+            offsets = self.columns["peak_offsets"],
+            precursor_masses = self.columns["mz"] * self.columns["charge"],
+            max_charges = self.columns["charge"]
+        )
+
+    def __getstate__(self):
+        return {"cache_filename": self.cache_filename}
+
+    def __setstate__(self, state):
+        self.cache_filename = state["cache_filename"]
+        self.attach()
+
+    def __len__(self):
+        return self.meta["spectrum_count"]
+
+    #Creates the Spectrum at a position of the library
+    def get_spectrum(self, position):
+        return load_spectra_from_cache(self.meta, self.columns, position, position + 1)[0]
+
+    #Returns the positions, in library order, of the spectra with precursor mz within pm_tolerance
+    def get_precursor_candidates(self, mz, pm_tolerance):
+        left_bound_index = np.searchsorted(self.columns["precursor_sorted_mz"], mz - pm_tolerance, side="left")
+        right_bound_index = np.searchsorted(self.columns["precursor_sorted_mz"], mz + pm_tolerance, side="right")
+        candidate_positions = np.array(self.columns["precursor_order"][left_bound_index:right_bound_index])
+        candidate_positions = candidate_positions[np.abs(self.columns["mz"][candidate_positions] - mz) < pm_tolerance]
+        return np.sort(candidate_positions)
+
+    def search_spectrum(self, otherspectrum, pm_tolerance, peak_tolerance, min_matched_peaks, min_score, analog_search=False, top_k=1):
+        if otherspectrum == None:
+            return []
+
+        if len(otherspectrum.peaks) < min_matched_peaks:
+            return []
+
+        if analog_search == False:
+            candidate_indices = self.get_precursor_candidates(otherspectrum.mz, pm_tolerance)
+        else:
+            candidate_indices = np.arange(len(self))
+        candidate_indices = candidate_indices[self.peak_counts[candidate_indices] >= min_matched_peaks]
+
+        query_mz, query_intensity = otherspectrum.get_normalized_peaks()
+        cosine_scores, matched_peaks = spectrum_alignment.score_alignment_one_vs_many(query_mz, query_intensity, otherspectrum.mz * otherspectrum.charge, self.library_arrays, peak_tolerance, candidate_indices=candidate_indices)
+
+        hits = np.nonzero((cosine_scores > min_score) & (matched_peaks >= min_matched_peaks))[0]
+        hits = hits[np.argsort(-cosine_scores[hits], kind="stable")][:top_k]
+
+        match_list = []
+        for hit in hits.tolist():
+            position = candidate_indices[hit]
+            filename = self.meta["filenames"][self.columns["filename_code"][position]]
+            mz_delta = abs(float(self.columns["mz"][position]) - otherspectrum.mz)
+            match_list.append(SpectrumMatch(filename, int(self.columns["scan"][position]), otherspectrum.filename, otherspectrum.scan, float(cosine_scores[hit]), int(matched_peaks[hit]), mz_delta))
+
+        return match_list
+
+#Writes the sqrt normalized intensities and the precursor index used by MappedSpectrumLibrary to a spectrum cache
+def write_mapped_library_columns(columns, cache_filename):
+    peak_offsets = np.asarray(columns["peak_offsets"]).tolist()
+    normalized_intensity = np.empty(peak_offsets[-1], dtype=np.float64)
+    for i in range(len(peak_offsets) - 1):
+        spectrum_intensity = columns["peak_intensity"][peak_offsets[i]:peak_offsets[i + 1]]
+        normalized_intensity[peak_offsets[i]:peak_offsets[i + 1]] = spectrum_alignment.sqrt_normalize_arrays(spectrum_intensity, spectrum_intensity)[1]
+
+    precursor_order = np.argsort(columns["mz"], kind="stable")
+
+    #The last column marks the library columns as complete
+    save_cache_column(cache_filename, "normalized_intensity", normalized_intensity)
+    save_cache_column(cache_filename, "precursor_order", precursor_order)
+    save_cache_column(cache_filename, "precursor_sorted_mz", np.asarray(columns["mz"])[precursor_order])
+
+#Saves a cache column to a temporary file that is then renamed over the column, readers never see a partial file
+def save_cache_column(cache_filename, column_name, values):
+    temp_filename = os.path.join(cache_filename, "%s.npy.%d.%d.tmp" % (column_name, os.getpid(), threading.get_ident()))
+    try:
+        with open(temp_filename, "wb") as temp_file:
+            np.save(temp_file, values)
+        os.replace(temp_filename, os.path.join(cache_filename, column_name + ".npy"))
+    except:
+        os.remove(temp_filename)
+        raise
+
+###
+# Compact storage for the peaks of a spectrum, the m/z and intensity values are kept in two contiguous
+# array('d') instead of a list of [mz, intensity] lists. Indexing, slicing and iterating still give
+# [mz, intensity] lists, these are PeakViews so peak[1] *= 2 writes through to the stored peak.
+# Every change made through the PeakList or its views bumps the version, which spectra check before using
+# their cached normalized peaks, changing the mz and intensity arrays directly needs Spectrum.invalidate_peak_cache
+###
+class PeakList:
+    __slots__ = ['mz', 'intensity', '_version']
+
+    def __init__(self, peaks=None):
+        self.mz = array.array('d')
+        self.intensity = array.array('d')
+        self._version = 0
+        if peaks != None:
+            for peak in peaks:
+                self.mz.append(peak[0])
+                self.intensity.append(peak[1])
+
+    #Takes any sequences of m/z and intensity, numpy arrays are copied without per peak conversion
+    @staticmethod
+    def from_arrays(mz, intensity):
+        peak_list = PeakList()
+        peak_list.mz = _to_double_array(mz)
+        peak_list.intensity = _to_double_array(intensity)
+        return peak_list
+
+    def add_peak(self, mz, intensity):
+        self.mz.append(mz)
+        self.intensity.append(intensity)
+        self._changed()
+
+    def append(self, peak):
+        self.add_peak(peak[0], peak[1])
+
+    def extend(self, peaks):
+        if isinstance(peaks, PeakList):
+            mz_values, intensity_values = peaks.mz[:], peaks.intensity[:]
+        else:
+            peaks = [[peak[0], peak[1]] for peak in peaks]
+            mz_values, intensity_values = [peak[0] for peak in peaks], [peak[1] for peak in peaks]
+        self.mz.extend(mz_values)
+        self.intensity.extend(intensity_values)
+        self._changed()
+
+    #Sorts like a list of [mz, intensity] lists, by m/z then intensity unless a key is given
+    def sort(self, key=None, reverse=False):
+        peaks = sorted([[mz, intensity] for mz, intensity in zip(self.mz, self.intensity)], key=key, reverse=reverse)
+        self.mz = array.array('d', [peak[0] for peak in peaks])
+        self.intensity = array.array('d', [peak[1] for peak in peaks])
+        self._changed()
+
+    def __add__(self, other):
+        peak_list = PeakList.from_arrays(self.mz, self.intensity)
+        peak_list.extend(other)
+        return peak_list
+
+    def __radd__(self, other):
+        peak_list = PeakList(other)
+        peak_list.extend(self)
+        return peak_list
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __len__(self):
+        return len(self.mz)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [PeakView(self, i) for i in range(*index.indices(len(self.mz)))]
+        if index < 0:
+            index += len(self.mz)
+        if index < 0 or index >= len(self.mz):
+            raise IndexError("peak index out of range")
+        return PeakView(self, index)
+
+    def __setitem__(self, index, peak):
+        self.mz[index] = peak[0]
+        self.intensity[index] = peak[1]
+        self._changed()
+
+    def _changed(self):
+        self._version += 1
+
+    def __iter__(self):
+        for i in range(len(self.mz)):
+            yield PeakView(self, i)
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __repr__(self):
+        return repr(list(self))
+
+#[mz, intensity] of one peak in a PeakList, assigning either value writes it back to the PeakList.
+#The view follows the position of the peak, so it should not be kept across sorting or filtering
+class PeakView(list):
+    __slots__ = ['peak_list', 'index']
+
+    def __init__(self, peak_list, index):
+        list.__init__(self, (peak_list.mz[index], peak_list.intensity[index]))
+        self.peak_list = peak_list
+        self.index = index
+
+    def __setitem__(self, item, value):
+        list.__setitem__(self, item, value)
+        self.peak_list.mz[self.index] = list.__getitem__(self, 0)
+        self.peak_list.intensity[self.index] = list.__getitem__(self, 1)
+        self.peak_list._changed()
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+def _to_double_array(values):
+    if isinstance(values, array.array) and values.typecode == 'd':
+        return array.array('d', values)
+    if np is not None and isinstance(values, np.ndarray):
+        double_array = array.array('d')
+        double_array.frombytes(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        return double_array
+    return array.array('d', values)
+
+
 class Spectrum:
+    __slots__ = ['filename', 'scan', '_peaks', '_peaks_version', '_normalized_peaks', '_noise_level', 'mz', 'charge', 'index', 'ms_level', 'retention_time', 'collision_energy', 'fragmenation_method', 'precursor_intensity', 'totIonCurrent']
+
     def __init__(self, filename, scan, index, peaks, mz, charge, ms_level, collision_energy=0.0, fragmentation_method="NO_FRAG", precursor_intensity=0.0, totIonCurrent=0.0):
         self.filename = filename
         self.scan = scan
@@ -167,6 +874,49 @@ class Spectrum:
         self.precursor_intensity = precursor_intensity
         self.totIonCurrent = totIonCurrent
 
+    #Peaks are stored as a PeakList, assigning new peaks, which every peak filter does, or changing the PeakList in place invalidates the cached normalized peaks
+    @property
+    def peaks(self):
+        return self._peaks
+
+    @peaks.setter
+    def peaks(self, peaks):
+        if not isinstance(peaks, PeakList):
+            peaks = PeakList(peaks)
+        self._peaks = peaks
+        self.invalidate_peak_cache()
+
+    #Only needs to be called after modifying the mz or intensity arrays of the peaks directly
+    def invalidate_peak_cache(self):
+        self._normalized_peaks = None
+        self._noise_level = None
+        self._peaks_version = self._peaks._version
+
+    #Drops the cached values when the PeakList was changed in place since they were computed
+    def check_peak_cache(self):
+        if self._peaks_version != self._peaks._version:
+            self.invalidate_peak_cache()
+
+    #Noise level of the peaks as calculate_noise_level_in_peaks, computed once until the peaks change
+    def get_noise_level(self):
+        self.check_peak_cache()
+        if self._noise_level is None:
+            self._noise_level = ming_numerical_utilities.calculate_noise_level_in_peaks(self.peaks)
+        return self._noise_level
+
+    ###
+    # Sqrt normalized peaks used for scoring, computed once and reused until the peaks change.
+    # These are (mz array, intensity array) with numpy, otherwise a list of spectrum_alignment.Peak
+    ###
+    def get_normalized_peaks(self):
+        self.check_peak_cache()
+        if self._normalized_peaks is None:
+            if np is not None:
+                self._normalized_peaks = spectrum_alignment.sqrt_normalize_arrays(np.array(self.peaks.mz), np.array(self.peaks.intensity))
+            else:
+                self._normalized_peaks = spectrum_alignment.sqrt_normalize_spectrum(spectrum_alignment.convert_to_peaks(self.peaks))
+        return self._normalized_peaks
+
     def get_mgf_string(self):
         output_lines = []
         output_lines.append("BEGIN IONS")
@@ -198,26 +948,76 @@ class Spectrum:
 
     #Straight up cosine between two spectra
     def cosine_spectrum(self, other_spectrum, peak_tolerance):
-        total_score, reported_alignments = spectrum_alignment.score_alignment(self.peaks, other_spectrum.peaks, self.mz * self.charge, other_spectrum.mz * other_spectrum.charge, peak_tolerance, self.charge)
+        if np is not None:
+            mz1, intensity1 = self.get_normalized_peaks()
+            mz2, intensity2 = other_spectrum.get_normalized_peaks()
+            total_score, reported_alignments = spectrum_alignment.score_alignment_normalized_arrays(mz1, intensity1, mz2, intensity2, self.mz * self.charge, other_spectrum.mz * other_spectrum.charge, peak_tolerance, self.charge)
+        else:
+            total_score, reported_alignments = spectrum_alignment.score_alignment_normalized(self.get_normalized_peaks(), other_spectrum.get_normalized_peaks(), self.mz * self.charge, other_spectrum.mz * other_spectrum.charge, peak_tolerance, self.charge)
         return total_score, len(reported_alignments)
 
+    ###
+    # Runs preprocessing steps, see SpectrumCollection.preprocess, converting the peaks to numpy arrays once
+    # and back once. Returns the time spent in each step and the number of peaks it removed
+    ###
+    def apply_preprocessing_steps(self, steps):
+        step_times = []
+        step_peaks_removed = []
+        if np is None:
+            for step in steps:
+                peaks_before = len(self.peaks)
+                step_start = time.time()
+                getattr(self, step[0])(*step[1:])
+                step_times.append(time.time() - step_start)
+                step_peaks_removed.append(peaks_before - len(self.peaks))
+            return step_times, step_peaks_removed
+
+        mz, intensity = get_peak_arrays(self.peaks)
+        for step in steps:
+            peaks_before = len(mz)
+            step_start = time.time()
+            mz, intensity = apply_preprocessing_step(mz, intensity, self.mz, step)
+            step_times.append(time.time() - step_start)
+            step_peaks_removed.append(peaks_before - len(mz))
+        self.peaks = PeakList.from_arrays(mz, intensity)
+        return step_times, step_peaks_removed
+
     #Looks at windows of a given size, and picks the top peaks in there
     def window_filter_peaks(self, window_size, top_peaks):
+        if np is not None:
+            self.apply_preprocessing_steps([("window_filter_peaks", window_size, top_peaks)])
+            return
         new_peaks = window_filter_peaks(self.peaks, window_size, top_peaks)
         self.peaks = new_peaks
 
+    #Keeps the top peaks of each window and the peaks above min_snr
+    def filter_peaks_noise_or_window(self, min_snr, window_size, top_peaks):
+        if np is not None:
+            self.apply_preprocessing_steps([("filter_peaks_noise_or_window", min_snr, window_size, top_peaks)])
+            return
+        self.peaks = filter_peaks_noise_or_window(self.peaks, min_snr, window_size, top_peaks)
+
     def filter_to_top_peaks(self, top_k_peaks):
+        if np is not None:
+            self.apply_preprocessing_steps([("filter_to_top_peaks", top_k_peaks)])
+            return
         sorted_peaks = sorted(self.peaks, key=lambda peak: peak[1], reverse=True)
         sorted_peaks = sorted_peaks[:top_k_peaks]
         sorted_peaks = sorted(sorted_peaks, key=lambda peak: peak[0], reverse=False)
         self.peaks = sorted_peaks
 
     def filter_precursor_peaks(self):
+        if np is not None:
+            self.apply_preprocessing_steps([("filter_precursor_peaks",)])
+            return
         new_peaks = filter_precursor_peaks(self.peaks, 20.0, self.mz)
         self.peaks = new_peaks
 
     def filter_noise_peaks(self, min_snr):
-        average_noise_level = ming_numerical_utilities.calculate_noise_level_in_peaks(self.peaks)
+        if np is not None:
+            self.apply_preprocessing_steps([("filter_noise_peaks", min_snr)])
+            return
+        average_noise_level = self.get_noise_level()
         new_peaks = []
         for peak in self.peaks:
             if peak[1] > average_noise_level * min_snr:
@@ -225,6 +1025,9 @@ class Spectrum:
         self.peaks = new_peaks
 
     def filter_peak_mass_range(self, lower, higher):
+        if np is not None:
+            self.apply_preprocessing_steps([("filter_peak_mass_range", lower, higher)])
+            return
         new_peaks = []
         for peak in self.peaks:
             if peak[0] < lower or peak[0] > higher:
@@ -253,8 +1056,12 @@ class Spectrum:
 
         return peak_vector
 
+    #Normalized binned peaks with only the non-empty bins, see ming_numerical_utilities.vectorize_peaks_sparse
+    def get_sparse_peak_vector(self, max_mass=1500, bin_size=1, sqrt_peaks=True):
+        return ming_numerical_utilities.vectorize_peaks_sparse(self.peaks, max_mass, bin_size, sqrt_peaks=sqrt_peaks)
+
     def get_number_of_signal_peaks(self, SNR_Threshold=5):
-        return ming_numerical_utilities.calculate_signal_peaks_in_peaklist(self.peaks, SNR_Threshold)
+        return ming_numerical_utilities.calculate_signal_peaks_in_peaklist(self.peaks, SNR_Threshold, average_noise_intensity=self.get_noise_level())
 
     def get_number_of_peaks_within_percent_of_max(self, percent=1.0):
         max_peak_intensity = 0.0
@@ -308,6 +1115,21 @@ class PeptideLibrarySpectrum(Spectrum):
         annotated_peak_count = ming_psm_library.calculated_number_annotated_peaks(self.peaks, self.charge, self.peptide, tolerance)
         return annotated_peak_count
 
+    #Computes all the annotation metrics written to the tsv in one annotation of the peaks
+    def calculate_annotation_metrics(self, tolerance, SNR=2.0, signal_SNR=5):
+        metrics = calculate_psm_annotation_metrics(self.peaks, self.charge, self.peptide, tolerance, SNR=SNR, signal_SNR=signal_SNR)
+        self.set_annotation_metrics(metrics)
+        return metrics
+
+    def set_annotation_metrics(self, metrics):
+        self.annotated_peaks = metrics.annotated_peaks
+        self.explained_intensity = metrics.explained_intensity
+        self.signal_peaks = metrics.signal_peaks
+        self.number_of_peaks_within_1_percent_of_max = metrics.number_of_peaks_within_1_percent_of_max
+        self.number_of_peaks_within_5_percent_of_max = metrics.number_of_peaks_within_5_percent_of_max
+        self.annotated_ions = metrics.annotated_ions
+        self.number_of_b_y_breaks = metrics.number_of_b_y_breaks
+
     def get_mgf_string(self):
         output_string = "BEGIN IONS\n"
         output_string += "PEPMASS=" + str(self.mz) + "\n"
@@ -364,7 +1186,9 @@ class PeptideLibrarySpectrum(Spectrum):
     def get_tsv_header():
         return "mgf_filename\toriginalfilename\toriginalfile_filename\toriginalfile_scan\tspectrumindex\tspectrumscan\tcharge\tmz\tpeptide\tprotein\tcollision_energy\tannotated_peaks\texplained_intensity\tsignal_peaks\tnumber_of_peaks_within_1_percent_of_max\tnumber_of_peaks_within_5_percent_of_max\tpeaks\tannotated_ions\tnumber_of_b_y_breaks\tscore\tvariant_score\tlength\tpercentagebreaks\tproteosafe_task\tnum_spectra\tspectrum_ranking"
 
-    def get_tsv_line(self, output_mgf_filename=""):
+    def get_tsv_line(self, output_mgf_filename="", annotation_tolerance=None):
+        if annotation_tolerance != None:
+            self.calculate_annotation_metrics(annotation_tolerance)
         length_of_peptide = len(ming_psm_library.strip_sequence(self.peptide))
         percentage_breaks = float(self.number_of_b_y_breaks)/float(length_of_peptide)
         return "%s\t%s\t%s\t%s\t%d\t%d\t%d\t%f\t%s\t%s\t%f\t%d\t%f\t%d\t%d\t%d\t%d\t%d\t%d\t%f\t%f\t%d\t%f\t%s\t%d\t%d" % (output_mgf_filename, self.filename, self.originalfile_filename, self.originalfile_scan, self.index, self.scan, self.charge, self.mz, self.peptide, self.protein, self.collision_energy, self.annotated_peaks, self.explained_intensity, self.signal_peaks, self.number_of_peaks_within_1_percent_of_max, self.number_of_peaks_within_5_percent_of_max, len(self.peaks), self.annotated_ions, self.number_of_b_y_breaks, self.score, self.variant_score, length_of_peptide, percentage_breaks, self.proteosafe_task, self.num_spectra, self.spectrum_ranking)
@@ -373,7 +1197,7 @@ class PeptideLibrarySpectrum(Spectrum):
 def load_mgf_peptide_library(filename):
     charge = 0
     mz = 0
-    peaks = []
+    peak_lines = []
     scan = -1
     peptide = ""
     protein = ""
@@ -391,7 +1215,7 @@ def load_mgf_peptide_library(filename):
         if mgf_file_line == "BEGIN IONS":
             charge = 0
             mz = 0
-            peaks = []
+            peak_lines = []
             scan = -1
             peptide = ""
             protein = ""
@@ -400,7 +1224,7 @@ def load_mgf_peptide_library(filename):
             continue
 
         if mgf_file_line == "END IONS":
-            lib_spectrum = PeptideLibrarySpectrum(filename, scan, spectrum_index, peaks, mz, charge, peptide, protein, collision_energy=collision_energy)
+            lib_spectrum = PeptideLibrarySpectrum(filename, scan, spectrum_index, parse_mgf_peak_lines(peak_lines, " |\t"), mz, charge, peptide, protein, collision_energy=collision_energy)
             lib_spectrum.score = score
             lib_spectrum.fdr = fdr
             spectrum_index += 1
@@ -409,6 +1233,10 @@ def load_mgf_peptide_library(filename):
                 print("Spectrum " + str(spectrum_index), lib_spectrum.peptide)
             continue
 
+        if mgf_file_line.find("=") == -1:
+            peak_lines.append(mgf_file_line)
+            continue
+
         if mgf_file_line.find("PEPMASS=") != -1:
             mz = float(mgf_file_line[8:])
             continue
@@ -439,10 +1267,6 @@ def load_mgf_peptide_library(filename):
             fdr = float(mgf_file_line[4:])
             continue
 
-        if mgf_file_line.find("=") == -1:
-            peak_split = re.split(" |\t", mgf_file_line)
-            peaks.append([float(peak_split[0]), float(peak_split[1])])
-
     return output_spectra
 
 
@@ -556,87 +1380,122 @@ class LibrarySpectrum:
 
 
 
+###
+ # Parses the peak lines of one mgf spectrum. Peak lines normally hold an mz and an intensity split by a single
+ # space or tab, those split the same with any separator_pattern, so they are all converted in one go.
+ # Any other line makes every line go through re.split with separator_pattern
+###
+def parse_mgf_peak_lines(peak_lines, separator_pattern="[ |\t]+"):
+    peak_text = "".join(peak_lines)
+    has_space = peak_text.find(" ") != -1
+    has_tab = peak_text.find("\t") != -1
+    if peak_text.find("|") == -1 and has_space != has_tab:
+        separator = " " if has_space else "\t"
+        peak_tokens = []
+        for peak_line in peak_lines:
+            peak_split = peak_line.split(separator)
+            if len(peak_split) != 2:
+                break
+            peak_tokens += peak_split
+        else:
+            try:
+                peak_values = array.array('d', map(float, peak_tokens))
+                return PeakList.from_arrays(peak_values[0::2], peak_values[1::2])
+            except ValueError:
+                pass
+
+    peaks = PeakList()
+    for peak_line in peak_lines:
+        peak_split = re.split(separator_pattern, peak_line)
+        peaks.add_peak(float(peak_split[0]), float(peak_split[1]))
+    return peaks
+
 ###
  # Returns a list of spectrum objects
 ###
 def load_mgf_file(filename):
+    return list(iter_mgf_file(filename))
+
+###
+ # Yields the spectrum objects of an mgf one at a time, None for spectra without peaks
+ # Same parsing as load_mgf_file, but memory does not grow with the file size
+###
+def iter_mgf_file(filename):
     charge = 0
     mz = 0
-    peaks = []
+    peak_lines = []
     scan = 0
     peptide = ""
     protein = ""
     spectrum_count = 0
     non_empty_spectrum = 0
 
-    output_spectra = []
-
-    for line in open(filename, "r"):
-        mgf_file_line = line.rstrip()
-        if len(mgf_file_line) < 4:
-            continue
-
-        if mgf_file_line[0] == "#":
-            continue
+    with open(filename, "r") as mgf_file:
+        for line in mgf_file:
+            mgf_file_line = line.rstrip()
+            if len(mgf_file_line) < 4:
+                continue
 
-        if mgf_file_line == "BEGIN IONS":
-            charge = 0
-            mz = 0
-            peaks = []
-            scan = 0
-            peptide = ""
-            protein = ""
-            continue
+            if mgf_file_line[0] == "#":
+                continue
 
-        if mgf_file_line == "END IONS":
-            if spectrum_count % 10000 == 0:
-                print("Spectra Loaded\t%d\tReal\t%d" % (spectrum_count, non_empty_spectrum))
+            if mgf_file_line == "BEGIN IONS":
+                charge = 0
+                mz = 0
+                peak_lines = []
+                scan = 0
+                peptide = ""
+                protein = ""
+                continue
 
-            if len(peaks) > 0:
-                non_empty_spectrum += 1
-                adding_spectrum = Spectrum(filename, scan, -1, peaks, mz, charge, 2)
-                output_spectra.append(adding_spectrum)
-            else:
-                output_spectra.append(None)
-            spectrum_count += 1
-            continue
+            if mgf_file_line == "END IONS":
+                if spectrum_count % 10000 == 0:
+                    print("Spectra Loaded\t%d\tReal\t%d" % (spectrum_count, non_empty_spectrum))
 
-        if mgf_file_line[:8] == "PEPMASS=":
-            mz = float(mgf_file_line[8:])
-            continue
-        if mgf_file_line[:7] == "CHARGE=":
-            try:
-                if mgf_file_line[7:].find("-") != -1:
-                    charge = - int(mgf_file_line[7:].replace("-", ""))
+                if len(peak_lines) > 0:
+                    non_empty_spectrum += 1
+                    adding_spectrum = Spectrum(filename, scan, -1, parse_mgf_peak_lines(peak_lines), mz, charge, 2)
+                    yield adding_spectrum
                 else:
-                    charge = int(mgf_file_line[7:].replace("+", ""))
-            except:
-                charge = 0
+                    yield None
+                spectrum_count += 1
+                continue
 
-            continue
-        if mgf_file_line[:6] == "SCANS=":
-            scan = int(mgf_file_line[6:])
-            continue
+            #Peak lines are the only lines without an =, they are parsed together at the end of the spectrum
+            if mgf_file_line.find("=") == -1:
+                peak_lines.append(mgf_file_line)
+                continue
 
-        if mgf_file_line[:4] == "SEQ=":
-            peptide = mgf_file_line[4:]
-            continue
+            if mgf_file_line[:8] == "PEPMASS=":
+                mz = float(mgf_file_line[8:])
+                continue
+            if mgf_file_line[:7] == "CHARGE=":
+                try:
+                    if mgf_file_line[7:].find("-") != -1:
+                        charge = - int(mgf_file_line[7:].replace("-", ""))
+                    else:
+                        charge = int(mgf_file_line[7:].replace("+", ""))
+                except:
+                    charge = 0
 
-        if mgf_file_line[:8] == "PROTEIN=":
-            protein = mgf_file_line[8:]
-            continue
+                continue
+            if mgf_file_line[:6] == "SCANS=":
+                scan = int(mgf_file_line[6:])
+                continue
 
-        if mgf_file_line.find("=") == -1:
-            peak_split = re.split("[ |\t]+", mgf_file_line)
-            peaks.append([float(peak_split[0]), float(peak_split[1])])
+            if mgf_file_line[:4] == "SEQ=":
+                peptide = mgf_file_line[4:]
+                continue
 
-    return output_spectra
+            if mgf_file_line[:8] == "PROTEIN=":
+                protein = mgf_file_line[8:]
+                continue
 
 
 def load_gnps_library_mgf_file(filename):
     charge = 0
     mz = 0
-    peaks = []
+    peak_lines = []
     scan = 0
     peptide = ""
     protein = ""
@@ -659,7 +1518,7 @@ def load_gnps_library_mgf_file(filename):
         if mgf_file_line == "BEGIN IONS":
             charge = 0
             mz = 0
-            peaks = []
+            peak_lines = []
             scan = 0
             peptide = ""
             protein = ""
@@ -671,12 +1530,12 @@ def load_gnps_library_mgf_file(filename):
             if spectrum_count % 10000 == 0:
                 print("Spectra Loaded\t%d\tReal\t%d" % (spectrum_count, non_empty_spectrum))
 
-            if len(peaks) > 0:
+            if len(peak_lines) > 0:
                 if len(spectrumid) < 5:
                     print("Not a valid GNPS Library file")
                     exit(1)
                 non_empty_spectrum += 1
-                adding_spectrum = Spectrum(filename, scan, -1, peaks, mz, charge, 2)
+                adding_spectrum = Spectrum(filename, scan, -1, parse_mgf_peak_lines(peak_lines), mz, charge, 2)
                 library_spectrum = LibrarySpectrum(adding_spectrum)
                 library_spectrum.spectrumid = spectrumid
                 library_spectrum.inchi = inchi_string
@@ -687,6 +1546,10 @@ def load_gnps_library_mgf_file(filename):
             spectrum_count += 1
             continue
 
+        if mgf_file_line.find("=") == -1:
+            peak_lines.append(mgf_file_line)
+            continue
+
         if mgf_file_line[:8] == "PEPMASS=":
             mz = float(mgf_file_line[8:])
             continue
@@ -717,10 +1580,6 @@ def load_gnps_library_mgf_file(filename):
             smiles_string = mgf_file_line[7:]
             continue
 
-        if mgf_file_line.find("=") == -1:
-            peak_split = re.split("[ |\t]+", mgf_file_line)
-            peaks.append([float(peak_split[0]), float(peak_split[1])])
-
     return output_spectra
 
 
@@ -843,172 +1702,523 @@ def load_massbank_file(filename):
             peaks.append([float(splits[0]), float(splits[1])])
     return output_spectra
 
-#Decode peaks for mzXML
-def decode_spectrum(line, peaks_precision, peaks_compression, struct_iter_ok):
-
-    """https://groups.google.com/forum/#!topic/spctools-discuss/qK_QThoEzeQ"""
-
+#Decode peaks for mzXML straight into a PeakList, without creating a tuple per peak
+def decode_spectrum_peak_list(line, peaks_precision, peaks_compression):
     decoded = binascii.a2b_base64(line)
-    number_of_peaks = 0
-    unpack_format1 = ""
-
 
     if peaks_compression == "zlib":
         decoded = zlib.decompress(decoded)
 
-    #Assuming no compression
     if peaks_precision == 32:
-        number_of_peaks = len(decoded)/4
-        unpack_format1 = ">%df" % number_of_peaks
+        interleaved_peaks = array.array('f')
     else:
-        number_of_peaks = len(decoded)/8
-        unpack_format1 = ">%dd" % number_of_peaks
-
-    # peaks = []
-    # if struct_iter_ok:
-    #     peak_iter = struct.iter_unpack(unpack_format1,decoded)
-    #     peaks = [
-    #        pair for pair in zip(*[peak_iter] * 2)
-    #     ]
-    # else:
-    peaks = [
-       pair for pair in zip(*[iter(struct.unpack(unpack_format1,decoded))] * 2)
-    ]
-    return peaks
-    # peaks_list = struct.unpack(unpack_format1,decoded)
-    # return [
-    #     (peaks_list[i*2],peaks_list[i*2+1])
-    #     for i in range(0,int(len(peaks_list)/2))
-    # ]
+        interleaved_peaks = array.array('d')
+    interleaved_peaks.frombytes(decoded)
 
-def load_mzml_file(filename, drop_ms1=False):
-    output_ms1 = []
-    output_ms2 = []
+    #mzXML peaks are big endian
+    if sys.byteorder == "little":
+        interleaved_peaks.byteswap()
 
-    for spectrum in pyteomicsmzml.read(filename):
-        # print("==========================")
-        #
-        # for key in spectrum.keys():
-        #     print(key, spectrum[key])
+    return PeakList.from_arrays(interleaved_peaks[0::2], interleaved_peaks[1::2])
 
-        ms_level = spectrum["ms level"]
-        scan = -1
-        index = int(spectrum["index"])
-        peaks = []
-        #peaks_zipped = zip(spectrum["m/z array"], spectrum["intensity array"])
+###
+ # Decode peaks for mzXML as numpy views over the decoded bytes, the big endian values are read
+ # in place and the mz and intensity arrays are strided views of the interleaved pairs
+###
+def decode_spectrum_arrays(line, peaks_precision, peaks_compression):
+    decoded = binascii.a2b_base64(line)
 
-        for i in range(len(spectrum["m/z array"])):
-            peaks.append([float(spectrum["m/z array"][i]), float(spectrum["intensity array"][i])])
+    if peaks_compression == "zlib":
+        decoded = zlib.decompress(decoded)
 
+    if peaks_precision == 32:
+        interleaved_peaks = np.frombuffer(decoded, dtype=">f4")
+    else:
+        interleaved_peaks = np.frombuffer(decoded, dtype=">f8")
 
+    return interleaved_peaks[0::2], interleaved_peaks[1::2]
 
-        #Determining scan
-        for id_split in spectrum["id"].split(" "):
-            if id_split.find("scan=") != -1:
-                scan = int(id_split.replace("scan=", ""))
-            if "scanId=" in id_split:
-                scan = int(id_split.replace("scanId=", ""))
+def load_mzml_file(filename, drop_ms1=False, workers=1):
+    output_spectra = []
 
-        if ms_level == 1:
-            if drop_ms1 == False:
-                output = Spectrum(
-                        filename,
-                        scan,
-                        index,
-                        peaks,
-                        0,
-                        0,
-                        ms_level
-                    )
-
-                output_ms1.append(output)
+    if workers == 1 or ming_parallel_library == None:
+        reader = pyteomicsmzml.MzML(filename, decode_binary=False)
+        read_spectra = [read_mzml_spectrum(spectrum, filename, drop_ms1) for spectrum in reader]
+        reader.close()
+    else:
+        read_spectra = read_mzml_spectra_parallel(filename, drop_ms1, workers)
 
-        if ms_level == 2:
-            precusor_list = spectrum["precursorList"]["precursor"][0]
-            activation = precusor_list["activation"]
-            collision_energy = float(activation["collision energy"])
+    for ms_level, output in read_spectra:
+        if output != None:
+            output_spectra.append(output)
 
-            selected_ion_list = precusor_list["selectedIonList"]
-            precursor_mz = float(selected_ion_list["selectedIon"][0]["selected ion m/z"])
-            precursor_intensity = 0
-            precursor_charge = 0
+    return output_spectra
 
-            try:
-                precursor_intensity = float(selected_ion_list["selectedIon"][0]["peak intensity"])
-            except:
-                precursor_intensity = 0
+###
+ # Reads an mzML with the spectra split in contiguous ranges of indices, each range read and decoded
+ # by a worker through the mzML index. Returns (ms_level, spectrum) in file order
+###
+def read_mzml_spectra_parallel(filename, drop_ms1, workers, chunks_per_worker=4):
+    with pyteomicsmzml.MzML(filename) as reader:
+        spectrum_count = len(reader)
+    chunk_size = max(1, int(math.ceil(float(spectrum_count) / (workers * chunks_per_worker))))
+
+    job_parameters_list = []
+    for range_start in range(0, spectrum_count, chunk_size):
+        job_parameters = {}
+        job_parameters["filename"] = filename
+        job_parameters["drop_ms1"] = drop_ms1
+        job_parameters["range_start"] = range_start
+        job_parameters["range_end"] = min(range_start + chunk_size, spectrum_count)
+        job_parameters_list.append(job_parameters)
+
+    read_spectra = []
+    for range_spectra in ming_parallel_library.run_parallel_job(read_mzml_range_job, job_parameters_list, workers):
+        read_spectra += range_spectra
+    return read_spectra
+
+def read_mzml_range_job(job_parameters):
+    reader = pyteomicsmzml.MzML(job_parameters["filename"], decode_binary=False)
+    range_spectra = []
+    for spectrum in reader[job_parameters["range_start"]:job_parameters["range_end"]]:
+        range_spectra.append(read_mzml_spectrum(spectrum, job_parameters["filename"], job_parameters["drop_ms1"]))
+    reader.close()
+    return range_spectra
 
-            try:
-                precursor_charge = int(selected_ion_list["selectedIon"][0]["charge state"])
-            except:
-                precursor_charge = 0
+###
+ # Returns the ms level and Spectrum of a pyteomics mzML spectrum, the Spectrum is None when it is not kept.
+ # The spectrum is read with decode_binary=False, so the peak arrays are only decoded for the spectra that
+ # are kept, straight into numpy arrays
+###
+def read_mzml_spectrum(spectrum, filename, drop_ms1):
+    ms_level = spectrum["ms level"]
+    if ms_level == 1 and drop_ms1 == True:
+        return ms_level, None
 
+    scan = -1
+    index = int(spectrum["index"])
+    peaks = PeakList.from_arrays(decode_mzml_array(spectrum, "m/z array"), decode_mzml_array(spectrum, "intensity array"))
 
-            fragmentation_method = "NO_FRAG"
-            totIonCurrent = float(spectrum["total ion current"])
 
-            try:
-                for key in activation:
-                    if key == "beam-type collision-induced dissociation":
-                        fragmentation_method = "HCD"
-            except:
-                fragmentation_method = "NO_FRAG"
+    #Determining scan
+    for id_split in spectrum["id"].split(" "):
+        if id_split.find("scan=") != -1:
+            scan = int(id_split.replace("scan=", ""))
+        if "scanId=" in id_split:
+            scan = int(id_split.replace("scanId=", ""))
 
+    if ms_level == 1:
+        if drop_ms1 == False:
             output = Spectrum(
                     filename,
                     scan,
                     index,
                     peaks,
-                    precursor_mz,
-                    precursor_charge,
-                    ms_level,
-                    collision_energy=collision_energy,
-                    fragmentation_method=fragmentation_method,
-                    precursor_intensity=precursor_intensity,
-                    totIonCurrent=totIonCurrent
+                    0,
+                    0,
+                    ms_level
                 )
-            output_ms1.append(output)
+            return ms_level, output
 
-    return output_ms1 + output_ms2
+    if ms_level == 2:
+        precusor_list = spectrum["precursorList"]["precursor"][0]
+        activation = precusor_list["activation"]
+        collision_energy = float(activation["collision energy"])
+
+        selected_ion_list = precusor_list["selectedIonList"]
+        precursor_mz = float(selected_ion_list["selectedIon"][0]["selected ion m/z"])
+        precursor_intensity = 0
+        precursor_charge = 0
 
-def load_mzxml_file(filename, drop_ms1=False):
+        try:
+            precursor_intensity = float(selected_ion_list["selectedIon"][0]["peak intensity"])
+        except:
+            precursor_intensity = 0
+
+        try:
+            precursor_charge = int(selected_ion_list["selectedIon"][0]["charge state"])
+        except:
+            precursor_charge = 0
+
+
+        fragmentation_method = "NO_FRAG"
+        totIonCurrent = float(spectrum["total ion current"])
+
+        try:
+            for key in activation:
+                if key == "beam-type collision-induced dissociation":
+                    fragmentation_method = "HCD"
+        except:
+            fragmentation_method = "NO_FRAG"
+
+        output = Spectrum(
+                filename,
+                scan,
+                index,
+                peaks,
+                precursor_mz,
+                precursor_charge,
+                ms_level,
+                collision_energy=collision_energy,
+                fragmentation_method=fragmentation_method,
+                precursor_intensity=precursor_intensity,
+                totIonCurrent=totIonCurrent
+            )
+        return ms_level, output
+
+    return ms_level, None
+
+#Decodes a binary array of a spectrum read with decode_binary=False, empty scans have an empty <binary> that pyteomics cannot decode
+def decode_mzml_array(spectrum, array_name):
+    binary_array = spectrum[array_name]
+    if spectrum.get("defaultArrayLength") == 0 or not binary_array.data:
+        return array.array('d')
+    return binary_array.decode()
+
+def load_mzxml_file(filename, drop_ms1=False, use_numpy=True, workers=1):
     output_ms1 = []
     output_ms2 = []
 
-    struct_iter_ok = True
-    canary = True
-
-    with open(filename) as fd:
-        xmltodict_start = time.time()
-        mzxml = xmltodict.parse(fd.read())
-        xmltodict_end = time.time()
-        print("XML time: " + str(xmltodict_end - xmltodict_start))
-        read_scans = mzxml['mzXML']['msRun']['scan']
-        filename_output = os.path.split(filename)[1]
-        index = 1
-        for scan in read_scans:
-            # print(scan)
-            ms_level, spectrum, struct_iter_ok, canary = read_mzxml_scan(scan, index, filename_output, struct_iter_ok, canary, drop_ms1)
-            index += 1
-            if ms_level == 1:
-                if drop_ms1 == False:
-                    output_ms1.append(spectrum)
-            if ms_level == 2:
-                output_ms2.append(spectrum)
-            nested_scans = scan.get('scan',[])
-            if not isinstance(nested_scans,list):
-                nested_scans = [nested_scans]
-            for nested_scan in nested_scans:
-                ms_level, spectrum, struct_iter_ok, canary = read_mzxml_scan(nested_scan, index, filename_output, struct_iter_ok, canary, drop_ms1)
-                index += 1
-                output_ms2.append(spectrum)
+    for ms_level, spectrum, nested in iter_mzxml_scans(filename, drop_ms1=drop_ms1, use_numpy=use_numpy, workers=workers):
+        if nested:
+            output_ms2.append(spectrum)
+            continue
+        if ms_level == 1:
+            if drop_ms1 == False:
+                output_ms1.append(spectrum)
+        if ms_level == 2:
+            output_ms2.append(spectrum)
     return output_ms1 + output_ms2
 
-def read_mzxml_scan(scan, index, filename_output, struct_iter_ok, canary, drop_ms1):
+###
+ # Yields the spectra of an mzXML in file order, the same spectra load_mzxml_file returns
+###
+def iter_mzxml_file(filename, drop_ms1=False, use_numpy=True, workers=1):
+    for ms_level, spectrum, nested in iter_mzxml_scans(filename, drop_ms1=drop_ms1, use_numpy=use_numpy, workers=workers):
+        if spectrum == None:
+            continue
+        if nested or ms_level == 1 or ms_level == 2:
+            yield spectrum
+
+###
+ # Yields (ms_level, spectrum, nested) for every scan of an mzXML with the index load_mzxml_file gives it.
+ # With more than one worker the scans are decoded in chunks of chunk_size through ming_parallel_library,
+ # a few chunks per worker at a time, keeping the file order
+###
+def iter_mzxml_scans(filename, drop_ms1=False, use_numpy=True, workers=1, chunk_size=500):
+    filename_output = os.path.split(filename)[1]
+
+    if workers == 1 or ming_parallel_library == None:
+        for index, scan, nested in iter_mzxml_scan_dicts(filename):
+            ms_level, spectrum = read_mzxml_scan(scan, index, filename_output, drop_ms1, use_numpy=use_numpy)
+            yield ms_level, spectrum, nested
+        return
+
+    job_parameters_list = []
+    for scan_chunk in iter_list_chunks(iter_mzxml_scan_dicts(filename), chunk_size):
+        job_parameters = {}
+        job_parameters["scans"] = scan_chunk
+        job_parameters["filename_output"] = filename_output
+        job_parameters["drop_ms1"] = drop_ms1
+        job_parameters["use_numpy"] = use_numpy
+        job_parameters_list.append(job_parameters)
+
+        if len(job_parameters_list) == 4 * workers:
+            for decoded_scans in ming_parallel_library.run_parallel_job(decode_mzxml_scans_job, job_parameters_list, workers):
+                for decoded_scan in decoded_scans:
+                    yield decoded_scan
+            job_parameters_list = []
+
+    for decoded_scans in ming_parallel_library.run_parallel_job(decode_mzxml_scans_job, job_parameters_list, workers):
+        for decoded_scan in decoded_scans:
+            yield decoded_scan
+
+def decode_mzxml_scans_job(job_parameters):
+    decoded_scans = []
+    for index, scan, nested in job_parameters["scans"]:
+        ms_level, spectrum = read_mzxml_scan(scan, index, job_parameters["filename_output"], job_parameters["drop_ms1"], use_numpy=job_parameters["use_numpy"])
+        decoded_scans.append((ms_level, spectrum, nested))
+    return decoded_scans
+
+def iter_list_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+###
+ # Streams the scans of an mzXML with iterparse instead of parsing the whole document, yielding
+ # (index, scan, nested) with the scan in the dict layout of xmltodict. Each top level scan is read
+ # when it ends, followed by its nested scans, and then cleared so memory stays flat
+###
+def iter_mzxml_scan_dicts(filename):
+    index = 1
+
+    element_stack = []
+    scan_depth = 0
+    for event, element in ElementTree.iterparse(filename, events=("start", "end")):
+        tag = strip_xml_namespace(element.tag)
+        if event == "start":
+            element_stack.append(element)
+            if tag == "scan":
+                scan_depth += 1
+            continue
+
+        element_stack.pop()
+        if tag == "scan":
+            scan_depth -= 1
+            if scan_depth == 0:
+                scan_elements = [element] + [child for child in element if strip_xml_namespace(child.tag) == "scan"]
+                for scan_element in scan_elements:
+                    yield index, mzxml_element_to_dict(scan_element), scan_element is not element
+                    index += 1
+
+        #Nothing outside of the scans is used, so those elements are dropped once they end
+        if scan_depth == 0:
+            element.clear()
+            if len(element_stack) > 0:
+                element_stack[-1].remove(element)
+
+def strip_xml_namespace(tag):
+    if tag[0] == "{":
+        return tag[tag.find("}") + 1:]
+    return tag
+
+###
+ # Converts an ElementTree element to the dicts xmltodict makes, with '@' attributes and '#text',
+ # so read_mzxml_scan reads them the same way. Nested scans are left out as they are read on their own
+###
+def mzxml_element_to_dict(element):
+    element_dict = {}
+    for key, value in element.attrib.items():
+        element_dict["@" + strip_xml_namespace(key)] = value
+
+    for child in element:
+        child_tag = strip_xml_namespace(child.tag)
+        if child_tag == "scan":
+            continue
+        child_value = mzxml_element_to_dict(child)
+        if child_tag in element_dict:
+            if not isinstance(element_dict[child_tag], list):
+                element_dict[child_tag] = [element_dict[child_tag]]
+            element_dict[child_tag].append(child_value)
+        else:
+            element_dict[child_tag] = child_value
+
+    text = ""
+    if element.text != None:
+        text = element.text.strip()
+    if len(element_dict) == 0:
+        if len(text) == 0:
+            return None
+        return text
+    if len(text) > 0:
+        element_dict["#text"] = text
+    return element_dict
+
+###
+ # Random access to the scans of an mzXML through its scan offset index, so looking up a few scans
+ # does not parse the whole file. Works as a SpectrumCollection scandict, keyed by scan number or
+ # "filename:scan" like load_from_mzXML, and scans are only decoded when they are looked up.
+ # The index of a spectrum is its rank in the file, as in load_mzxml_file
+###
+class IndexedMzXMLFile:
+    def __init__(self, filename, drop_ms1=False, index_filename=None):
+        self.filename = filename
+        self.filename_output = os.path.split(filename)[1]
+        self.drop_ms1 = drop_ms1
+        self.scan_offsets = load_mzxml_scan_offsets(filename, index_filename=index_filename)
+        self.scan_positions = {}
+        for position, scan_offset in enumerate(self.scan_offsets):
+            self.scan_positions[scan_offset[0]] = position
+        self.spectrum_cache = {}
+
+    def get_scan_number(self, key):
+        if isinstance(key, str):
+            prefix = self.filename_output + ":"
+            if not key.startswith(prefix):
+                return None
+            try:
+                return int(key[len(prefix):])
+            except ValueError:
+                return None
+        return key
+
+    #Returns the spectrum of a scan number, None when the scan is not in the file or dropped
+    def get_spectrum(self, scan):
+        if scan in self.spectrum_cache:
+            return self.spectrum_cache[scan]
+        if not scan in self.scan_positions:
+            return None
+
+        position = self.scan_positions[scan]
+        with open(self.filename, "rb") as mzxml_file:
+            scan_element = read_mzxml_scan_element(mzxml_file, self.scan_offsets[position][1])
+        ms_level, spectrum = read_mzxml_scan(mzxml_element_to_dict(scan_element), position + 1, self.filename_output, self.drop_ms1)
+        self.spectrum_cache[scan] = spectrum
+        return spectrum
+
+    #All the spectra in the order of load_mzxml_file, MS1 then MS2
+    def get_spectra(self):
+        spectra = [self.get_spectrum(scan) for scan, offset in self.scan_offsets]
+        spectra = [spectrum for spectrum in spectra if spectrum != None]
+        return [spectrum for spectrum in spectra if spectrum.ms_level == 1] + [spectrum for spectrum in spectra if spectrum.ms_level == 2]
+
+    def get(self, key, default=None):
+        spectrum = self.get_spectrum(self.get_scan_number(key))
+        if spectrum == None:
+            return default
+        return spectrum
+
+    def __getitem__(self, key):
+        spectrum = self.get(key)
+        if spectrum == None:
+            raise KeyError(key)
+        return spectrum
+
+    def __contains__(self, key):
+        return self.get(key) != None
+
+    #All the scans in the index, without decoding them to check for dropped MS1
+    def keys(self):
+        all_keys = []
+        for scan, offset in self.scan_offsets:
+            all_keys.append(scan)
+            all_keys.append(self.filename_output + ":" + str(scan))
+        return all_keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return 2 * len(self.scan_offsets)
+
+###
+ # Returns the (scan number, byte offset) of every scan in file order. Uses the index at the end of the
+ # mzXML when it is valid, otherwise the scans are found by reading through the file. Only when an
+ # index_filename is given, e.g. filename + ".scanindex", the offsets found are saved there and read back
+ # while the mzXML keeps its size and modification time
+###
+def load_mzxml_scan_offsets(filename, index_filename=None):
+    scan_offsets = read_mzxml_index_offsets(filename)
+    if scan_offsets != None:
+        return scan_offsets
+
+    if index_filename == None:
+        return build_mzxml_scan_offsets(filename)
+
+    file_stat = os.stat(filename)
+    try:
+        with open(index_filename) as index_file:
+            saved_index = json.load(index_file)
+        if saved_index["file_size"] == file_stat.st_size and saved_index["file_mtime"] == file_stat.st_mtime:
+            return [tuple(scan_offset) for scan_offset in saved_index["scan_offsets"]]
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    scan_offsets = build_mzxml_scan_offsets(filename)
+    saved_index = {"file_size": file_stat.st_size, "file_mtime": file_stat.st_mtime, "scan_offsets": scan_offsets}
+    with open(index_filename, "w") as index_file:
+        json.dump(saved_index, index_file)
+    return scan_offsets
+
+#Reads the scan offsets from the indexOffset and index elements, None when missing or not pointing at scans
+def read_mzxml_index_offsets(filename):
+    with open(filename, "rb") as mzxml_file:
+        mzxml_file.seek(0, 2)
+        file_size = mzxml_file.tell()
+        mzxml_file.seek(max(file_size - 4096, 0))
+        index_offset_match = re.search(rb"<indexOffset>\s*(\d+)\s*</indexOffset>", mzxml_file.read())
+        if index_offset_match == None:
+            return None
+        index_offset = int(index_offset_match.group(1))
+        if index_offset >= file_size:
+            return None
+
+        mzxml_file.seek(index_offset)
+        index_match = re.search(rb'<index\s+name="scan"\s*>(.*?)</index>', mzxml_file.read(), re.S)
+        if index_match == None:
+            return None
+        scan_offsets = []
+        for offset_match in re.finditer(rb'<offset\s+id="(\d+)"\s*>\s*(\d+)\s*</offset>', index_match.group(1)):
+            scan_offsets.append((int(offset_match.group(1)), int(offset_match.group(2))))
+        if len(scan_offsets) == 0:
+            return None
+
+        scan_offsets = sorted(scan_offsets, key=lambda scan_offset: scan_offset[1])
+        for scan, offset in [scan_offsets[0], scan_offsets[-1]]:
+            mzxml_file.seek(offset)
+            if mzxml_file.read(6).rstrip() != b"<scan":
+                return None
+    return scan_offsets
+
+#Finds the scan offsets in a single pass over the file, for mzXML without a usable index
+def build_mzxml_scan_offsets(filename):
+    scan_tag_pattern = re.compile(rb'<scan\s[^>]*?\bnum\s*=\s*"(\d+)"')
+    scan_offsets = []
+    buffer = b""
+    buffer_offset = 0
+    with open(filename, "rb") as mzxml_file:
+        while True:
+            chunk = mzxml_file.read(1 << 20)
+            buffer += chunk
+            search_start = 0
+            tag_start = buffer.find(b"<scan", search_start)
+            while tag_start != -1:
+                tag_end = buffer.find(b">", tag_start)
+                if tag_end == -1:
+                    break
+                scan_tag_match = scan_tag_pattern.match(buffer, tag_start, tag_end + 1)
+                if scan_tag_match != None:
+                    scan_offsets.append((int(scan_tag_match.group(1)), buffer_offset + tag_start))
+                search_start = tag_end + 1
+                tag_start = buffer.find(b"<scan", search_start)
+
+            if len(chunk) == 0:
+                break
+
+            #Keeping a scan tag cut by the end of the chunk for the next one
+            if tag_start != -1:
+                keep_start = tag_start
+            else:
+                keep_start = max(search_start, len(buffer) - 4)
+            buffer_offset += keep_start
+            buffer = buffer[keep_start:]
+    return scan_offsets
+
+###
+ # Parses the scan element starting at a byte offset. The scan is fed to a pull parser under a
+ # wrapper root, reading until it ends, what follows it in the file is never parsed
+###
+def read_mzxml_scan_element(mzxml_file, offset):
+    mzxml_file.seek(offset)
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    parser.feed(b"<mzXMLScans>")
+    scan_depth = 0
+    while True:
+        chunk = mzxml_file.read(65536)
+        if len(chunk) == 0:
+            raise ValueError("Unterminated scan at offset " + str(offset))
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if strip_xml_namespace(element.tag) != "scan":
+                continue
+            if event == "start":
+                scan_depth += 1
+            else:
+                scan_depth -= 1
+                if scan_depth == 0:
+                    return element
+
+def read_mzxml_scan(scan, index, filename_output, drop_ms1, use_numpy=True):
     ms_level = int(scan['@msLevel'])
 
     if drop_ms1 == True and ms_level == 1:
-        return ms_level, None, struct_iter_ok, canary
+        return ms_level, None
 
     scan_number = int(scan['@num'])
     collision_energy = 0.0
@@ -1070,16 +2280,14 @@ def read_mzxml_scan(scan, index, filename_output, struct_iter_ok, canary, drop_m
     peaks_precision = float(scan['peaks'].get('@precision', '32'))
     peaks_compression = scan['peaks'].get('@compressionType', 'none')
     peak_string = scan['peaks'].get('#text', '')
-    if canary and peak_string != '':
-        try:
-            decode_spectrum(peak_string, peaks_precision, peaks_compression, struct_iter_ok)
-        except:
-            struct_iter_ok = False
-        canary = False
-    if peak_string != '':
-        peaks = decode_spectrum(peak_string, peaks_precision, peaks_compression, struct_iter_ok)
+    #use_numpy=False decodes with the array module instead of numpy
+    if peak_string != '' and use_numpy and np is not None:
+        mz_array, intensity_array = decode_spectrum_arrays(peak_string, peaks_precision, peaks_compression)
+        peaks = PeakList.from_arrays(mz_array, intensity_array)
+    elif peak_string != '':
+        peaks = decode_spectrum_peak_list(peak_string, peaks_precision, peaks_compression)
     else:
-        peaks = []
+        peaks = PeakList()
     if ms_level == 1:
         output = Spectrum(
             filename_output,
@@ -1105,7 +2313,7 @@ def read_mzxml_scan(scan, index, filename_output, struct_iter_ok, canary, drop_m
             totIonCurrent=totIonCurrent
         )
         output.retention_time = retention_time
-    return ms_level, output, struct_iter_ok, canary
+    return ms_level, output
 
 def write_mgf_file(filename, spectrum_list):
     print("WRITING")
@@ -1126,6 +2334,11 @@ def filter_noise_peaks(peaks, min_snr):
     return new_peaks
 
 def filter_peaks_noise_or_window(peaks, min_snr, window_size, top_peaks):
+    if np is not None:
+        mz, intensity = get_peak_arrays(peaks)
+        peak_mask = noise_or_window_peak_mask(mz, intensity, np.array([0, len(mz)]), min_snr, window_size, top_peaks)
+        return [peaks[i] for i in np.nonzero(peak_mask)[0].tolist()]
+
     window_filtered_peaks = window_filter_peaks(peaks, window_size, top_peaks)
     snr_peaks = filter_noise_peaks(peaks, min_snr)
 
@@ -1155,11 +2368,8 @@ def calculate_unique_ions_annotated(peaks, max_charge, peptide, tolerance):
 
     #Determining which ions are annotated
     annotated_ions = set()
-    for peak in peaks:
-        mass = peak[0]
-        for ion_peak in theoretical_peaks:
-            if abs(mass - theoretical_peaks[ion_peak]) < tolerance:
-                annotated_ions.add(ion_peak)
+    for ions in ming_psm_library.match_peaks_to_ions(theoretical_peaks, [peak[0] for peak in peaks], tolerance):
+        annotated_ions.update(ions)
 
     return list(annotated_ions)
 
@@ -1170,12 +2380,11 @@ def map_ions_to_peak(peaks, max_charge, tolerance, peptide, ions_to_consider=["b
 
     ions_to_peaks = defaultdict(list)
 
-    for peak in peaks:
-        mass = peak[0]
-        for ion_peak in theoretical_peaks:
-            if abs(mass - theoretical_peaks[ion_peak]) < tolerance:
-                ions_to_peaks[ion_peak].append(peak)
-                break
+    #Each peak goes to the first ion it matches
+    peak_ions = ming_psm_library.match_peaks_to_ions(theoretical_peaks, [peak[0] for peak in peaks], tolerance)
+    for peak, ions in zip(peaks, peak_ions):
+        if len(ions) > 0:
+            ions_to_peaks[ions[0]].append(peak)
 
     #Now lets choose the peak with biggest intensity
     ions_to_peak = {}
@@ -1241,7 +2450,84 @@ def attenuate_unannotated_peaks(peaks, max_charge, tolerance, peptide, attenuati
     new_peaks = sorted(new_peaks, key=lambda peak: peak[0])
     return new_peaks
 
+###
+# Annotation metrics of a PSM from a single annotation of its peaks, the same values as
+# calculated_number_annotated_peaks, calculated_explained_intensity, get_number_of_signal_peaks,
+# get_number_of_peaks_within_percent_of_max, calculated_number_unique_ions_annotated_in_signal and
+# determine_b_y_breaks_total. The theoretical ions are matched once and the noise level computed once,
+# the signal and b/y break metrics reuse the matches of the peaks that pass their filters
+###
+def calculate_psm_annotation_metrics(peaks, max_charge, peptide, tolerance, SNR=2.0, signal_SNR=5):
+    charge_set = range(1, max_charge + 1)
+    theoretical_peaks = ming_psm_library.create_theoretical_peak_map(peptide, ["b",  "b-iso", "y", "y-iso", "b-H2O", "b-NH3", "y-H2O", "y-NH3", "a"], charge_set=charge_set)
+    peak_ions = ming_psm_library.match_peaks_to_ions(theoretical_peaks, [peak[0] for peak in peaks], tolerance)
+    intensities = [peak[1] for peak in peaks]
+
+    max_peak_intensity = 0.0
+    for intensity in intensities:
+        max_peak_intensity = max(max_peak_intensity, intensity)
+
+    annotated_peaks = 0
+    for intensity, ions in zip(intensities, peak_ions):
+        if len(ions) > 0 and intensity/max_peak_intensity > 0.05:
+            annotated_peaks += 1
+
+    explained_intensity = 0.0
+    if len(peaks) > 0:
+        sum_annotated_peaks = sum(intensity for intensity, ions in zip(intensities, peak_ions) if len(ions) > 0)
+        sum_unannotated_peaks = sum(intensity for intensity, ions in zip(intensities, peak_ions) if len(ions) == 0)
+        explained_intensity = sum_annotated_peaks / (sum_annotated_peaks + sum_unannotated_peaks)
+
+    average_noise_level = ming_numerical_utilities.calculate_noise_level_in_peaks(peaks)
+    signal_peaks = ming_numerical_utilities.calculate_signal_peaks_in_peaklist(peaks, signal_SNR, average_noise_intensity=average_noise_level)
+    peaks_within_1_percent = len([intensity for intensity in intensities if intensity > 1.0 / 100.0 * max_peak_intensity])
+    peaks_within_5_percent = len([intensity for intensity in intensities if intensity > 5.0 / 100.0 * max_peak_intensity])
+
+    annotated_ions = set()
+    for intensity, ions in zip(intensities, peak_ions):
+        if intensity > average_noise_level * SNR:
+            annotated_ions.update(ions)
+
+    #b/y breaks are counted on the noise or window filtered peaks, from the first b or y ion each peak matches
+    if SNR > 1.0:
+        if np is not None:
+            mz, intensity = get_peak_arrays(peaks)
+            break_peak_mask = noise_or_window_peak_mask(mz, intensity, np.array([0, len(mz)]), SNR, 100, 20).tolist()
+        else:
+            masses_to_keep = set([peak[0] for peak in filter_peaks_noise_or_window(peaks, SNR, 100, 20)])
+            break_peak_mask = [peak[0] in masses_to_keep for peak in peaks]
+    else:
+        break_peak_mask = [True] * len(peaks)
+
+    peptide_length = len(ming_psm_library.strip_sequence(peptide))
+    prm_break_numbers = set()
+    for keep_peak, ions in zip(break_peak_mask, peak_ions):
+        if not keep_peak:
+            continue
+        for ion in ions:
+            ion_splits = ion.split(":")
+            if ion_splits[0] == "b":
+                prm_break_numbers.add(int(ion_splits[1]))
+                break
+            if ion_splits[0] == "y":
+                prm_break_numbers.add(peptide_length - int(ion_splits[1]) + 1)
+                break
+
+    return PSMAnnotationMetrics(annotated_peaks, explained_intensity, signal_peaks, peaks_within_1_percent, peaks_within_5_percent, len(annotated_ions), len(prm_break_numbers))
+
+#Annotation metrics of a list of (peaks, charge, peptide)
+def calculate_psm_annotation_metrics_job(job_parameters):
+    metrics_list = []
+    for peaks, charge, peptide in job_parameters["spectra"]:
+        metrics_list.append(calculate_psm_annotation_metrics(peaks, charge, peptide, job_parameters["tolerance"], SNR=job_parameters["SNR"], signal_SNR=job_parameters["signal_SNR"]))
+    return metrics_list
+
 def window_filter_peaks(peaks, window_size, top_peaks):
+    if np is not None:
+        mz, intensity = get_peak_arrays(peaks)
+        peak_indices = window_filter_peak_indices(mz, intensity, np.zeros(len(mz), dtype=np.int64), window_size, top_peaks)
+        return [peaks[i] for i in peak_indices.tolist()]
+
     peak_list_window_map = defaultdict(list)
     for peak in peaks:
         mass = peak[0]
@@ -1256,3 +2542,88 @@ def window_filter_peaks(peaks, window_size, top_peaks):
 
     new_peaks = sorted(new_peaks, key=lambda peak: peak[0])
     return new_peaks
+
+#mz and intensity numpy arrays of a PeakList or a list of peaks
+def get_peak_arrays(peaks):
+    if isinstance(peaks, PeakList):
+        return np.array(peaks.mz, dtype=np.float64), np.array(peaks.intensity, dtype=np.float64)
+    return np.array([peak[0] for peak in peaks], dtype=np.float64), np.array([peak[1] for peak in peaks], dtype=np.float64)
+
+#Concatenated peak arrays of a list of spectra, the peaks of spectrum i are peak_offsets[i] to peak_offsets[i + 1]
+def get_spectra_peak_arrays(spectra):
+    peak_offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum([len(spectrum.peaks) for spectrum in spectra], out=peak_offsets[1:])
+    mz = np.empty(peak_offsets[-1])
+    intensity = np.empty(peak_offsets[-1])
+    for i, spectrum in enumerate(spectra):
+        mz[peak_offsets[i]:peak_offsets[i + 1]] = spectrum.peaks.mz
+        intensity[peak_offsets[i]:peak_offsets[i + 1]] = spectrum.peaks.intensity
+    return mz, intensity, peak_offsets
+
+###
+ # Rank by intensity of every peak within its window_size mass bucket, as window_filter_peaks sorts the buckets.
+ # peak_spectrum gives the spectrum of each peak so many spectra are ranked with a single sort, ties in
+ # intensity keep the peak order. Peaks are ordered by one integer key, bucket then intensity rank, when it fits
+###
+def window_filter_peak_ranks(mz, intensity, peak_spectrum, window_size):
+    mass_bucket = (mz / window_size).astype(np.int64)
+    if len(mz) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    bucket_range = int(mass_bucket.max()) - int(mass_bucket.min()) + 1
+    if bucket_range * (int(peak_spectrum.max()) + 1) * len(mz) < 2 ** 62:
+        intensity_rank = np.empty(len(mz), dtype=np.int64)
+        intensity_rank[np.argsort(-intensity, kind="stable")] = np.arange(len(mz))
+        group_key = peak_spectrum * bucket_range + (mass_bucket - mass_bucket.min())
+        ordering = np.argsort(group_key * len(mz) + intensity_rank)
+        sorted_group_key = group_key[ordering]
+        group_start = np.ones(len(ordering), dtype=bool)
+        group_start[1:] = sorted_group_key[1:] != sorted_group_key[:-1]
+    else:
+        ordering = np.lexsort((-intensity, mass_bucket, peak_spectrum))
+        sorted_bucket = mass_bucket[ordering]
+        sorted_spectrum = peak_spectrum[ordering]
+        group_start = np.ones(len(ordering), dtype=bool)
+        group_start[1:] = (sorted_bucket[1:] != sorted_bucket[:-1]) | (sorted_spectrum[1:] != sorted_spectrum[:-1])
+    group_start_position = np.maximum.accumulate(np.where(group_start, np.arange(len(ordering)), 0))
+
+    ranks = np.empty(len(ordering), dtype=np.int64)
+    ranks[ordering] = np.arange(len(ordering)) - group_start_position
+    return ranks
+
+###
+ # Indices of the peaks window_filter_peaks keeps, grouped by spectrum and in its output order, by mass then
+ # intensity. peak_spectrum has to be non decreasing, the usual peaks sorted by mass stay in place
+###
+def window_filter_peak_indices(mz, intensity, peak_spectrum, window_size, top_peaks):
+    kept_indices = np.nonzero(window_filter_peak_ranks(mz, intensity, peak_spectrum, window_size) < top_peaks)[0]
+    kept_mz = mz[kept_indices]
+    kept_spectrum = peak_spectrum[kept_indices]
+    if np.all((kept_mz[1:] > kept_mz[:-1]) | (kept_spectrum[1:] != kept_spectrum[:-1])):
+        return kept_indices
+    return kept_indices[np.lexsort((-intensity[kept_indices], kept_mz, kept_spectrum))]
+
+###
+ # Mask of the peaks filter_peaks_noise_or_window keeps for many spectra, in one pass: the top_peaks of each
+ # window or above min_snr times the noise level. As in filter_peaks_noise_or_window a peak with the same
+ # mass as a kept peak of its spectrum is kept too. The peaks of each spectrum are contiguous as given by peak_offsets
+###
+def noise_or_window_peak_mask(mz, intensity, peak_offsets, min_snr, window_size, top_peaks):
+    peak_spectrum = np.repeat(np.arange(len(peak_offsets) - 1), np.diff(peak_offsets))
+    noise_levels = ming_numerical_utilities.calculate_noise_levels_in_peak_arrays(intensity, peak_offsets)
+    peak_mask = (window_filter_peak_ranks(mz, intensity, peak_spectrum, window_size) < top_peaks) | (intensity > noise_levels[peak_spectrum] * min_snr)
+
+    #Peaks are usually already sorted by mass within each spectrum
+    same_spectrum = peak_spectrum[1:] == peak_spectrum[:-1]
+    if np.all((mz[1:] >= mz[:-1]) | ~same_spectrum):
+        ordering = np.arange(len(mz))
+    else:
+        ordering = np.lexsort((mz, peak_spectrum))
+    sorted_mz = mz[ordering]
+    sorted_spectrum = peak_spectrum[ordering]
+    group_start = np.ones(len(ordering), dtype=bool)
+    group_start[1:] = (sorted_mz[1:] != sorted_mz[:-1]) | (sorted_spectrum[1:] != sorted_spectrum[:-1])
+    group_index = np.cumsum(group_start) - 1
+    group_kept = np.bincount(group_index, weights=peak_mask[ordering], minlength=int(group_start.sum())) > 0
+    peak_mask[ordering] = group_kept[group_index]
+    return peak_mask
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+import math
+import bisect
+from collections import namedtuple
+
+import spectrum_alignment
+import ming_parallel_library
+
+"""
+All vs all pairwise cosine to create the pairs table of a molecular network from a set of spectra
+
+The output is the CLUSTERID1/CLUSTERID2/DeltaMZ/MEH/Cosine/OtherScore table read by
+molecular_network_filtering_library.loading_network, MEH is the number of matched peaks
+and OtherScore the smaller fraction of intensity explained by the matched peaks in either spectrum
+
+"""
+
+PAIRS_HEADERS = ["CLUSTERID1", "CLUSTERID2", "DeltaMZ", "MEH", "Cosine", "OtherScore"]
+
+NetworkPairScore = namedtuple('NetworkPairScore', ['clusterid1', 'clusterid2', 'deltamz', 'matched_peaks', 'cosine', 'explained_intensity'])
+PeakBinIndex = namedtuple('PeakBinIndex', ['mass_bins', 'mass_bins_neighborhood', 'loss_bins', 'loss_bins_neighborhood'])
+
+###
+# Intensity-mass index of a spectrum used to bound the cosine before aligning. Peaks are binned by
+# m/z (zero shift matches) and by neutral loss from the precursor (precursor shift matches), each bin
+# holds [number of peaks, sum of squared normalized intensity]. Bins are twice the tolerance wide,
+# so two peaks that can match always fall in the same or adjacent bins
+###
+def build_peak_bin_index(spectrum, tolerance):
+    bin_size = 2 * (tolerance + 0.000001)
+    precursor_mass = spectrum.mz * spectrum.charge
+
+    mass_bins = {}
+    loss_bins = {}
+    for mz, intensity in get_normalized_peak_list(spectrum):
+        energy = intensity * intensity
+
+        mass_bin = int(math.floor(mz / bin_size))
+        if not mass_bin in mass_bins:
+            mass_bins[mass_bin] = [0, 0.0]
+        mass_bins[mass_bin][0] += 1
+        mass_bins[mass_bin][1] += energy
+
+        loss_bin = int(math.floor((precursor_mass - mz) / bin_size))
+        if not loss_bin in loss_bins:
+            loss_bins[loss_bin] = [0, 0.0]
+        loss_bins[loss_bin][0] += 1
+        loss_bins[loss_bin][1] += energy
+
+    return PeakBinIndex(mass_bins, _bin_neighborhood(mass_bins), loss_bins, _bin_neighborhood(loss_bins))
+
+def _bin_neighborhood(bins):
+    neighborhood = set()
+    for bin_index in bins:
+        neighborhood.add(bin_index - 1)
+        neighborhood.add(bin_index)
+        neighborhood.add(bin_index + 1)
+    return neighborhood
+
+#Normalized peaks of a spectrum as (mz, intensity) pairs, whether or not numpy is available
+def get_normalized_peak_list(spectrum):
+    normalized_peaks = spectrum.get_normalized_peaks()
+    if spectrum_alignment.np is not None:
+        return zip(normalized_peaks[0].tolist(), normalized_peaks[1].tolist())
+    return normalized_peaks
+
+###
+# Upper bounds on the number of matched peaks and on the cosine of score_alignment for a pair of spectra.
+# Only peaks in bins that have a possible partner can be matched, so the matched peaks are bounded by how
+# many peaks there are in those bins and, by Cauchy-Schwarz, the cosine by the square root of the product
+# of the intensity in those bins. Returns None when the pair cannot be bounded, i.e. when the shifts
+# for higher charges are considered
+###
+def calculate_pair_upper_bound(index1, index2, shift, tolerance, max_charge_consideration=1):
+    real_shift = abs(shift) > tolerance
+    if real_shift and max_charge_consideration > 1:
+        return None
+
+    mass_bins1 = index1.mass_bins.keys() & index2.mass_bins_neighborhood
+    mass_bins2 = index2.mass_bins.keys() & index1.mass_bins_neighborhood
+    peaks1, energy1 = _sum_bins(index1.mass_bins, mass_bins1)
+    peaks2, energy2 = _sum_bins(index2.mass_bins, mass_bins2)
+
+    if real_shift:
+        loss_bins1 = index1.loss_bins.keys() & index2.loss_bins_neighborhood
+        loss_bins2 = index2.loss_bins.keys() & index1.loss_bins_neighborhood
+        loss_peaks1, loss_energy1 = _sum_bins(index1.loss_bins, loss_bins1)
+        loss_peaks2, loss_energy2 = _sum_bins(index2.loss_bins, loss_bins2)
+        peaks1 += loss_peaks1
+        peaks2 += loss_peaks2
+        energy1 += loss_energy1
+        energy2 += loss_energy2
+
+    max_matched_peaks = min(peaks1, peaks2)
+    max_cosine = math.sqrt(min(energy1, 1.0) * min(energy2, 1.0))
+
+    return max_matched_peaks, max_cosine
+
+def _sum_bins(bins, bins_to_sum):
+    total_peaks = 0
+    total_energy = 0.0
+    for bin_index in bins_to_sum:
+        total_peaks += bins[bin_index][0]
+        total_energy += bins[bin_index][1]
+    return total_peaks, total_energy
+
+#Aligns two spectra the same way as Spectrum.cosine_spectrum, returning the score, matched peaks and explained intensity
+def score_spectrum_pair(spectrum1, spectrum2, tolerance):
+    normalized_peaks1 = spectrum1.get_normalized_peaks()
+    normalized_peaks2 = spectrum2.get_normalized_peaks()
+
+    if spectrum_alignment.np is not None:
+        intensity1 = normalized_peaks1[1]
+        intensity2 = normalized_peaks2[1]
+        total_score, reported_alignments = spectrum_alignment.score_alignment_normalized_arrays(normalized_peaks1[0], intensity1, normalized_peaks2[0], intensity2, spectrum1.mz * spectrum1.charge, spectrum2.mz * spectrum2.charge, tolerance, spectrum1.charge)
+    else:
+        intensity1 = [peak.intensity for peak in normalized_peaks1]
+        intensity2 = [peak.intensity for peak in normalized_peaks2]
+        total_score, reported_alignments = spectrum_alignment.score_alignment_normalized(normalized_peaks1, normalized_peaks2, spectrum1.mz * spectrum1.charge, spectrum2.mz * spectrum2.charge, tolerance, spectrum1.charge)
+
+    #Normalized intensities squared are the fraction of the total intensity
+    explained_intensity1 = 0.0
+    explained_intensity2 = 0.0
+    for alignment in reported_alignments:
+        explained_intensity1 += intensity1[alignment.peak1] ** 2
+        explained_intensity2 += intensity2[alignment.peak2] ** 2
+
+    return total_score, len(reported_alignments), min(explained_intensity1, explained_intensity2)
+
+###
+# Scores the first query_count spectra of a job against every later spectrum within max_shift.
+# The spectra are sorted by precursor mz and include all the spectra within max_shift of the queries
+###
+def compute_pairs_job(job_parameters):
+    spectra = job_parameters["spectra"]
+    query_count = job_parameters["query_count"]
+    tolerance = job_parameters["tolerance"]
+    min_score = job_parameters["min_score"]
+    min_matched_peaks = job_parameters["min_matched_peaks"]
+    max_shift = job_parameters["max_shift"]
+
+    precursor_mz_list = [spectrum.mz for spectrum in spectra]
+    bin_indices = [build_peak_bin_index(spectrum, tolerance) for spectrum in spectra]
+
+    pairs = []
+    pruned_pairs = 0
+    for i in range(query_count):
+        window_end = bisect.bisect_right(precursor_mz_list, precursor_mz_list[i] + max_shift)
+        for j in range(i + 1, window_end):
+            #The spectrum with the smaller cluster id is spec1, as in the output
+            if spectra[i].scan <= spectra[j].scan:
+                index1, index2 = i, j
+            else:
+                index1, index2 = j, i
+            spectrum1 = spectra[index1]
+            spectrum2 = spectra[index2]
+
+            upper_bound = calculate_pair_upper_bound(bin_indices[index1], bin_indices[index2], spectrum1.mz * spectrum1.charge - spectrum2.mz * spectrum2.charge, tolerance, spectrum1.charge)
+            if upper_bound != None:
+                max_matched_peaks, max_cosine = upper_bound
+                if max_matched_peaks < min_matched_peaks or max_cosine + 0.000001 < min_score:
+                    pruned_pairs += 1
+                    continue
+
+            cosine_score, matched_peaks, explained_intensity = score_spectrum_pair(spectrum1, spectrum2, tolerance)
+            if cosine_score > min_score and matched_peaks >= min_matched_peaks:
+                pairs.append(NetworkPairScore(spectrum1.scan, spectrum2.scan, spectrum1.mz - spectrum2.mz, matched_peaks, cosine_score, explained_intensity))
+
+    return pairs, pruned_pairs
+
+###
+# All vs all pairs for molecular networking, spectra are compared when their precursor mz are within
+# max_shift and pairs are kept when the cosine is above min_score with at least min_matched_peaks.
+# The spectra are split into chunks of chunk_size queries run through ming_parallel_library
+###
+def compute_all_pairs(spectrum_list, tolerance, min_score, min_matched_peaks, max_shift, parallelism_level=1, chunk_size=1000):
+    spectra = [spectrum for spectrum in spectrum_list if spectrum != None and len(spectrum.peaks) > 0]
+    spectra = sorted(spectra, key=lambda spectrum: spectrum.mz)
+    precursor_mz_list = [spectrum.mz for spectrum in spectra]
+
+    job_parameters_list = []
+    for chunk_start in range(0, len(spectra), chunk_size):
+        chunk_end = min(chunk_start + chunk_size, len(spectra))
+        window_end = bisect.bisect_right(precursor_mz_list, precursor_mz_list[chunk_end - 1] + max_shift)
+
+        job_parameters = {}
+        job_parameters["spectra"] = spectra[chunk_start:window_end]
+        job_parameters["query_count"] = chunk_end - chunk_start
+        job_parameters["tolerance"] = tolerance
+        job_parameters["min_score"] = min_score
+        job_parameters["min_matched_peaks"] = min_matched_peaks
+        job_parameters["max_shift"] = max_shift
+        job_parameters_list.append(job_parameters)
+
+    results = ming_parallel_library.run_parallel_job(compute_pairs_job, job_parameters_list, parallelism_level)
+
+    all_pairs = []
+    total_pruned_pairs = 0
+    for pairs, pruned_pairs in results:
+        all_pairs += pairs
+        total_pruned_pairs += pruned_pairs
+    print("Pairs Found\t%d\tPruned\t%d" % (len(all_pairs), total_pruned_pairs))
+
+    all_pairs = sorted(all_pairs, key=lambda pair: (pair.clusterid1, pair.clusterid2))
+
+    return all_pairs
+
+def write_pairs_file(pairs, output_filename):
+    with open(output_filename, "w") as output_file:
+        output_file.write("\t".join(PAIRS_HEADERS) + "\n")
+        for pair in pairs:
+            output_list = [str(pair.clusterid1), str(pair.clusterid2), str(pair.deltamz), str(pair.matched_peaks), str(pair.cosine), str(pair.explained_intensity)]
+            output_file.write("\t".join(output_list) + "\n")
+
+#Writes out the all vs all pairs table of the spectra in a SpectrumCollection
+def create_pairs_file(spectrum_collection, output_filename, tolerance=0.5, min_score=0.7, min_matched_peaks=6, max_shift=500.0, parallelism_level=1):
+    pairs = compute_all_pairs(spectrum_collection.spectrum_list, tolerance, min_score, min_matched_peaks, max_shift, parallelism_level=parallelism_level)
+    write_pairs_file(pairs, output_filename)
+    return pairs
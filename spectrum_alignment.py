@@ -3,9 +3,15 @@ import bisect
 from collections import namedtuple
 import ming_spectrum_library
 
+try:
+    import numpy as np
+except:
+    np = None
+
 Match = namedtuple('Match', ['peak1', 'peak2', 'score'])
 Peak = namedtuple('Peak',['mz','intensity'])
 Alignment = namedtuple('Alignment', ['peak1', 'peak2'])
+LibraryArrays = namedtuple('LibraryArrays', ['mz', 'intensity', 'offsets', 'precursor_masses', 'max_charges'])
 
 def convert_to_peaks(peak_tuples):
     #using the splat we can handle both size 2 lists and tuples
@@ -85,8 +91,22 @@ def score_alignment(spec1,spec2,pm1,pm2,tolerance,max_charge_consideration=1):
     if len(spec1) == 0 or len(spec2) == 0:
         return 0.0, []
 
+    #With numpy the spectra are scored as arrays, giving the same score and alignments
+    if np is not None:
+        mz1, intensity1 = convert_to_arrays(spec1)
+        mz2, intensity2 = convert_to_arrays(spec2)
+        return score_alignment_arrays(mz1, intensity1, mz2, intensity2, pm1, pm2, tolerance, max_charge_consideration)
+
     spec1_n = sqrt_normalize_spectrum(convert_to_peaks(spec1))
     spec2_n = sqrt_normalize_spectrum(convert_to_peaks(spec2))
+
+    return score_alignment_normalized(spec1_n,spec2_n,pm1,pm2,tolerance,max_charge_consideration)
+
+#Same as score_alignment, but the spectra are expected to be already converted to peaks and sqrt normalized
+def score_alignment_normalized(spec1_n,spec2_n,pm1,pm2,tolerance,max_charge_consideration=1):
+    if len(spec1_n) == 0 or len(spec2_n) == 0:
+        return 0.0, []
+
     shift = (pm1 - pm2)
 
     #zero_shift_alignments = find_match_peaks(spec1_n,spec2_n,0,tolerance)
@@ -126,6 +146,234 @@ def score_alignment(spec1,spec2,pm1,pm2,tolerance,max_charge_consideration=1):
 
     return total_score, reported_alignments
 
+###
+# Array backed version of score_alignment, the spectra are given as separate m/z and intensity
+# arrays (float32 or float64, m/z sorted ascending) instead of lists of peaks. Candidate pairs
+# and the greedy assignment are computed with numpy, no namedtuples are created until the
+# reported alignments are returned. Returns the same score and alignment list as score_alignment
+###
+def score_alignment_arrays(mz1, intensity1, mz2, intensity2, pm1, pm2, tolerance, max_charge_consideration=1):
+    if len(mz1) == 0 or len(mz2) == 0:
+        return 0.0, []
+
+    mz1, intensity1 = sqrt_normalize_arrays(mz1, intensity1)
+    mz2, intensity2 = sqrt_normalize_arrays(mz2, intensity2)
+
+    return score_alignment_normalized_arrays(mz1, intensity1, mz2, intensity2, pm1, pm2, tolerance, max_charge_consideration)
+
+#Splits a list of peaks into m/z and intensity arrays
+def convert_to_arrays(peak_tuples):
+    #Array backed peak lists already hold the columns
+    if hasattr(peak_tuples, "intensity"):
+        return np.array(peak_tuples.mz, dtype=np.float64), np.array(peak_tuples.intensity, dtype=np.float64)
+    peak_array = np.asarray(peak_tuples, dtype=np.float64).reshape(-1, 2)
+    return np.ascontiguousarray(peak_array[:,0]), np.ascontiguousarray(peak_array[:,1])
+
+def sqrt_normalize_arrays(mz, intensity):
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    #Summing in python to accumulate in the same order as sqrt_normalize_spectrum
+    normed_value = math.sqrt(sum(intensity.tolist()))
+    return mz, np.sqrt(intensity) / normed_value
+
+#Array version of find_match_peaks_efficient, returns the peak indices of spec1 and spec2 for every pair
+# Assumes that shift is equal to spec1 - spec2
+def find_match_peaks_arrays(mz1, mz2, shift, tolerance):
+    adj_tolerance =  tolerance + 0.000001
+
+    left_bound_index = np.searchsorted(mz2, mz1 - shift - adj_tolerance, side="left")
+    right_bound_index = np.searchsorted(mz2, mz1 - shift + adj_tolerance, side="right")
+    match_counts = right_bound_index - left_bound_index
+
+    #Expanding each [left, right) range into one entry per matched pair
+    peak1_index = np.repeat(np.arange(len(mz1)), match_counts)
+    range_starts = np.repeat(left_bound_index - (np.cumsum(match_counts) - match_counts), match_counts)
+    peak2_index = np.arange(len(peak1_index)) + range_starts
+
+    return peak1_index, peak2_index
+
+#Same as score_alignment_arrays, but the intensities are expected to be already sqrt normalized
+def score_alignment_normalized_arrays(mz1, intensity1, mz2, intensity2, pm1, pm2, tolerance, max_charge_consideration=1):
+    if len(mz1) == 0 or len(mz2) == 0:
+        return 0.0, []
+
+    shift = (pm1 - pm2)
+
+    zero_shift_peak1, zero_shift_peak2 = find_match_peaks_arrays(mz1, mz2, 0, tolerance)
+    real_shift_peak1 = np.zeros(0, dtype=zero_shift_peak1.dtype)
+    real_shift_peak2 = np.zeros(0, dtype=zero_shift_peak2.dtype)
+    if abs(shift) > tolerance:
+        real_shift_pairs = [find_match_peaks_arrays(mz1, mz2, shift, tolerance)]
+
+        if max_charge_consideration > 1:
+            for charge_considered in range(2, max_charge_consideration + 1):
+                real_shift_pairs.append(find_match_peaks_arrays(mz1, mz2, shift/charge_considered, tolerance))
+
+        #Making real shift alignments without repetition
+        pair_keys = np.unique(np.concatenate([peak1 * len(mz2) + peak2 for peak1, peak2 in real_shift_pairs]))
+        real_shift_peak1 = pair_keys // len(mz2)
+        real_shift_peak2 = pair_keys % len(mz2)
+
+    all_peak1 = np.concatenate([zero_shift_peak1, real_shift_peak1])
+    all_peak2 = np.concatenate([zero_shift_peak2, real_shift_peak2])
+    all_scores = intensity1[all_peak1] * intensity2[all_peak2]
+
+    #Ranking all possible matches by score, ties keep the zero shift matches first
+    match_order = np.argsort(-all_scores, kind="stable")
+    all_peak1 = all_peak1[match_order]
+    all_peak2 = all_peak2[match_order]
+    all_scores = all_scores[match_order]
+
+    accepted = greedy_assign_ranked_matches(all_peak1, all_peak2, len(mz1), len(mz2))
+
+    reported_alignments = [Alignment(peak1, peak2) for peak1, peak2 in zip(all_peak1[accepted].tolist(), all_peak2[accepted].tolist())]
+    #Summing in rank order so the total is the same as the sequential greedy sum
+    total_score = 0.0
+    for match_score in all_scores[accepted].tolist():
+        total_score += match_score
+
+    return total_score, reported_alignments
+
+###
+# Greedy assignment of matches already sorted by descending score, without walking them one by one.
+# In every round each match that is the best remaining one for both of its peaks is accepted, then all
+# matches touching an accepted peak are dropped. This accepts exactly the same matches as going down
+# the sorted list and taking every match whose peaks are still unused.
+###
+def greedy_assign_ranked_matches(peak1_index, peak2_index, spec1_size, spec2_size):
+    number_of_matches = len(peak1_index)
+    accepted = np.zeros(number_of_matches, dtype=bool)
+    spec1_peak_used = np.zeros(spec1_size, dtype=bool)
+    spec2_peak_used = np.zeros(spec2_size, dtype=bool)
+
+    remaining = np.arange(number_of_matches)
+    while len(remaining) > 0:
+        remaining_peak1 = peak1_index[remaining]
+        remaining_peak2 = peak2_index[remaining]
+
+        best_rank_peak1 = np.full(spec1_size, number_of_matches)
+        best_rank_peak2 = np.full(spec2_size, number_of_matches)
+        np.minimum.at(best_rank_peak1, remaining_peak1, remaining)
+        np.minimum.at(best_rank_peak2, remaining_peak2, remaining)
+
+        winners = remaining[(best_rank_peak1[remaining_peak1] == remaining) & (best_rank_peak2[remaining_peak2] == remaining)]
+        accepted[winners] = True
+        spec1_peak_used[peak1_index[winners]] = True
+        spec2_peak_used[peak2_index[winners]] = True
+
+        remaining = remaining[~(spec1_peak_used[remaining_peak1] | spec2_peak_used[remaining_peak2])]
+
+    return accepted
+
+###
+# Prepares a set of library spectra for one vs many scoring. The sqrt normalized m/z and intensity
+# arrays of every spectrum are concatenated, the peaks of spectrum i are at offsets[i]:offsets[i+1]
+###
+def prepare_library_arrays(normalized_peak_arrays, precursor_masses, max_charges):
+    mz_list = [np.zeros(0)]
+    intensity_list = [np.zeros(0)]
+    offsets = [0]
+    for mz, intensity in normalized_peak_arrays:
+        mz_list.append(mz)
+        intensity_list.append(intensity)
+        offsets.append(offsets[-1] + len(mz))
+
+    return LibraryArrays(
+            mz = np.concatenate(mz_list),
+            intensity = np.concatenate(intensity_list),
+            offsets = np.array(offsets, dtype=np.int64),
+            precursor_masses = np.array(precursor_masses, dtype=np.float64),
+            max_charges = np.array(max_charges, dtype=np.int64)
+    )
+
+###
+# Scores one sqrt normalized query against many prepared library spectra in a single call.
+# Each library spectrum is spec1 and the query is spec2 of score_alignment, with the library
+# precursor mass and max charge consideration. Returns arrays of the cosine and number of matched
+# peaks for each candidate. Candidates are scored in chunks to bound memory on large libraries
+###
+def score_alignment_one_vs_many(query_mz, query_intensity, query_pm, library, tolerance, candidate_indices=None, candidate_batch_size=1000):
+    if candidate_indices is None:
+        candidate_indices = np.arange(len(library.offsets) - 1)
+    candidate_indices = np.asarray(candidate_indices, dtype=np.int64)
+
+    scores = np.zeros(len(candidate_indices))
+    matched_peaks = np.zeros(len(candidate_indices), dtype=np.int64)
+    if len(query_mz) == 0:
+        return scores, matched_peaks
+
+    for batch_start in range(0, len(candidate_indices), candidate_batch_size):
+        batch_end = batch_start + candidate_batch_size
+        scores[batch_start:batch_end], matched_peaks[batch_start:batch_end] = _score_alignment_one_vs_many_batch(query_mz, query_intensity, query_pm, library, tolerance, candidate_indices[batch_start:batch_end])
+
+    return scores, matched_peaks
+
+def _score_alignment_one_vs_many_batch(query_mz, query_intensity, query_pm, library, tolerance, candidate_indices):
+    number_of_candidates = len(candidate_indices)
+    adj_tolerance =  tolerance + 0.000001
+
+    #Gathering the library peaks of every candidate, peak_candidate is the position of the candidate in this batch
+    peak_starts = library.offsets[candidate_indices]
+    peak_counts = library.offsets[candidate_indices + 1] - peak_starts
+    peak_candidate = np.repeat(np.arange(number_of_candidates), peak_counts)
+    peak_index = np.arange(len(peak_candidate)) + np.repeat(peak_starts - (np.cumsum(peak_counts) - peak_counts), peak_counts)
+    peak_mz = library.mz[peak_index]
+
+    #Every shift to consider for each candidate, zero shift first
+    shifts = library.precursor_masses[candidate_indices] - query_pm
+    shift_candidate = [np.arange(number_of_candidates)]
+    shift_values = [np.zeros(number_of_candidates)]
+    shifted_candidates = np.nonzero(np.abs(shifts) > tolerance)[0]
+    max_charges = library.max_charges[candidate_indices]
+    shift_candidate.append(shifted_candidates)
+    shift_values.append(shifts[shifted_candidates])
+    for charge_considered in range(2, int(max_charges.max(initial=1)) + 1):
+        charge_candidates = shifted_candidates[max_charges[shifted_candidates] >= charge_considered]
+        shift_candidate.append(charge_candidates)
+        shift_values.append(shifts[charge_candidates]/charge_considered)
+    shift_candidate = np.concatenate(shift_candidate)
+    shift_values = np.concatenate(shift_values)
+    is_real_shift = np.arange(len(shift_candidate)) >= number_of_candidates
+
+    #One entry per (shift, library peak) of that shift's candidate
+    candidate_peak_starts = np.cumsum(peak_counts) - peak_counts
+    entry_counts = peak_counts[shift_candidate]
+    entry_shift = np.repeat(np.arange(len(shift_candidate)), entry_counts)
+    entry_peak = np.arange(len(entry_shift)) + np.repeat(candidate_peak_starts[shift_candidate] - (np.cumsum(entry_counts) - entry_counts), entry_counts)
+    entry_mz = peak_mz[entry_peak] - shift_values[entry_shift]
+
+    #Same bounds as find_match_peaks_arrays with the library spectrum as spec1
+    left_bound_index = np.searchsorted(query_mz, entry_mz - adj_tolerance, side="left")
+    right_bound_index = np.searchsorted(query_mz, entry_mz + adj_tolerance, side="right")
+    match_counts = right_bound_index - left_bound_index
+    pair_entry = np.repeat(np.arange(len(entry_peak)), match_counts)
+    pair_query_peak = np.arange(len(pair_entry)) + np.repeat(left_bound_index - (np.cumsum(match_counts) - match_counts), match_counts)
+    pair_library_peak = entry_peak[pair_entry]
+    pair_is_real_shift = is_real_shift[entry_shift[pair_entry]]
+
+    #Real shift pairs without repetition across charges
+    real_shift_keys = np.unique(pair_library_peak[pair_is_real_shift] * len(query_mz) + pair_query_peak[pair_is_real_shift])
+    pair_library_peak = np.concatenate([pair_library_peak[~pair_is_real_shift], real_shift_keys // len(query_mz)])
+    pair_query_peak = np.concatenate([pair_query_peak[~pair_is_real_shift], real_shift_keys % len(query_mz)])
+    pair_kind = np.concatenate([np.zeros(len(pair_library_peak) - len(real_shift_keys), dtype=np.int64), np.ones(len(real_shift_keys), dtype=np.int64)])
+    pair_candidate = peak_candidate[pair_library_peak]
+    pair_scores = library.intensity[peak_index[pair_library_peak]] * query_intensity[pair_query_peak]
+
+    #Ranking within each candidate the same way as score_alignment_normalized_arrays
+    match_order = np.lexsort((pair_query_peak, pair_library_peak, pair_kind, -pair_scores, pair_candidate))
+    pair_library_peak = pair_library_peak[match_order]
+    pair_query_peak = pair_query_peak[match_order]
+    pair_candidate = pair_candidate[match_order]
+    pair_scores = pair_scores[match_order]
+
+    #Candidates never share peaks, so one greedy assignment covers the whole batch
+    accepted = greedy_assign_ranked_matches(pair_library_peak, pair_candidate * len(query_mz) + pair_query_peak, len(peak_index), number_of_candidates * len(query_mz))
+
+    scores = np.bincount(pair_candidate[accepted], weights=pair_scores[accepted], minlength=number_of_candidates)
+    matched_peaks = np.bincount(pair_candidate[accepted], minlength=number_of_candidates)
+
+    return scores, matched_peaks
+
 def score_alignment_matched_peaks(spec1,spec2,pm1,pm2,tolerance,max_charge_consideration=1, reported_alignments=None):
     if reported_alignments == None:
         total_score, reported_alignments = score_alignment_matched_peaks(spec1,spec2,pm1,pm2,tolerance,max_charge_consideration)
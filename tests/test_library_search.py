@@ -0,0 +1,104 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import ming_spectrum_library
+
+
+def _make_spectrum(scan):
+    peaks = [[100.0 + j * 17.0 + (scan % 3) * 0.1, float((j * 7 + scan) % 11 + 1)] for j in range(15)]
+    return ming_spectrum_library.Spectrum("library.mgf", scan, scan - 1, peaks, 400.0 + (scan % 7) * 0.5, 2, 2)
+
+def _make_collection(scans):
+    collection = ming_spectrum_library.SpectrumCollection("library.mgf")
+    collection.load_from_iterator([_make_spectrum(scan) for scan in scans])
+    return collection
+
+def _search_both(collection, query):
+    batch_matches = collection.search_spectrum_batch(query, 2.0, 0.5, 3, 0.1, top_k=100)
+    matches = collection.search_spectrum(query, 2.0, 0.5, 3, 0.1, top_k=100)
+    return batch_matches, matches
+
+def _assert_same_matches(batch_matches, matches):
+    assert len(batch_matches) == len(matches)
+    for batch_match, match in zip(batch_matches, matches):
+        assert (batch_match.filename, batch_match.scan, batch_match.matchedpeaks) == (match.filename, match.scan, match.matchedpeaks)
+        assert batch_match.cosine == pytest.approx(match.cosine, abs=1e-9)
+
+def test_batch_search_after_loading_more_spectra():
+    collection = _make_collection(range(1, 11))
+    query = _make_spectrum(100)
+    collection.search_spectrum_batch(query, 2.0, 0.5, 3, 0.1)
+
+    collection.load_from_iterator([_make_spectrum(scan) for scan in range(11, 31)])
+
+    batch_matches, matches = _search_both(collection, query)
+    assert any(match.scan > 10 for match in matches)
+    _assert_same_matches(batch_matches, matches)
+
+def test_batch_search_after_filtering_the_collection():
+    collection = _make_collection(range(1, 21))
+    query = _make_spectrum(100)
+    batch_matches_before = collection.search_spectrum_batch(query, 2.0, 0.5, 3, 0.1, top_k=100)
+
+    collection.window_filter_peaks(50, 1)
+
+    batch_matches, matches = _search_both(collection, query)
+    assert batch_matches != batch_matches_before
+    _assert_same_matches(batch_matches, matches)
+
+def test_batch_search_after_changing_spectra_in_place():
+    collection = _make_collection(range(1, 21))
+    query = _make_spectrum(100)
+    batch_matches_before = collection.search_spectrum_batch(query, 2.0, 0.5, 3, 0.1, top_k=100)
+
+    for spectrum in collection.spectrum_list[:10]:
+        spectrum.window_filter_peaks(50, 1)
+    collection.spectrum_list[10].peaks[0] = [100.0, 500.0]
+    collection.spectrum_list[11].charge = 3
+    collection.spectrum_list.sort(key=lambda spectrum: -spectrum.scan)
+    collection.invalidate_search_cache()
+
+    batch_matches, matches = _search_both(collection, query)
+    assert batch_matches != batch_matches_before
+    _assert_same_matches(batch_matches, matches)
+
+def test_batch_search_without_numpy(monkeypatch):
+    matches = _make_collection(range(1, 21)).search_spectrum(_make_spectrum(100), 2.0, 0.5, 3, 0.1, top_k=100)
+
+    monkeypatch.setattr(ming_spectrum_library, "np", None)
+    collection = _make_collection(range(1, 21))
+    query = _make_spectrum(100)
+    assert collection.search_spectrum_batch(query, 2.0, 0.5, 3, 0.1, top_k=100) == matches
+    with pytest.raises(ImportError):
+        collection.prepare_library_search()
+
+def _linear_precursor_candidates(collection, mz, pm_tolerance):
+    return [i for i, spectrum in enumerate(collection.spectrum_list) if abs(spectrum.mz - mz) < pm_tolerance]
+
+def test_precursor_candidates_follow_spectrum_changes():
+    collection = _make_collection(range(1, 21))
+    assert collection.get_precursor_candidates(401.0, 0.3) == _linear_precursor_candidates(collection, 401.0, 0.3)
+
+    collection.spectrum_list[0].mz = 401.1
+    collection.invalidate_search_cache()
+    assert collection.get_precursor_candidates(401.0, 0.3) == _linear_precursor_candidates(collection, 401.0, 0.3)
+
+    collection.spectrum_list.sort(key=lambda spectrum: spectrum.mz)
+    collection.invalidate_search_cache()
+    assert collection.get_precursor_candidates(401.0, 0.3) == _linear_precursor_candidates(collection, 401.0, 0.3)
+
+    collection.spectrum_list = [_make_spectrum(scan) for scan in range(101, 121)]
+    assert collection.get_precursor_candidates(401.0, 0.3) == _linear_precursor_candidates(collection, 401.0, 0.3)
+
+def test_precursor_index_is_built_on_first_lookup():
+    collection = ming_spectrum_library.SpectrumCollection("library.mgf")
+    for scan in range(1, 21):
+        collection.load_from_iterator([_make_spectrum(scan)])
+    assert collection.precursor_index_mz is None
+
+    candidates = collection.get_precursor_candidates(401.0, 0.3)
+    precursor_index_mz = collection.precursor_index_mz
+    assert candidates == _linear_precursor_candidates(collection, 401.0, 0.3)
+    collection.get_precursor_candidates(402.0, 0.3)
+    assert collection.precursor_index_mz is precursor_index_mz
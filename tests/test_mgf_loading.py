@@ -0,0 +1,139 @@
+import random
+import re
+
+import pytest
+
+import ming_spectrum_library
+
+
+#load_mgf_file as it was before the spectrum iterator, every peak line split with re.split
+def _reference_load_mgf_file(filename):
+    charge = 0
+    mz = 0
+    peaks = []
+    scan = 0
+    output_spectra = []
+
+    for line in open(filename, "r"):
+        mgf_file_line = line.rstrip()
+        if len(mgf_file_line) < 4:
+            continue
+        if mgf_file_line[0] == "#":
+            continue
+        if mgf_file_line == "BEGIN IONS":
+            charge = 0
+            mz = 0
+            peaks = []
+            scan = 0
+            continue
+        if mgf_file_line == "END IONS":
+            if len(peaks) > 0:
+                output_spectra.append(ming_spectrum_library.Spectrum(filename, scan, -1, peaks, mz, charge, 2))
+            else:
+                output_spectra.append(None)
+            continue
+        if mgf_file_line[:8] == "PEPMASS=":
+            mz = float(mgf_file_line[8:])
+            continue
+        if mgf_file_line[:7] == "CHARGE=":
+            try:
+                if mgf_file_line[7:].find("-") != -1:
+                    charge = - int(mgf_file_line[7:].replace("-", ""))
+                else:
+                    charge = int(mgf_file_line[7:].replace("+", ""))
+            except:
+                charge = 0
+            continue
+        if mgf_file_line[:6] == "SCANS=":
+            scan = int(mgf_file_line[6:])
+            continue
+        if mgf_file_line.find("=") == -1:
+            peak_split = re.split("[ |\t]+", mgf_file_line)
+            peaks.append([float(peak_split[0]), float(peak_split[1])])
+
+    return output_spectra
+
+def _spectrum_state(spectrum):
+    if spectrum == None:
+        return None
+    return (spectrum.filename, spectrum.scan, spectrum.mz, spectrum.charge, list(spectrum.peaks))
+
+def _write_mgf(filename, seed, number_of_spectra=50):
+    rng = random.Random(seed)
+    with open(filename, "w") as mgf_file:
+        mgf_file.write("#written for the loader tests\n")
+        for scan in range(1, number_of_spectra + 1):
+            mgf_file.write("BEGIN IONS\n")
+            mgf_file.write("PEPMASS=%f\n" % rng.uniform(100.0, 1500.0))
+            mgf_file.write("CHARGE=%s\n" % rng.choice(["1+", "2+", "3-", "0", "", "2"]))
+            mgf_file.write("SCANS=%d\n" % scan)
+            mgf_file.write("TITLE=spectrum %d\n" % scan)
+            for i in range(rng.choice([0, 1, 5, 40])):
+                separator = rng.choice([" ", "\t", "  "])
+                mgf_file.write("%s%s%s\n" % (repr(rng.uniform(50.0, 1500.0)), separator, rng.choice([repr(rng.uniform(0.0, 1e5)), "1e3", "25"])))
+            mgf_file.write("END IONS\n\n")
+
+@pytest.mark.parametrize("seed", range(3))
+def test_iter_mgf_file_matches_reference(tmp_path, seed):
+    filename = str(tmp_path / "spectra.mgf")
+    _write_mgf(filename, seed)
+    reference_spectra = [_spectrum_state(spectrum) for spectrum in _reference_load_mgf_file(filename)]
+
+    assert [_spectrum_state(spectrum) for spectrum in ming_spectrum_library.iter_mgf_file(filename)] == reference_spectra
+    assert [_spectrum_state(spectrum) for spectrum in ming_spectrum_library.load_mgf_file(filename)] == reference_spectra
+
+    collection = ming_spectrum_library.SpectrumCollection(filename)
+    collection.load_from_file()
+    assert [_spectrum_state(spectrum) for spectrum in collection.spectrum_list] == [spectrum for spectrum in reference_spectra if spectrum != None]
+
+def test_iter_mgf_file_closes_the_file(tmp_path, monkeypatch):
+    filename = str(tmp_path / "spectra.mgf")
+    _write_mgf(filename, 0)
+    opened_files = []
+    def tracking_open(*arguments, **keyword_arguments):
+        opened_file = open(*arguments, **keyword_arguments)
+        opened_files.append(opened_file)
+        return opened_file
+    monkeypatch.setattr(ming_spectrum_library, "open", tracking_open, raising=False)
+
+    list(ming_spectrum_library.iter_mgf_file(filename))
+    spectrum_iterator = ming_spectrum_library.iter_mgf_file(filename)
+    next(spectrum_iterator)
+    spectrum_iterator.close()
+
+    assert len(opened_files) == 2
+    assert all(opened_file.closed for opened_file in opened_files)
+
+def _reference_parse_mgf_peak_lines(peak_lines, separator_pattern="[ |\t]+"):
+    peaks = []
+    for peak_line in peak_lines:
+        peak_split = re.split(separator_pattern, peak_line)
+        peaks.append([float(peak_split[0]), float(peak_split[1])])
+    return peaks
+
+PEAK_LINE_FORMATS = ["%s %s", "%s\t%s", "%s   %s", "%s|%s", "%s %s extra", "%s\t%s\t3", "%s | %s"]
+
+@pytest.mark.parametrize("separator_pattern", ["[ |\t]+", " |\t"])
+@pytest.mark.parametrize("seed", range(5))
+def test_parse_mgf_peak_lines_matches_reference(separator_pattern, seed):
+    rng = random.Random(seed)
+    for i in range(200):
+        #Mostly plain two column lines, which take the bulk path, with some lines that need the per-line parse
+        line_formats = PEAK_LINE_FORMATS[:3] if rng.random() < 0.5 else PEAK_LINE_FORMATS
+        peak_lines = [rng.choice(line_formats) % (repr(rng.uniform(50.0, 1500.0)), rng.choice([repr(rng.uniform(0.0, 1e5)), "1e3", "25", "-0.0"])) for j in range(rng.randint(1, 20))]
+        try:
+            reference_peaks = _reference_parse_mgf_peak_lines(peak_lines, separator_pattern)
+        except (ValueError, IndexError) as reference_error:
+            with pytest.raises(type(reference_error)):
+                ming_spectrum_library.parse_mgf_peak_lines(peak_lines, separator_pattern)
+            continue
+        assert list(ming_spectrum_library.parse_mgf_peak_lines(peak_lines, separator_pattern)) == reference_peaks
+
+def test_parse_mgf_peak_lines_falls_back_per_line():
+    peak_lines = ["100.5 20.0 b2", "200.25\t30.0", "300.0|40.0"]
+    assert list(ming_spectrum_library.parse_mgf_peak_lines(peak_lines)) == [[100.5, 20.0], [200.25, 30.0], [300.0, 40.0]]
+    with pytest.raises(ValueError):
+        ming_spectrum_library.parse_mgf_peak_lines(["100.5 20.0", "200.25 abc"])
+    #As many tokens as two per line, but not two on each line
+    with pytest.raises(IndexError):
+        ming_spectrum_library.parse_mgf_peak_lines(["100.5 20.0 30.0", "200.25"])
@@ -0,0 +1,85 @@
+import base64
+import struct
+
+import pytest
+
+pytest.importorskip("pyteomics")
+pytest.importorskip("numpy")
+
+import ming_spectrum_library
+
+
+def _binary_array(values, array_accession, array_name):
+    encoded = base64.b64encode(struct.pack("<%dd" % len(values), *values)).decode("ascii")
+    return """<binaryDataArray encodedLength="%d">
+  <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float"/>
+  <cvParam cvRef="MS" accession="MS:1000576" name="no compression"/>
+  <cvParam cvRef="MS" accession="%s" name="%s"/>
+  <binary>%s</binary>
+</binaryDataArray>""" % (len(encoded), array_accession, array_name, encoded)
+
+def _spectrum_xml(index, scan, peaks):
+    mz_values = [peak[0] for peak in peaks]
+    intensity_values = [peak[1] for peak in peaks]
+    return """<spectrum index="%d" id="scan=%d" defaultArrayLength="%d">
+  <cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="2"/>
+  <cvParam cvRef="MS" accession="MS:1000285" name="total ion current" value="%f"/>
+  <precursorList count="1">
+    <precursor>
+      <selectedIonList count="1">
+        <selectedIon>
+          <cvParam cvRef="MS" accession="MS:1000744" name="selected ion m/z" value="500.25"/>
+          <cvParam cvRef="MS" accession="MS:1000041" name="charge state" value="2"/>
+        </selectedIon>
+      </selectedIonList>
+      <activation>
+        <cvParam cvRef="MS" accession="MS:1000422" name="beam-type collision-induced dissociation"/>
+        <cvParam cvRef="MS" accession="MS:1000045" name="collision energy" value="30"/>
+      </activation>
+    </precursor>
+  </precursorList>
+  <binaryDataArrayList count="2">
+%s
+%s
+  </binaryDataArrayList>
+</spectrum>""" % (index, scan, len(peaks), sum(intensity_values), _binary_array(mz_values, "MS:1000514", "m/z array"), _binary_array(intensity_values, "MS:1000515", "intensity array"))
+
+def _write_mzml(filename, spectra_peaks):
+    spectra_xml = [_spectrum_xml(i, i + 1, peaks) for i, peaks in enumerate(spectra_peaks)]
+    with open(filename, "w") as output_file:
+        output_file.write("""<?xml version="1.0" encoding="utf-8"?>
+<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">
+  <cvList count="1">
+    <cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>
+  </cvList>
+  <run id="run">
+    <spectrumList count="%d">
+%s
+    </spectrumList>
+  </run>
+</mzML>
+""" % (len(spectra_xml), "\n".join(spectra_xml)))
+
+@pytest.fixture
+def mzml_with_empty_scans(tmp_path):
+    spectra_peaks = []
+    for i in range(40):
+        if i % 10 == 3:
+            spectra_peaks.append([])
+        else:
+            spectra_peaks.append([[100.0 + j * 7.5 + i, 10.0 * (j + 1)] for j in range(5)])
+    filename = str(tmp_path / "empty_scans.mzML")
+    _write_mzml(filename, spectra_peaks)
+    return filename, spectra_peaks
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_load_mzml_file_keeps_empty_scans(mzml_with_empty_scans, workers):
+    filename, spectra_peaks = mzml_with_empty_scans
+    spectra = ming_spectrum_library.load_mzml_file(filename, workers=workers)
+
+    assert len(spectra) == len(spectra_peaks)
+    for spectrum, peaks in zip(spectra, spectra_peaks):
+        assert list(spectrum.peaks) == peaks
+        assert spectrum.mz == 500.25
+        assert spectrum.charge == 2
+    assert [spectrum.scan for spectrum in spectra] == list(range(1, 41))
@@ -0,0 +1,237 @@
+import base64
+import random
+import struct
+import zlib
+
+import pytest
+
+import ming_spectrum_library
+
+
+MZXML_NAMESPACE = "http://sashimi.sourceforge.net/schema_revision/mzXML_3.2"
+
+#Scans of a small run, MS1 scans with MS2 scans nested in them or following them, some without peaks
+def _random_scans(seed, nested):
+    rng = random.Random(seed)
+    scans = []
+    scan_number = 1
+    for i in range(12):
+        ms1_scan = {"num": scan_number, "ms_level": 1, "peaks": _random_peaks(rng), "retention_time": 10.0 * i, "children": []}
+        scan_number += 1
+        scans.append(ms1_scan)
+        for j in range(rng.randint(0, 3)):
+            ms2_scan = {"num": scan_number, "ms_level": 2, "peaks": _random_peaks(rng) if rng.random() < 0.85 else [], "retention_time": 10.0 * i + j + 1, "precursor_mz": round(rng.uniform(300.0, 1200.0), 4), "charge": rng.randint(1, 3), "collision_energy": 35.0, "children": []}
+            scan_number += 1
+            if nested:
+                ms1_scan["children"].append(ms2_scan)
+            else:
+                scans.append(ms2_scan)
+    return scans
+
+def _random_peaks(rng):
+    return [[rng.uniform(100.0, 1500.0), rng.uniform(1.0, 1e6)] for i in range(rng.randint(1, 30))]
+
+def _encode_peaks(peaks, precision, compression):
+    values = [value for peak in peaks for value in peak]
+    encoded = struct.pack(">%d%s" % (len(values), "f" if precision == 32 else "d"), *values)
+    if compression == "zlib":
+        encoded = zlib.compress(encoded)
+    return base64.b64encode(encoded).decode("ascii")
+
+def _scan_xml(scan, precision, compression):
+    attributes = 'num="%d" msLevel="%d" peaksCount="%d" retentionTime="PT%.2fS" totIonCurrent="%f"' % (scan["num"], scan["ms_level"], len(scan["peaks"]), scan["retention_time"], sum(peak[1] for peak in scan["peaks"]))
+    lines = []
+    if scan["ms_level"] == 2:
+        lines.append('<scan %s collisionEnergy="%f">' % (attributes, scan["collision_energy"]))
+        lines.append('<precursorMz precursorScanNum="1" precursorIntensity="1000.0" precursorCharge="%d" activationMethod="CID">%s</precursorMz>' % (scan["charge"], repr(scan["precursor_mz"])))
+    else:
+        lines.append('<scan %s>' % attributes)
+    compressed = 'compressionType="zlib"' if compression == "zlib" else 'compressionType="none"'
+    lines.append('<peaks precision="%d" byteOrder="network" contentType="m/z-int" %s>%s</peaks>' % (precision, compressed, _encode_peaks(scan["peaks"], precision, compression)))
+    for child_scan in scan["children"]:
+        lines.append(_scan_xml(child_scan, precision, compression))
+    lines.append("</scan>")
+    return "\n".join(lines)
+
+def _write_mzxml(filename, scans, precision=32, compression="none", indexed=True):
+    document = '<?xml version="1.0" encoding="ISO-8859-1"?>\n<mzXML xmlns="%s">\n<msRun scanCount="%d">\n' % (MZXML_NAMESPACE, len(scans))
+    document += "\n".join(_scan_xml(scan, precision, compression) for scan in scans)
+    document += "\n</msRun>\n"
+    document = document.encode("ascii")
+
+    if indexed:
+        index_offset = len(document)
+        index = b'<index name="scan">\n'
+        scan_start = document.find(b"<scan ")
+        while scan_start != -1:
+            scan_number = int(document[scan_start:].split(b'"')[1])
+            index += b'<offset id="%d">%d</offset>\n' % (scan_number, scan_start)
+            scan_start = document.find(b"<scan ", scan_start + 1)
+        document += index + b"</index>\n<indexOffset>%d</indexOffset>\n" % index_offset
+    document += b"</mzXML>\n"
+
+    with open(filename, "wb") as output_file:
+        output_file.write(document)
+
+#Spectra load_mzxml_file gives for the scans, all MS1 first then MS2 in file order, indexed by rank in the file
+def _expected_spectra(scans, precision, drop_ms1):
+    ms1_spectra = []
+    ms2_spectra = []
+    file_order_scans = []
+    for scan in scans:
+        file_order_scans.append(scan)
+        file_order_scans += scan["children"]
+
+    for index, scan in enumerate(file_order_scans):
+        peaks = scan["peaks"]
+        if precision == 32:
+            peaks = [[struct.unpack(">f", struct.pack(">f", value))[0] for value in peak] for peak in peaks]
+        if scan["ms_level"] == 1:
+            if not drop_ms1:
+                ms1_spectra.append((scan["num"], index + 1, 1, 0, 0, peaks))
+        else:
+            ms2_spectra.append((scan["num"], index + 1, 2, scan["precursor_mz"], scan["charge"], peaks))
+    return ms1_spectra + ms2_spectra
+
+def _spectrum_state(spectrum):
+    return (spectrum.scan, spectrum.index, spectrum.ms_level, spectrum.mz, spectrum.charge, list(spectrum.peaks))
+
+MZXML_FORMATS = [(32, "none", True), (64, "none", True), (32, "zlib", False), (64, "zlib", False)]
+
+@pytest.fixture(params=[(nested,) + mzxml_format for nested in [True, False] for mzxml_format in MZXML_FORMATS], ids=lambda param: "%s-%d-%s-%s" % ("nested" if param[0] else "flat", param[1], param[2], "indexed" if param[3] else "unindexed"))
+def mzxml_file(request, tmp_path):
+    nested, precision, compression, indexed = request.param
+    scans = _random_scans(precision + len(compression), nested)
+    filename = str(tmp_path / "run.mzXML")
+    _write_mzxml(filename, scans, precision=precision, compression=compression, indexed=indexed)
+    return filename, scans, precision
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("drop_ms1", [False, True])
+@pytest.mark.parametrize("use_numpy", [True, False], ids=["numpy", "no_numpy"])
+def test_load_mzxml_file_matches_fixture(mzxml_file, workers, drop_ms1, use_numpy):
+    filename, scans, precision = mzxml_file
+    if use_numpy:
+        pytest.importorskip("numpy")
+
+    spectra = ming_spectrum_library.load_mzxml_file(filename, drop_ms1=drop_ms1, use_numpy=use_numpy, workers=workers)
+
+    assert [_spectrum_state(spectrum) for spectrum in spectra] == _expected_spectra(scans, precision, drop_ms1)
+    assert all(spectrum.filename == "run.mzXML" for spectrum in spectra)
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 500])
+def test_iter_mzxml_scans_keeps_file_order_across_chunks(mzxml_file, chunk_size):
+    filename, scans, precision = mzxml_file
+    serial_scans = [(ms_level, _spectrum_state(spectrum), nested) for ms_level, spectrum, nested in ming_spectrum_library.iter_mzxml_scans(filename)]
+    parallel_scans = [(ms_level, _spectrum_state(spectrum), nested) for ms_level, spectrum, nested in ming_spectrum_library.iter_mzxml_scans(filename, workers=2, chunk_size=chunk_size)]
+
+    assert parallel_scans == serial_scans
+    assert [spectrum_state[1] for ms_level, spectrum_state, nested in serial_scans] == list(range(1, len(serial_scans) + 1))
+    assert [nested for ms_level, spectrum_state, nested in serial_scans] == [scan is not top_scan for top_scan in scans for scan in [top_scan] + top_scan["children"]]
+
+def test_iter_mzxml_file_matches_load_mzxml_file(mzxml_file):
+    filename, scans, precision = mzxml_file
+    spectra = ming_spectrum_library.load_mzxml_file(filename)
+    iterated_spectra = list(ming_spectrum_library.iter_mzxml_file(filename))
+
+    assert sorted(_spectrum_state(spectrum) for spectrum in iterated_spectra) == sorted(_spectrum_state(spectrum) for spectrum in spectra)
+    assert [spectrum.index for spectrum in iterated_spectra] == sorted(spectrum.index for spectrum in spectra)
+
+#The scan dicts are read by read_mzxml_scan as the xmltodict dicts were before the streaming reader
+def test_scan_dicts_match_xmltodict(mzxml_file):
+    xmltodict = pytest.importorskip("xmltodict")
+    filename, scans, precision = mzxml_file
+    with open(filename) as mzxml_file_handle:
+        reference_scans = []
+        for scan in xmltodict.parse(mzxml_file_handle.read())["mzXML"]["msRun"]["scan"]:
+            nested_scans = scan.pop("scan", [])
+            if not isinstance(nested_scans, list):
+                nested_scans = [nested_scans]
+            reference_scans.append(scan)
+            reference_scans += nested_scans
+
+    scan_dicts = [scan for index, scan, nested in ming_spectrum_library.iter_mzxml_scan_dicts(filename)]
+
+    assert len(scan_dicts) == len(reference_scans)
+    for scan_dict, reference_scan in zip(scan_dicts, reference_scans):
+        assert scan_dict == dict(reference_scan)
+
+@pytest.mark.parametrize("drop_ms1", [False, True])
+def test_indexed_mzxml_lookups_match_load_mzxml_file(mzxml_file, drop_ms1):
+    filename, scans, precision = mzxml_file
+    spectra = ming_spectrum_library.load_mzxml_file(filename, drop_ms1=drop_ms1)
+    indexed_file = ming_spectrum_library.IndexedMzXMLFile(filename, drop_ms1=drop_ms1)
+
+    for spectrum in reversed(spectra):
+        assert _spectrum_state(indexed_file[spectrum.scan]) == _spectrum_state(spectrum)
+        assert indexed_file["run.mzXML:" + str(spectrum.scan)] is indexed_file[spectrum.scan]
+    assert [_spectrum_state(spectrum) for spectrum in indexed_file.get_spectra()] == [_spectrum_state(spectrum) for spectrum in spectra]
+
+    all_scan_numbers = [scan["num"] for top_scan in scans for scan in [top_scan] + top_scan["children"]]
+    assert [key for key in indexed_file.keys() if isinstance(key, int)] == all_scan_numbers
+    assert ("run.mzXML:" + str(scans[0]["num"]) in indexed_file) == (not drop_ms1)
+    assert not 10000 in indexed_file
+    assert indexed_file.get("other.mzXML:1") == None
+    with pytest.raises(KeyError):
+        indexed_file[10000]
+
+def test_indexed_collection_decodes_spectrum_list(mzxml_file):
+    filename, scans, precision = mzxml_file
+    collection = ming_spectrum_library.SpectrumCollection(filename)
+    collection.load_from_mzXML()
+    indexed_collection = ming_spectrum_library.SpectrumCollection(filename)
+    indexed_collection.load_from_mzXML_indexed()
+
+    assert [_spectrum_state(spectrum) for spectrum in indexed_collection.spectrum_list] == [_spectrum_state(spectrum) for spectrum in collection.spectrum_list]
+    for spectrum in indexed_collection.spectrum_list:
+        assert indexed_collection.scandict[spectrum.scan] is spectrum
+
+def test_scan_offsets_without_a_valid_index(tmp_path):
+    scans = _random_scans(0, True)
+    indexed_filename = str(tmp_path / "indexed.mzXML")
+    _write_mzxml(indexed_filename, scans, indexed=True)
+    unindexed_filename = str(tmp_path / "run.mzXML")
+    _write_mzxml(unindexed_filename, scans, indexed=False)
+    broken_filename = str(tmp_path / "broken.mzXML")
+    with open(indexed_filename, "rb") as indexed_file:
+        document = indexed_file.read()
+    with open(broken_filename, "wb") as broken_file:
+        broken_file.write(document.replace(b"<indexOffset>", b"<indexOffset>1"))
+
+    scan_offsets = ming_spectrum_library.read_mzxml_index_offsets(indexed_filename)
+    assert ming_spectrum_library.build_mzxml_scan_offsets(indexed_filename) == scan_offsets
+    assert ming_spectrum_library.read_mzxml_index_offsets(unindexed_filename) == None
+    assert ming_spectrum_library.read_mzxml_index_offsets(broken_filename) == None
+    assert ming_spectrum_library.load_mzxml_scan_offsets(broken_filename) == scan_offsets
+    assert [scan for scan, offset in ming_spectrum_library.load_mzxml_scan_offsets(unindexed_filename)] == [scan for scan, offset in scan_offsets]
+
+def test_scan_index_file_is_only_written_when_asked(tmp_path, monkeypatch):
+    filename = str(tmp_path / "run.mzXML")
+    _write_mzxml(filename, _random_scans(0, True), indexed=False)
+    index_filename = filename + ".scanindex"
+
+    scan_offsets = ming_spectrum_library.load_mzxml_scan_offsets(filename)
+    ming_spectrum_library.IndexedMzXMLFile(filename)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["run.mzXML"]
+
+    assert ming_spectrum_library.load_mzxml_scan_offsets(filename, index_filename=index_filename) == scan_offsets
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["run.mzXML", "run.mzXML.scanindex"]
+
+    #A saved index matching the file is read instead of reading through the file
+    build_mzxml_scan_offsets = ming_spectrum_library.build_mzxml_scan_offsets
+    def fail_build(filename):
+        raise AssertionError("scan offsets rebuilt")
+    monkeypatch.setattr(ming_spectrum_library, "build_mzxml_scan_offsets", fail_build)
+    assert ming_spectrum_library.load_mzxml_scan_offsets(filename, index_filename=index_filename) == scan_offsets
+
+    #Changing the file makes the saved index stale
+    _write_mzxml(filename, _random_scans(1, True), indexed=False)
+    monkeypatch.setattr(ming_spectrum_library, "build_mzxml_scan_offsets", build_mzxml_scan_offsets)
+    new_scan_offsets = ming_spectrum_library.build_mzxml_scan_offsets(filename)
+    assert new_scan_offsets != scan_offsets
+    indexed_collection = ming_spectrum_library.SpectrumCollection(filename)
+    indexed_collection.load_from_mzXML_indexed(index_filename=index_filename)
+    assert indexed_collection.scandict.scan_offsets == new_scan_offsets
+
+    with pytest.raises((IOError, OSError)):
+        ming_spectrum_library.load_mzxml_scan_offsets(filename, index_filename=str(tmp_path / "missing" / "run.scanindex"))
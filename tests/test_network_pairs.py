@@ -0,0 +1,95 @@
+import random
+
+import pytest
+
+import ming_spectrum_library
+import molecular_network_pairs_library
+import spectrum_alignment
+
+
+#Spectra built from a few shared fragment sets, so many pairs score above the thresholds and many do not
+def _random_spectra(seed, number_of_spectra):
+    rng = random.Random(seed)
+    families = [[rng.uniform(100.0, 800.0) for i in range(25)] for family in range(4)]
+    spectra = []
+    for scan in range(1, number_of_spectra + 1):
+        family = rng.choice(families)
+        precursor_mz = rng.uniform(820.0, 900.0)
+        charge = 2 if rng.random() < 0.2 else 1
+        peaks = [[mz + rng.uniform(-0.1, 0.1), rng.uniform(1.0, 1000.0)] for mz in rng.sample(family, rng.randint(3, 20))]
+        peaks += [[rng.uniform(100.0, 800.0), rng.uniform(1.0, 100.0)] for i in range(rng.randint(0, 5))]
+        spectra.append(ming_spectrum_library.Spectrum("network.mgf", scan, scan - 1, sorted(peaks), precursor_mz, charge, 2))
+    return spectra
+
+#Every pair within max_shift scored without any bound
+def _brute_force_pairs(spectra, tolerance, min_score, min_matched_peaks, max_shift):
+    pairs = []
+    for spectrum1 in spectra:
+        for spectrum2 in spectra:
+            if spectrum1.scan >= spectrum2.scan or abs(spectrum1.mz - spectrum2.mz) > max_shift:
+                continue
+            cosine_score, matched_peaks, explained_intensity = molecular_network_pairs_library.score_spectrum_pair(spectrum1, spectrum2, tolerance)
+            if cosine_score > min_score and matched_peaks >= min_matched_peaks:
+                pairs.append(molecular_network_pairs_library.NetworkPairScore(spectrum1.scan, spectrum2.scan, spectrum1.mz - spectrum2.mz, matched_peaks, cosine_score, explained_intensity))
+    return pairs
+
+@pytest.fixture(params=[True, False], ids=["numpy", "no_numpy"])
+def use_numpy(request, monkeypatch):
+    if request.param:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(ming_spectrum_library, "np", None)
+        monkeypatch.setattr(spectrum_alignment, "np", None)
+    return request.param
+
+def test_upper_bound_is_above_the_alignment(use_numpy):
+    spectra = _random_spectra(0, 40)
+    bounded_pairs = 0
+    for spectrum1 in spectra:
+        for spectrum2 in spectra:
+            shift = spectrum1.mz * spectrum1.charge - spectrum2.mz * spectrum2.charge
+            upper_bound = molecular_network_pairs_library.calculate_pair_upper_bound(molecular_network_pairs_library.build_peak_bin_index(spectrum1, 0.5), molecular_network_pairs_library.build_peak_bin_index(spectrum2, 0.5), shift, 0.5, spectrum1.charge)
+            if abs(shift) > 0.5 and spectrum1.charge > 1:
+                assert upper_bound == None
+                continue
+
+            cosine_score, matched_peaks, explained_intensity = molecular_network_pairs_library.score_spectrum_pair(spectrum1, spectrum2, 0.5)
+            max_matched_peaks, max_cosine = upper_bound
+            assert matched_peaks <= max_matched_peaks
+            assert cosine_score <= max_cosine + 1e-9
+            bounded_pairs += 1
+    assert bounded_pairs > 0
+
+@pytest.mark.parametrize("min_score, min_matched_peaks", [(0.7, 6), (0.3, 2), (0.0, 0)])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_compute_all_pairs_matches_brute_force(use_numpy, min_score, min_matched_peaks, chunk_size):
+    spectra = _random_spectra(1, 60)
+    expected_pairs = _brute_force_pairs(spectra, 0.5, min_score, min_matched_peaks, 40.0)
+
+    pairs = molecular_network_pairs_library.compute_all_pairs(spectra, 0.5, min_score, min_matched_peaks, 40.0, chunk_size=chunk_size)
+
+    assert [(pair.clusterid1, pair.clusterid2, pair.matched_peaks) for pair in pairs] == [(pair.clusterid1, pair.clusterid2, pair.matched_peaks) for pair in expected_pairs]
+    for pair, expected_pair in zip(pairs, expected_pairs):
+        assert pair.cosine == pytest.approx(expected_pair.cosine, abs=1e-12)
+        assert pair.explained_intensity == pytest.approx(expected_pair.explained_intensity, abs=1e-12)
+
+def test_compute_pairs_job_prunes_pairs():
+    spectra = sorted(_random_spectra(2, 60), key=lambda spectrum: spectrum.mz)
+    job_parameters = {"spectra": spectra, "query_count": len(spectra), "tolerance": 0.5, "min_score": 0.7, "min_matched_peaks": 6, "max_shift": 40.0}
+
+    pairs, pruned_pairs = molecular_network_pairs_library.compute_pairs_job(job_parameters)
+
+    assert pruned_pairs > 0
+    assert sorted(pairs) == sorted(_brute_force_pairs(spectra, 0.5, 0.7, 6, 40.0))
+
+def test_write_pairs_file(tmp_path):
+    spectra = _random_spectra(3, 30)
+    pairs = molecular_network_pairs_library.compute_all_pairs(spectra, 0.5, 0.3, 2, 40.0)
+    output_filename = str(tmp_path / "pairs.tsv")
+
+    molecular_network_pairs_library.write_pairs_file(pairs, output_filename)
+
+    with open(output_filename) as output_file:
+        lines = output_file.read().splitlines()
+    assert lines[0].split("\t") == molecular_network_pairs_library.PAIRS_HEADERS
+    assert [line.split("\t")[:2] for line in lines[1:]] == [[str(pair.clusterid1), str(pair.clusterid2)] for pair in pairs]
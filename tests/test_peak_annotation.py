@@ -0,0 +1,153 @@
+import random
+from collections import defaultdict
+
+import pytest
+
+import ming_numerical_utilities
+import ming_psm_library
+import ming_spectrum_library
+
+
+ION_TYPES = ["b", "b-iso", "y", "y-iso", "b-H2O", "b-NH3", "y-H2O", "y-NH3", "a"]
+PEPTIDES = ["PEPTIDE", "PEPS+79.966TIDEK", "+42.011AC+57.021DEFGHIK", "GGGGGGGGGGGGR"]
+
+#Annotation as it was before the sorted ion masses, every peak compared against every ion in the order of the mapping
+def _reference_match_peaks_to_ions(ion_peak_mapping, peak_masses, tolerance):
+    return [[ion_peak for ion_peak in ion_peak_mapping if abs(mass - ion_peak_mapping[ion_peak]) < tolerance] for mass in peak_masses]
+
+def _reference_map_ions_to_peak(peaks, theoretical_peaks, tolerance):
+    ions_to_peaks = defaultdict(list)
+    for peak in peaks:
+        for ion_peak in theoretical_peaks:
+            if abs(peak[0] - theoretical_peaks[ion_peak]) < tolerance:
+                ions_to_peaks[ion_peak].append(peak)
+                break
+
+    ions_to_peak = {}
+    for ion in ions_to_peaks:
+        max_peak = ions_to_peaks[ion][0]
+        for peak in ions_to_peaks[ion]:
+            if peak[1] > max_peak[1]:
+                max_peak = peak
+        ions_to_peak[ion] = max_peak
+    return ions_to_peak
+
+#Ion masses with duplicates and close neighbours, and peak masses on and right around the tolerance edges
+def _random_ion_peak_mapping(rng):
+    ion_masses = [round(rng.uniform(100.0, 1500.0), 2) for i in range(60)]
+    ion_masses += rng.sample(ion_masses, 10)
+    ion_masses += [ion_mass + rng.uniform(-0.3, 0.3) for ion_mass in rng.sample(ion_masses, 10)]
+    rng.shuffle(ion_masses)
+    return dict(("ion%d:%d:1" % (i, i + 1), ion_mass) for i, ion_mass in enumerate(ion_masses))
+
+def _random_peak_masses(rng, ion_peak_mapping, tolerance):
+    ion_masses = list(ion_peak_mapping.values())
+    peak_masses = [rng.uniform(90.0, 1510.0) for i in range(100)]
+    peak_masses += [ion_mass + rng.uniform(-1.5, 1.5) * tolerance for ion_mass in rng.sample(ion_masses, 40)]
+    peak_masses += [ion_mass + tolerance for ion_mass in rng.sample(ion_masses, 10)]
+    peak_masses += [ion_mass - tolerance for ion_mass in rng.sample(ion_masses, 10)]
+    peak_masses += rng.sample(ion_masses, 10)
+    return peak_masses
+
+@pytest.mark.parametrize("tolerance", [0.01, 0.1, 0.5, 2.0])
+@pytest.mark.parametrize("seed", range(3))
+def test_match_peaks_to_ions_matches_linear_scan(seed, tolerance):
+    rng = random.Random(seed)
+    ion_peak_mapping = _random_ion_peak_mapping(rng)
+    peak_masses = _random_peak_masses(rng, ion_peak_mapping, tolerance)
+
+    assert ming_psm_library.match_peaks_to_ions(ion_peak_mapping, peak_masses, tolerance) == _reference_match_peaks_to_ions(ion_peak_mapping, peak_masses, tolerance)
+
+def test_match_peaks_to_ions_without_ions_or_peaks():
+    assert ming_psm_library.match_peaks_to_ions({}, [100.0, 200.0], 0.5) == [[], []]
+    assert ming_psm_library.match_peaks_to_ions({"b:1:1": 100.0}, [], 0.5) == []
+
+@pytest.mark.parametrize("peptide", PEPTIDES)
+@pytest.mark.parametrize("max_charge", [1, 3])
+def test_peptide_annotation_matches_linear_scan(peptide, max_charge):
+    pytest.importorskip("pyteomics")
+    rng = random.Random(peptide)
+    theoretical_peaks = ming_psm_library.create_theoretical_peak_map(peptide, ION_TYPES, charge_set=range(1, max_charge + 1))
+    peaks = [[peak_mass, rng.uniform(1.0, 100.0)] for peak_mass in sorted(_random_peak_masses(rng, theoretical_peaks, 0.5))]
+
+    reference_ions = _reference_match_peaks_to_ions(theoretical_peaks, [peak[0] for peak in peaks], 0.5)
+    reference_annotated_peaks = [peak for peak, ions in zip(peaks, reference_ions) if len(ions) > 0]
+    reference_unannotated_peaks = [peak for peak, ions in zip(peaks, reference_ions) if len(ions) == 0]
+    assert ming_psm_library.extract_annotated_peaks(theoretical_peaks, peaks, 0.5) == (reference_annotated_peaks, reference_unannotated_peaks)
+    assert sorted(ming_spectrum_library.calculate_unique_ions_annotated(peaks, max_charge, peptide, 0.5)) == sorted(set(ion for ions in reference_ions for ion in ions))
+
+    by_theoretical_peaks = ming_psm_library.create_theoretical_peak_map(peptide, ["b", "y"], charge_set=range(1, max_charge + 1))
+    assert ming_spectrum_library.map_ions_to_peak(peaks, max_charge, 0.5, peptide, ["b", "y"]) == _reference_map_ions_to_peak(peaks, by_theoretical_peaks, 0.5)
+
+#The annotation metrics one at a time, each from its own annotation of the peaks
+def _individual_annotation_metrics(peaks, max_charge, peptide, tolerance, SNR, signal_SNR):
+    spectrum = ming_spectrum_library.Spectrum("test.mgf", 1, 0, peaks, 500.0, max_charge, 2)
+    return ming_spectrum_library.PSMAnnotationMetrics(
+        ming_psm_library.calculated_number_annotated_peaks(peaks, max_charge, peptide, tolerance),
+        ming_psm_library.calculated_explained_intensity(peaks, max_charge, peptide, tolerance),
+        spectrum.get_number_of_signal_peaks(signal_SNR),
+        spectrum.get_number_of_peaks_within_percent_of_max(1.0),
+        spectrum.get_number_of_peaks_within_percent_of_max(5.0),
+        ming_spectrum_library.calculated_number_unique_ions_annotated_in_signal(peaks, max_charge, peptide, tolerance, SNR),
+        ming_spectrum_library.determine_b_y_breaks_total(peaks, max_charge, tolerance, peptide, SNR)
+    )
+
+def _random_psm_peaks(rng, peptide, max_charge):
+    theoretical_peaks = ming_psm_library.create_theoretical_peak_map(peptide, ION_TYPES, charge_set=range(1, max_charge + 1))
+    ion_masses = list(theoretical_peaks.values())
+    peak_masses = [ion_mass + rng.uniform(-0.6, 0.6) for ion_mass in rng.sample(ion_masses, min(len(ion_masses), rng.randint(0, 40)))]
+    peak_masses += [rng.uniform(100.0, 1500.0) for i in range(rng.randint(0, 60))]
+    #Integer intensities so ties around the noise and percent of max thresholds are common
+    return [[peak_mass, float(rng.randint(1, 50))] for peak_mass in sorted(set(peak_masses))]
+
+@pytest.fixture(params=[True, False], ids=["numpy", "no_numpy"])
+def use_numpy(request, monkeypatch):
+    if request.param:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(ming_spectrum_library, "np", None)
+        monkeypatch.setattr(ming_numerical_utilities, "np", None)
+    return request.param
+
+@pytest.mark.parametrize("SNR, signal_SNR", [(2.0, 5), (1.0, 2), (3.5, 1.5)])
+def test_psm_annotation_metrics_match_individual_metrics(use_numpy, SNR, signal_SNR):
+    pytest.importorskip("pyteomics")
+    rng = random.Random(SNR)
+    for i in range(40):
+        peptide = rng.choice(PEPTIDES)
+        max_charge = rng.randint(1, 3)
+        peaks = _random_psm_peaks(rng, peptide, max_charge)
+        if len(peaks) == 0:
+            continue
+
+        metrics = ming_spectrum_library.calculate_psm_annotation_metrics(peaks, max_charge, peptide, 0.5, SNR=SNR, signal_SNR=signal_SNR)
+        expected_metrics = _individual_annotation_metrics(peaks, max_charge, peptide, 0.5, SNR, signal_SNR)
+
+        assert metrics.explained_intensity == pytest.approx(expected_metrics.explained_intensity, rel=1e-12)
+        assert metrics._replace(explained_intensity=0.0) == expected_metrics._replace(explained_intensity=0.0)
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_collection_annotation_metrics_match_individual_metrics(workers):
+    pytest.importorskip("pyteomics")
+    rng = random.Random(workers)
+    collection = ming_spectrum_library.SpectrumCollection("library.mgf")
+    spectra = []
+    for scan in range(1, 31):
+        peptide = rng.choice(PEPTIDES)
+        max_charge = rng.randint(1, 3)
+        peaks = _random_psm_peaks(rng, peptide, max_charge)
+        if len(peaks) > 0:
+            spectra.append(ming_spectrum_library.PeptideLibrarySpectrum("library.mgf", scan, scan - 1, peaks, 500.0, max_charge, peptide, "PROTEIN"))
+    collection.load_from_iterator(spectra)
+
+    collection.calculate_annotation_metrics(0.5, workers=workers, chunk_size=7)
+
+    for spectrum in collection.spectrum_list:
+        expected_metrics = _individual_annotation_metrics(list(spectrum.peaks), spectrum.charge, spectrum.peptide, 0.5, 2.0, 5)
+        assert spectrum.annotated_peaks == expected_metrics.annotated_peaks
+        assert spectrum.explained_intensity == pytest.approx(expected_metrics.explained_intensity, rel=1e-12)
+        assert spectrum.signal_peaks == expected_metrics.signal_peaks
+        assert spectrum.number_of_peaks_within_1_percent_of_max == expected_metrics.number_of_peaks_within_1_percent_of_max
+        assert spectrum.number_of_peaks_within_5_percent_of_max == expected_metrics.number_of_peaks_within_5_percent_of_max
+        assert spectrum.annotated_ions == expected_metrics.annotated_ions
+        assert spectrum.number_of_b_y_breaks == expected_metrics.number_of_b_y_breaks
@@ -0,0 +1,123 @@
+import random
+from collections import defaultdict
+
+import pytest
+
+import ming_numerical_utilities
+import ming_spectrum_library
+
+
+#Peak filters as they were before the array filters, on lists of [mz, intensity]
+def _reference_noise_level(peaks):
+    sorted_peaks = sorted(peaks, key=lambda peak: peak[1])
+    number_of_peaks_bottom = int(len(sorted_peaks)/4)
+    if number_of_peaks_bottom == 0:
+        return -1.0
+    sum_intensity = 0.0
+    for i in range(number_of_peaks_bottom):
+        sum_intensity += sorted_peaks[i][1]
+    return sum_intensity/float(number_of_peaks_bottom)
+
+def _reference_window_filter_peaks(peaks, window_size, top_peaks):
+    peak_list_window_map = defaultdict(list)
+    for peak in peaks:
+        peak_list_window_map[int(peak[0]/window_size)].append(peak)
+
+    new_peaks = []
+    for bucket in peak_list_window_map:
+        peaks_sorted_by_intensity = sorted(peak_list_window_map[bucket], key=lambda peak: peak[1], reverse=True)
+        new_peaks += peaks_sorted_by_intensity[:top_peaks]
+
+    return sorted(new_peaks, key=lambda peak: peak[0])
+
+def _reference_filter_noise_peaks(peaks, min_snr):
+    average_noise_level = _reference_noise_level(peaks)
+    return [peak for peak in peaks if peak[1] > average_noise_level * min_snr]
+
+def _reference_filter_peaks_noise_or_window(peaks, min_snr, window_size, top_peaks):
+    peak_masses_to_keep = set([peak[0] for peak in _reference_window_filter_peaks(peaks, window_size, top_peaks)])
+    peak_masses_to_keep |= set([peak[0] for peak in _reference_filter_noise_peaks(peaks, min_snr)])
+    return [peak for peak in peaks if peak[0] in peak_masses_to_keep]
+
+def _reference_filter_to_top_peaks(peaks, top_k_peaks):
+    sorted_peaks = sorted(peaks, key=lambda peak: peak[1], reverse=True)[:top_k_peaks]
+    return sorted(sorted_peaks, key=lambda peak: peak[0])
+
+def _random_peaks(rng):
+    #Integer intensities so ties in intensity are common
+    mz_values = sorted(rng.sample(range(10000, 150000), rng.randint(0, 80)))
+    return [[mz / 100.0, float(rng.randint(1, 30))] for mz in mz_values]
+
+def _random_spectra(seed, number_of_spectra=40):
+    rng = random.Random(seed)
+    return [ming_spectrum_library.Spectrum("test.mgf", scan, scan - 1, _random_peaks(rng), rng.uniform(300.0, 1200.0), 2, 2) for scan in range(1, number_of_spectra + 1)]
+
+@pytest.fixture(params=[True, False], ids=["numpy", "no_numpy"])
+def use_numpy(request, monkeypatch):
+    if request.param:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(ming_spectrum_library, "np", None)
+        monkeypatch.setattr(ming_numerical_utilities, "np", None)
+    return request.param
+
+FILTERS = [
+    ("window_filter_peaks", (50, 2), lambda spectrum, peaks: _reference_window_filter_peaks(peaks, 50, 2)),
+    ("filter_peaks_noise_or_window", (2.0, 50, 1), lambda spectrum, peaks: _reference_filter_peaks_noise_or_window(peaks, 2.0, 50, 1)),
+    ("filter_noise_peaks", (1.5,), lambda spectrum, peaks: _reference_filter_noise_peaks(peaks, 1.5)),
+    ("filter_to_top_peaks", (10,), lambda spectrum, peaks: _reference_filter_to_top_peaks(peaks, 10)),
+    ("filter_precursor_peaks", (), lambda spectrum, peaks: [peak for peak in peaks if abs(peak[0] - spectrum.mz) > 20.0]),
+    ("filter_peak_mass_range", (400.0, 600.0), lambda spectrum, peaks: [peak for peak in peaks if peak[0] < 400.0 or peak[0] > 600.0]),
+]
+
+@pytest.mark.parametrize("seed", range(3))
+def test_noise_level_matches_reference(use_numpy, seed):
+    for spectrum in _random_spectra(seed):
+        peaks = list(spectrum.peaks)
+        assert ming_numerical_utilities.calculate_noise_level_in_peaks(peaks) == pytest.approx(_reference_noise_level(peaks), rel=1e-15)
+        assert spectrum.get_noise_level() == pytest.approx(_reference_noise_level(peaks), rel=1e-15)
+
+@pytest.mark.parametrize("step_name, step_arguments, reference_filter", FILTERS, ids=[step[0] for step in FILTERS])
+def test_spectrum_filters_match_reference(use_numpy, step_name, step_arguments, reference_filter):
+    for spectrum in _random_spectra(0):
+        expected_peaks = reference_filter(spectrum, list(spectrum.peaks))
+        getattr(spectrum, step_name)(*step_arguments)
+        assert list(spectrum.peaks) == expected_peaks
+
+@pytest.mark.parametrize("seed", range(3))
+def test_module_filters_match_reference(use_numpy, seed):
+    for spectrum in _random_spectra(seed):
+        peaks = list(spectrum.peaks)
+        assert ming_spectrum_library.window_filter_peaks(peaks, 50, 2) == _reference_window_filter_peaks(peaks, 50, 2)
+        assert ming_spectrum_library.filter_peaks_noise_or_window(peaks, 2.0, 50, 1) == _reference_filter_peaks_noise_or_window(peaks, 2.0, 50, 1)
+        assert ming_spectrum_library.filter_noise_peaks(peaks, 1.5) == _reference_filter_noise_peaks(peaks, 1.5)
+
+@pytest.mark.parametrize("collection_filter", ["window_filter_peaks", "filter_peaks_noise_or_window"])
+def test_collection_filters_match_reference(use_numpy, collection_filter):
+    step_name, step_arguments, reference_filter = [step for step in FILTERS if step[0] == collection_filter][0]
+    collection = ming_spectrum_library.SpectrumCollection("test.mgf")
+    collection.load_from_iterator(_random_spectra(1))
+    expected_peaks = [reference_filter(spectrum, list(spectrum.peaks)) for spectrum in collection.spectrum_list]
+
+    getattr(collection, step_name)(*step_arguments)
+
+    assert [list(spectrum.peaks) for spectrum in collection.spectrum_list] == expected_peaks
+
+def test_preprocess_matches_reference(use_numpy):
+    steps = [(step[0],) + step[1] for step in FILTERS]
+    collection = ming_spectrum_library.SpectrumCollection("test.mgf")
+    collection.load_from_iterator(_random_spectra(2))
+    expected_peaks = []
+    expected_peaks_removed = [0] * len(steps)
+    for spectrum in collection.spectrum_list:
+        peaks = list(spectrum.peaks)
+        for i, step in enumerate(FILTERS):
+            filtered_peaks = step[2](spectrum, peaks)
+            expected_peaks_removed[i] += len(peaks) - len(filtered_peaks)
+            peaks = filtered_peaks
+        expected_peaks.append(peaks)
+
+    report = collection.preprocess(steps)
+
+    assert [list(spectrum.peaks) for spectrum in collection.spectrum_list] == expected_peaks
+    assert [step_report.peaks_removed for step_report in report] == expected_peaks_removed
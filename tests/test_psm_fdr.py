@@ -0,0 +1,130 @@
+import random
+from fractions import Fraction
+
+import pytest
+
+import ming_psm_library
+
+
+#FDR filters as they were before the cumulative sum versions
+def _reference_filter_psm_fdr(input_psms, fdr_percentage):
+    input_psms = sorted(input_psms, key=lambda psm: psm.sorting_value(), reverse=True)
+
+    running_target_count = 1
+    running_decoy_count = 0
+    for psm in input_psms:
+        if psm.is_decoy() == 0:
+            running_target_count += 1
+        else:
+            running_decoy_count += 1
+        psm.fdr = float(running_decoy_count) / float(running_target_count)
+
+    min_fdr = 1
+    for psm in reversed(input_psms):
+        min_fdr = min(min_fdr, psm.fdr)
+        psm.fdr = min_fdr
+
+    return [psm for psm in input_psms if psm.fdr < fdr_percentage]
+
+def _reference_filter_psm_local_fdr(input_psms, fdr_percentage, local_window_size):
+    input_psms = sorted(input_psms, key=lambda psm: psm.sorting_value(), reverse=True)
+
+    running_target_count = 1
+    running_decoy_count = 0
+    recent_target_numbers = []
+    recent_decoy_numbers = []
+    for psm in input_psms:
+        if psm.is_decoy() == 0:
+            recent_target_numbers.append(1)
+            recent_decoy_numbers.append(0)
+            running_target_count += 1
+        else:
+            recent_decoy_numbers.append(1)
+            recent_target_numbers.append(0)
+            running_decoy_count += 1
+
+        recent_target_numbers = recent_target_numbers[-local_window_size:]
+        recent_decoy_numbers = recent_decoy_numbers[-local_window_size:]
+
+        #A window without targets has a local FDR of inf
+        if sum(recent_target_numbers) == 0:
+            psm.local_fdr = float("inf")
+        else:
+            psm.local_fdr = float(sum(recent_decoy_numbers)) / float(sum(recent_target_numbers))
+        psm.fdr = float(running_decoy_count) / float(running_target_count)
+
+    min_fdr = 1
+    for psm in reversed(input_psms):
+        min_fdr = min(min_fdr, psm.local_fdr)
+        psm.local_fdr = min_fdr
+
+    return [psm for psm in input_psms if psm.local_fdr < fdr_percentage]
+
+def _random_psms(seed, score_type, number_of_psms=400):
+    rng = random.Random(seed)
+    psms = []
+    for i in range(number_of_psms):
+        decoy = 1 if rng.random() < 0.35 else 0
+        #Rounded scores so ties are common, decoys score lower on average
+        score = score_type(round(rng.gauss(10.0 - 4.0 * decoy, 3.0), 1))
+        psms.append(ming_psm_library.PSM("test.mzXML", i, "PEPTIDE", score, decoy, "PROTEIN", 2))
+    return psms
+
+def _fdr_state(psms):
+    return [(psm.scan, psm.fdr, getattr(psm, "local_fdr", None)) for psm in psms]
+
+@pytest.fixture(params=[True, False], ids=["numpy", "no_numpy"])
+def use_numpy(request, monkeypatch):
+    if request.param:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(ming_psm_library, "np", None)
+    return request.param
+
+@pytest.mark.parametrize("score_type", [float, int, Fraction])
+@pytest.mark.parametrize("fdr_percentage", [0.01, 0.05, 0.5])
+def test_filter_psm_fdr_matches_reference(use_numpy, score_type, fdr_percentage):
+    psms = _random_psms(0, score_type)
+    reference_psms = _random_psms(0, score_type)
+
+    output_psms = ming_psm_library.filter_psm_fdr(psms, fdr_percentage)
+    reference_output_psms = _reference_filter_psm_fdr(reference_psms, fdr_percentage)
+
+    assert _fdr_state(output_psms) == _fdr_state(reference_output_psms)
+    assert _fdr_state(psms) == _fdr_state(reference_psms)
+
+@pytest.mark.parametrize("score_type", [float, Fraction])
+def test_calculate_psm_fdr_matches_reference(use_numpy, score_type):
+    psms = _random_psms(1, score_type)
+    reference_psms = _random_psms(1, score_type)
+
+    output_psms = ming_psm_library.calculate_psm_fdr(psms)
+    _reference_filter_psm_fdr(reference_psms, 1.0)
+    reference_output_psms = sorted(reference_psms, key=lambda psm: psm.sorting_value(), reverse=True)[::-1]
+
+    assert _fdr_state(output_psms) == _fdr_state(reference_output_psms)
+
+@pytest.mark.parametrize("score_type", [float, Fraction])
+@pytest.mark.parametrize("local_window_size", [1, 3, 15, 50, 500])
+def test_filter_psm_local_fdr_matches_reference(use_numpy, score_type, local_window_size):
+    psms = _random_psms(2, score_type)
+    reference_psms = _random_psms(2, score_type)
+
+    reference_output_psms = _reference_filter_psm_local_fdr(reference_psms, 0.1, local_window_size)
+    output_psms = ming_psm_library.filter_psm_local_fdr(psms, 0.1, local_window_size)
+
+    assert _fdr_state(output_psms) == _fdr_state(reference_output_psms)
+    assert _fdr_state(psms) == _fdr_state(reference_psms)
+
+@pytest.mark.parametrize("local_window_size", [0, -5])
+def test_filter_psm_local_fdr_rejects_empty_windows(use_numpy, local_window_size):
+    with pytest.raises(ValueError):
+        ming_psm_library.filter_psm_local_fdr(_random_psms(3, float), 0.1, local_window_size)
+
+def test_filter_psm_local_fdr_caps_windows_without_targets(use_numpy):
+    psms = [ming_psm_library.PSM("test.mzXML", i, "PEPTIDE", float(10 - i), decoy, "PROTEIN", 2) for i, decoy in enumerate([0, 1, 1, 0, 0, 1, 1, 1])]
+
+    output_psms = ming_psm_library.filter_psm_local_fdr(psms, 0.5, 2)
+
+    assert [psm.scan for psm in output_psms] == [0, 1, 2, 3, 4]
+    assert [psm.local_fdr for psm in sorted(psms, key=lambda psm: psm.scan)] == [0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 1.0, 1.0]
@@ -0,0 +1,144 @@
+import math
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import ming_spectrum_library
+import spectrum_alignment
+
+
+#score_alignment as it was before the array scoring path, on lists of [mz, intensity]
+def _reference_score_alignment(spec1, spec2, pm1, pm2, tolerance, max_charge_consideration=1):
+    if len(spec1) == 0 or len(spec2) == 0:
+        return 0.0, []
+
+    def sqrt_normalize(spectrum):
+        normed_value = math.sqrt(sum(peak[1] for peak in spectrum))
+        return [(peak[0], math.sqrt(peak[1]) / normed_value) for peak in spectrum]
+
+    def find_match_peaks(spec1_n, spec2_n, shift):
+        adj_tolerance = tolerance + 0.000001
+        alignments = []
+        for i, peak1 in enumerate(spec1_n):
+            for j, peak2 in enumerate(spec2_n):
+                if peak1[0] - shift - adj_tolerance <= peak2[0] <= peak1[0] - shift + adj_tolerance:
+                    alignments.append((i, j))
+        return alignments
+
+    spec1_n = sqrt_normalize(spec1)
+    spec2_n = sqrt_normalize(spec2)
+    shift = pm1 - pm2
+
+    zero_shift_alignments = find_match_peaks(spec1_n, spec2_n, 0)
+    real_shift_alignments = []
+    if abs(shift) > tolerance:
+        real_shift_alignments = find_match_peaks(spec1_n, spec2_n, shift)
+        for charge_considered in range(2, max_charge_consideration + 1):
+            real_shift_alignments += find_match_peaks(spec1_n, spec2_n, shift / charge_considered)
+    real_shift_alignments = list(set(real_shift_alignments))
+
+    all_matches = [(spec1_n[i][1] * spec2_n[j][1], i, j) for i, j in zero_shift_alignments + real_shift_alignments]
+    all_matches.sort(key=lambda match: match[0], reverse=True)
+
+    spec1_peak_used = set()
+    spec2_peak_used = set()
+    reported_alignments = []
+    total_score = 0.0
+    for match_score, i, j in all_matches:
+        if not i in spec1_peak_used and not j in spec2_peak_used:
+            spec1_peak_used.add(i)
+            spec2_peak_used.add(j)
+            reported_alignments.append((i, j))
+            total_score += match_score
+
+    return total_score, reported_alignments
+
+def _random_peaks(rng, base_peaks, number_of_peaks):
+    peaks = [[mz + rng.uniform(-0.3, 0.3), rng.uniform(1.0, 1000.0)] for mz in rng.sample(base_peaks, number_of_peaks)]
+    peaks += [[rng.uniform(100.0, 1000.0), rng.uniform(1.0, 1000.0)] for i in range(number_of_peaks // 3)]
+    return sorted(peaks)
+
+def _random_spectra(seed, number_of_spectra):
+    rng = random.Random(seed)
+    base_peaks = [rng.uniform(100.0, 1000.0) for i in range(60)]
+    spectra = []
+    for scan in range(1, number_of_spectra + 1):
+        peaks = _random_peaks(rng, base_peaks, rng.randint(0, 40))
+        spectra.append(ming_spectrum_library.Spectrum("library.mgf", scan, scan - 1, peaks, rng.uniform(500.0, 510.0), rng.randint(1, 3), 2))
+    return spectra
+
+@pytest.mark.parametrize("seed", range(5))
+def test_score_alignment_arrays_matches_reference(seed):
+    spectra = _random_spectra(seed, 20)
+    for spectrum1, spectrum2 in zip(spectra, spectra[1:]):
+        peaks1 = list(spectrum1.peaks)
+        peaks2 = list(spectrum2.peaks)
+        pm1 = spectrum1.mz * spectrum1.charge
+        pm2 = spectrum2.mz * spectrum2.charge
+        reference_score, reference_alignments = _reference_score_alignment(peaks1, peaks2, pm1, pm2, 0.5, spectrum1.charge)
+
+        mz1, intensity1 = spectrum_alignment.convert_to_arrays(peaks1)
+        mz2, intensity2 = spectrum_alignment.convert_to_arrays(peaks2)
+        score, alignments = spectrum_alignment.score_alignment_arrays(mz1, intensity1, mz2, intensity2, pm1, pm2, 0.5, spectrum1.charge)
+        assert score == pytest.approx(reference_score, abs=1e-12)
+        assert sorted(alignments) == sorted(reference_alignments)
+
+@pytest.mark.parametrize("use_numpy", [True, False], ids=["numpy", "no_numpy"])
+def test_score_alignment_matches_reference(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(spectrum_alignment, "np", None)
+    spectra = _random_spectra(11, 20)
+    for spectrum1, spectrum2 in zip(spectra, spectra[1:]):
+        peaks1 = list(spectrum1.peaks)
+        peaks2 = list(spectrum2.peaks)
+        pm1 = spectrum1.mz * spectrum1.charge
+        pm2 = spectrum2.mz * spectrum2.charge
+        reference_score, reference_alignments = _reference_score_alignment(peaks1, peaks2, pm1, pm2, 0.5, spectrum1.charge)
+
+        score, alignments = spectrum_alignment.score_alignment(peaks1, peaks2, pm1, pm2, 0.5, spectrum1.charge)
+        assert score == pytest.approx(reference_score, abs=1e-12)
+        assert sorted(alignments) == sorted(reference_alignments)
+
+        score, alignments = spectrum_alignment.score_alignment(spectrum1.peaks, spectrum2.peaks, pm1, pm2, 0.5, spectrum1.charge)
+        assert score == pytest.approx(reference_score, abs=1e-12)
+        assert sorted(alignments) == sorted(reference_alignments)
+
+@pytest.mark.parametrize("seed", range(3))
+def test_cosine_spectrum_matches_reference(seed):
+    spectra = _random_spectra(seed, 20)
+    for spectrum1, spectrum2 in zip(spectra, spectra[1:]):
+        reference_score, reference_alignments = _reference_score_alignment(list(spectrum1.peaks), list(spectrum2.peaks), spectrum1.mz * spectrum1.charge, spectrum2.mz * spectrum2.charge, 0.5, spectrum1.charge)
+        score, matched_peaks = spectrum1.cosine_spectrum(spectrum2, 0.5)
+        assert score == pytest.approx(reference_score, abs=1e-12)
+        assert matched_peaks == len(reference_alignments)
+
+@pytest.mark.parametrize("seed", range(3))
+def test_one_vs_many_matches_reference(seed):
+    spectra = _random_spectra(seed, 60)
+    query = spectra.pop()
+    library_arrays = spectrum_alignment.prepare_library_arrays([spectrum.get_normalized_peaks() for spectrum in spectra], [spectrum.mz * spectrum.charge for spectrum in spectra], [spectrum.charge for spectrum in spectra])
+    query_mz, query_intensity = query.get_normalized_peaks()
+
+    scores, matched_peaks = spectrum_alignment.score_alignment_one_vs_many(query_mz, query_intensity, query.mz * query.charge, library_arrays, 0.5, candidate_batch_size=7)
+
+    for i, spectrum in enumerate(spectra):
+        reference_score, reference_alignments = _reference_score_alignment(list(spectrum.peaks), list(query.peaks), spectrum.mz * spectrum.charge, query.mz * query.charge, 0.5, spectrum.charge)
+        assert scores[i] == pytest.approx(reference_score, abs=1e-12)
+        assert matched_peaks[i] == len(reference_alignments)
+
+@pytest.mark.parametrize("analog_search", [False, True])
+def test_search_spectrum_batch_matches_search_spectrum(analog_search):
+    spectra = _random_spectra(7, 80)
+    queries = spectra[-5:]
+    collection = ming_spectrum_library.SpectrumCollection("library.mgf")
+    collection.load_from_iterator(spectra[:-5])
+
+    for query in queries:
+        batch_matches = collection.search_spectrum_batch(query, 3.0, 0.5, 2, 0.05, analog_search=analog_search, top_k=10)
+        matches = collection.search_spectrum(query, 3.0, 0.5, 2, 0.05, analog_search=analog_search, top_k=10)
+        assert [(match.scan, match.matchedpeaks) for match in batch_matches] == [(match.scan, match.matchedpeaks) for match in matches]
+        for batch_match, match in zip(batch_matches, matches):
+            assert batch_match.cosine == pytest.approx(match.cosine, abs=1e-12)
+            assert batch_match.mzerror == match.mzerror
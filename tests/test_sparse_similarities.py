@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+import ming_numerical_utilities
+import ming_spectrum_library
+
+
+BIN_SIZE = 1.0
+MAX_MASS = 2000.0
+
+#Peaks in the middle of distinct bins and one precursor m/z, so the alignment cosine only matches peaks in the same bin
+def _random_spectra(seed, number_of_spectra):
+    rng = random.Random(seed)
+    shared_bins = rng.sample(range(100, 1900), 80)
+    spectra = []
+    for scan in range(1, number_of_spectra + 1):
+        peak_bins = sorted(rng.sample(shared_bins, rng.randint(0, 30)))
+        peaks = [[peak_bin + 0.5, rng.uniform(1.0, 1000.0)] for peak_bin in peak_bins]
+        spectra.append(ming_spectrum_library.Spectrum("test.mgf", scan, scan - 1, peaks, 800.0, 1, 2))
+    return spectra
+
+@pytest.fixture(params=["scipy", "numpy", "no_numpy"])
+def backend(request, monkeypatch):
+    if request.param == "scipy":
+        pytest.importorskip("scipy.sparse")
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+        monkeypatch.setattr(ming_numerical_utilities, "scipy", None)
+    if request.param == "no_numpy":
+        monkeypatch.setattr(ming_numerical_utilities, "np", None)
+        monkeypatch.setattr(ming_numerical_utilities, "scipy", None)
+    return request.param
+
+@pytest.mark.parametrize("sqrt_peaks", [True, False])
+def test_sparse_vectors_match_vectorize_peaks(backend, sqrt_peaks):
+    for spectrum in _random_spectra(0, 20):
+        #vectorize_peaks divides by zero without peaks
+        if len(spectrum.peaks) == 0:
+            assert len(ming_numerical_utilities.vectorize_peaks_sparse(spectrum.peaks, MAX_MASS, BIN_SIZE, sqrt_peaks=sqrt_peaks)[0]) == 0
+            continue
+        peak_vector = ming_numerical_utilities.vectorize_peaks(list(spectrum.peaks), MAX_MASS, BIN_SIZE, sqrt_peaks=sqrt_peaks)
+        bin_indices, bin_values = ming_numerical_utilities.vectorize_peaks_sparse(spectrum.peaks, MAX_MASS, BIN_SIZE, sqrt_peaks=sqrt_peaks)
+
+        non_zero_bins = [bin_index for bin_index in range(len(peak_vector)) if peak_vector[bin_index] != 0.0]
+        assert list(bin_indices) == non_zero_bins
+        assert list(bin_values) == pytest.approx([peak_vector[bin_index] for bin_index in non_zero_bins], rel=1e-12)
+
+@pytest.mark.parametrize("min_score", [0.0, 0.3])
+def test_sparse_similarities_match_cosine_spectrum(backend, min_score):
+    spectra = _random_spectra(1, 40)
+    queries, library = spectra[:10], spectra[10:]
+    query_vectors = [ming_numerical_utilities.vectorize_peaks_sparse(spectrum.peaks, MAX_MASS, BIN_SIZE) for spectrum in queries]
+    library_vectors = [ming_numerical_utilities.vectorize_peaks_sparse(spectrum.peaks, MAX_MASS, BIN_SIZE) for spectrum in library]
+
+    similarities = ming_numerical_utilities.calculate_sparse_similarities(query_vectors, library_vectors, int(MAX_MASS / BIN_SIZE), min_score=min_score, chunk_size=7)
+
+    expected_similarities = []
+    for i, query in enumerate(queries):
+        for j, library_spectrum in enumerate(library):
+            score, matched_peaks = query.cosine_spectrum(library_spectrum, 0.3)
+            if score > min_score + 1e-9:
+                expected_similarities.append((i, j, score))
+    assert [(i, j) for i, j, score in similarities if score > min_score + 1e-9] == [(i, j) for i, j, score in expected_similarities]
+    for similarity, expected_similarity in zip([similarity for similarity in similarities if similarity[2] > min_score + 1e-9], expected_similarities):
+        assert similarity[2] == pytest.approx(expected_similarity[2], abs=1e-12)
@@ -0,0 +1,136 @@
+import os
+import pickle
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import ming_spectrum_library
+
+
+def _make_collection(filename):
+    collection = ming_spectrum_library.SpectrumCollection(filename)
+    for i in range(30):
+        peaks = [[100.0 + j * 13.1 + i * 0.7, float((j * 7 + i) % 11 + 1)] for j in range(12)]
+        collection.spectrum_list.append(ming_spectrum_library.Spectrum(filename, i + 1, i, peaks, 400.0 + i * 0.3, 1, 2))
+    return collection
+
+@pytest.fixture
+def cache_filename(tmp_path):
+    source_filename = str(tmp_path / "library.mgf")
+    open(source_filename, "w").close()
+    collection = _make_collection(source_filename)
+    collection.save_to_cache()
+    return ming_spectrum_library.get_spectrum_cache_filename(source_filename), collection
+
+def test_save_to_cache_writes_mapped_library_columns(cache_filename):
+    cache_filename, collection = cache_filename
+    for column_name in ming_spectrum_library.MAPPED_LIBRARY_COLUMNS:
+        assert os.path.exists(os.path.join(cache_filename, column_name + ".npy"))
+    assert [filename for filename in os.listdir(cache_filename) if filename.endswith(".tmp")] == []
+
+    normalized_intensity = np.load(os.path.join(cache_filename, "normalized_intensity.npy"))
+    expected = np.concatenate([spectrum.get_normalized_peaks()[1] for spectrum in collection.spectrum_list])
+    assert np.array_equal(normalized_intensity, expected)
+
+def test_attach_only_reads_the_cache(cache_filename):
+    cache_filename, collection = cache_filename
+    modification_times = dict((filename, os.stat(os.path.join(cache_filename, filename)).st_mtime_ns) for filename in os.listdir(cache_filename))
+
+    library = pickle.loads(pickle.dumps(ming_spectrum_library.MappedSpectrumLibrary(cache_filename)))
+
+    assert len(library) == len(collection.spectrum_list)
+    assert dict((filename, os.stat(os.path.join(cache_filename, filename)).st_mtime_ns) for filename in os.listdir(cache_filename)) == modification_times
+
+def test_attach_rejects_caches_without_mapped_library_columns(cache_filename):
+    cache_filename, collection = cache_filename
+    os.remove(os.path.join(cache_filename, ming_spectrum_library.MAPPED_LIBRARY_COLUMNS[0] + ".npy"))
+
+    with pytest.raises(ValueError, match="rebuild the cache"):
+        ming_spectrum_library.MappedSpectrumLibrary(cache_filename)
+
+    collection.save_to_cache()
+    library = ming_spectrum_library.MappedSpectrumLibrary(cache_filename)
+    query = collection.spectrum_list[4]
+    assert library.search_spectrum(query, 1.0, 0.5, 1, 0.1, top_k=3) == collection.search_spectrum_batch(query, 1.0, 0.5, 1, 0.1, top_k=3)
+
+def _spectrum_state(spectrum):
+    return (spectrum.filename, spectrum.scan, spectrum.index, spectrum.mz, spectrum.charge, spectrum.ms_level, spectrum.retention_time, spectrum.collision_energy, spectrum.fragmenation_method, spectrum.precursor_intensity, spectrum.totIonCurrent, list(spectrum.peaks))
+
+def _write_mgf(filename, number_of_spectra):
+    with open(filename, "w") as mgf_file:
+        for i in range(number_of_spectra):
+            mgf_file.write("BEGIN IONS\nPEPMASS=%f\nCHARGE=%d+\nSCANS=%d\n" % (400.0 + i * 0.37, i % 3 + 1, i + 1))
+            for j in range(i % 7 + 1):
+                mgf_file.write("%f %f\n" % (100.0 + j * 13.1 + i, float((j * 7 + i) % 11 + 1)))
+            mgf_file.write("END IONS\n")
+
+def _load_with_cache(filename, monkeypatch, expect_cache, drop_ms1=False):
+    loaded_from_file = []
+    load_from_mgf = ming_spectrum_library.SpectrumCollection.load_from_mgf
+    def tracking_load_from_mgf(collection):
+        loaded_from_file.append(collection.filename)
+        load_from_mgf(collection)
+    monkeypatch.setattr(ming_spectrum_library.SpectrumCollection, "load_from_mgf", tracking_load_from_mgf)
+
+    collection = ming_spectrum_library.SpectrumCollection(filename)
+    collection.load_from_file(drop_ms1=drop_ms1, use_cache=True)
+    assert (len(loaded_from_file) == 0) == expect_cache
+    return collection
+
+def test_cached_spectra_match_the_file(tmp_path, monkeypatch):
+    filename = str(tmp_path / "spectra.mgf")
+    _write_mgf(filename, 25)
+    collection = ming_spectrum_library.SpectrumCollection(filename)
+    collection.load_from_file()
+
+    _load_with_cache(filename, monkeypatch, False)
+    cached_collection = _load_with_cache(filename, monkeypatch, True)
+
+    assert [_spectrum_state(spectrum) for spectrum in cached_collection.spectrum_list] == [_spectrum_state(spectrum) for spectrum in collection.spectrum_list]
+    assert sorted(cached_collection.scandict.keys()) == sorted(collection.scandict.keys())
+
+def test_cache_is_stale_when_the_file_changes(tmp_path, monkeypatch):
+    filename = str(tmp_path / "spectra.mgf")
+    _write_mgf(filename, 25)
+    _load_with_cache(filename, monkeypatch, False)
+    cache_filename = ming_spectrum_library.get_spectrum_cache_filename(filename)
+
+    #Same size, different modification time
+    source_stat = os.stat(filename)
+    os.utime(filename, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns + 10 ** 9))
+    assert ming_spectrum_library.read_spectrum_cache(cache_filename, filename, {"drop_ms1": False}) == None
+    _load_with_cache(filename, monkeypatch, False)
+    _load_with_cache(filename, monkeypatch, True)
+
+    #Different size
+    _write_mgf(filename, 30)
+    collection = _load_with_cache(filename, monkeypatch, False)
+    assert len(collection.spectrum_list) == 30
+    assert len(_load_with_cache(filename, monkeypatch, True).spectrum_list) == 30
+
+def test_cache_is_stale_for_other_load_parameters_or_versions(tmp_path, monkeypatch):
+    filename = str(tmp_path / "spectra.mgf")
+    _write_mgf(filename, 25)
+    _load_with_cache(filename, monkeypatch, False)
+    cache_filename = ming_spectrum_library.get_spectrum_cache_filename(filename)
+
+    assert ming_spectrum_library.read_spectrum_cache(cache_filename, filename, {"drop_ms1": False}) != None
+    assert ming_spectrum_library.read_spectrum_cache(cache_filename, filename, {"drop_ms1": True}) == None
+    _load_with_cache(filename, monkeypatch, False, drop_ms1=True)
+    _load_with_cache(filename, monkeypatch, True, drop_ms1=True)
+
+    monkeypatch.setattr(ming_spectrum_library, "SPECTRUM_CACHE_VERSION", ming_spectrum_library.SPECTRUM_CACHE_VERSION + 1)
+    assert ming_spectrum_library.read_spectrum_cache(cache_filename, filename, {"drop_ms1": True}) == None
+
+def test_cache_without_meta_is_incomplete(tmp_path, monkeypatch):
+    filename = str(tmp_path / "spectra.mgf")
+    _write_mgf(filename, 25)
+    _load_with_cache(filename, monkeypatch, False)
+    cache_filename = ming_spectrum_library.get_spectrum_cache_filename(filename)
+
+    os.remove(os.path.join(cache_filename, "meta.json"))
+
+    assert ming_spectrum_library.read_spectrum_cache(cache_filename) == None
+    _load_with_cache(filename, monkeypatch, False)
+    _load_with_cache(filename, monkeypatch, True)
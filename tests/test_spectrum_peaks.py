@@ -0,0 +1,101 @@
+import ming_numerical_utilities
+import ming_spectrum_library
+
+
+def _make_spectrum(scan=1):
+    peaks = [[100.0 + j * 11.3, float((j * 5) % 7 + 1)] for j in range(10)]
+    return ming_spectrum_library.Spectrum("test.mgf", scan, scan - 1, peaks, 500.0, 2, 2)
+
+def _make_spectrum_with_peaks(peaks):
+    return ming_spectrum_library.Spectrum("test.mgf", 1, 0, peaks, 500.0, 2, 2)
+
+def _normalized_intensity(spectrum):
+    normalized_peaks = spectrum.get_normalized_peaks()
+    if ming_spectrum_library.np is not None:
+        return normalized_peaks[1].tolist()
+    return [peak.intensity for peak in normalized_peaks]
+
+def test_setitem_invalidates_cached_peaks():
+    spectrum = _make_spectrum()
+    normalized_before = _normalized_intensity(spectrum)
+    spectrum.get_noise_level()
+
+    spectrum.peaks[0] = [100.0, 1000.0]
+
+    assert _normalized_intensity(spectrum) != normalized_before
+    assert _normalized_intensity(spectrum) == _normalized_intensity(_make_spectrum_with_peaks(list(spectrum.peaks)))
+    assert spectrum.get_noise_level() == ming_numerical_utilities.calculate_noise_level_in_peaks(list(spectrum.peaks))
+
+def test_append_invalidates_cached_peaks():
+    spectrum = _make_spectrum()
+    noise_before = spectrum.get_noise_level()
+
+    for j in range(6):
+        spectrum.peaks.append([400.0 + j, 0.01])
+
+    assert spectrum.get_noise_level() != noise_before
+    assert spectrum.get_noise_level() == ming_numerical_utilities.calculate_noise_level_in_peaks(list(spectrum.peaks))
+
+def test_shared_peak_list_edit_invalidates_both_spectra():
+    spectrum = _make_spectrum()
+    other_spectrum = _make_spectrum(scan=2)
+    other_spectrum.peaks = spectrum.peaks
+    normalized_before = _normalized_intensity(spectrum)
+    other_normalized_before = _normalized_intensity(other_spectrum)
+
+    spectrum.peaks[0] = [100.0, 1000.0]
+
+    assert _normalized_intensity(spectrum) != normalized_before
+    assert _normalized_intensity(other_spectrum) != other_normalized_before
+    assert _normalized_intensity(other_spectrum) == _normalized_intensity(spectrum)
+
+def test_invalidate_peak_cache_after_array_edits():
+    spectrum = _make_spectrum()
+    normalized_before = _normalized_intensity(spectrum)
+
+    spectrum.peaks.intensity[0] = 1000.0
+    spectrum.invalidate_peak_cache()
+
+    assert _normalized_intensity(spectrum) != normalized_before
+
+def test_peak_views_write_through():
+    spectrum = _make_spectrum()
+    expected_peaks = [[peak[0], peak[1] * 3.0] for peak in spectrum.peaks]
+    expected_peaks[-1][0] = 999.0
+    normalized_before = _normalized_intensity(spectrum)
+
+    for peak in spectrum.peaks:
+        peak[1] *= 3.0
+    spectrum.peaks[-1][0] = 999.0
+
+    assert list(spectrum.peaks) == expected_peaks
+    spectrum.peaks[0][1] = 1000.0
+    assert _normalized_intensity(spectrum) != normalized_before
+    assert _normalized_intensity(spectrum) == _normalized_intensity(_make_spectrum_with_peaks(list(spectrum.peaks)))
+
+def test_peak_slices_write_through():
+    spectrum = _make_spectrum()
+    for peak in spectrum.peaks[2:5]:
+        peak[1] = 0.0
+    assert [peak[1] for peak in spectrum.peaks][1:6] == [spectrum.peaks[1][1], 0.0, 0.0, 0.0, spectrum.peaks[5][1]]
+    assert spectrum.peaks[::-1] == list(reversed(list(spectrum.peaks)))
+
+def test_peak_list_behaves_like_a_list():
+    peaks = [[100.0 + j * 11.3, float((j * 5) % 7 + 1)] for j in range(10)]
+    spectrum = _make_spectrum_with_peaks(peaks)
+    noise_before = spectrum.get_noise_level()
+
+    spectrum.peaks.sort(key=lambda peak: peak[1], reverse=True)
+    assert list(spectrum.peaks) == sorted(peaks, key=lambda peak: peak[1], reverse=True)
+    spectrum.peaks.sort()
+    assert list(spectrum.peaks) == sorted(peaks)
+
+    extra_peaks = [[50.0, 0.5], [60.0, 0.25]]
+    assert list(spectrum.peaks + extra_peaks) == peaks + extra_peaks
+    assert list(extra_peaks + spectrum.peaks) == extra_peaks + peaks
+    spectrum.peaks += extra_peaks
+    assert list(spectrum.peaks) == peaks + extra_peaks
+    spectrum.peaks.extend(spectrum.peaks[:2])
+    assert list(spectrum.peaks) == peaks + extra_peaks + peaks[:2]
+    assert spectrum.get_noise_level() != noise_before
+    assert spectrum.get_noise_level() == ming_numerical_utilities.calculate_noise_level_in_peaks(list(spectrum.peaks))
@@ -0,0 +1,57 @@
+import re
+
+import pytest
+
+mass = pytest.importorskip("pyteomics.mass")
+
+import ming_psm_library
+
+
+ION_TYPES = ["b", "b-iso", "y", "y-iso", "b-H2O", "b-NH3", "y-H2O", "y-NH3", "a"]
+
+#create_theoretical_peak_map as it was before the prefix and suffix sums, every fragment mass from pyteomics
+def _reference_theoretical_peak_map(peptide, ion_type_list, charge_set):
+    amino_acid_list = re.findall('[^A-Z]*[A-Z][^A-Z]*', peptide)
+    only_letters_list = [letter for letter in peptide if letter.isalpha()]
+
+    only_mods_mass_add_list = []
+    for amino_acid in amino_acid_list:
+        mod_mass_to_add = 0.0
+        for mod_tokenized in re.findall('[+-][0-9]*.[0-9]*', re.sub("[A-Z]", "", amino_acid)):
+            mod_mass_to_add += float(mod_tokenized)
+        only_mods_mass_add_list.append(mod_mass_to_add)
+
+    ion_to_mass_mapping = {}
+    for charge in charge_set:
+        for ion_type in ion_type_list:
+            iso_topic_added_mass = 0.0
+            real_ion_type = ion_type
+            if ion_type[-4:] == "-iso":
+                iso_topic_added_mass = 1.007276 / float(charge)
+                real_ion_type = ion_type[:-4]
+
+            for i in range(len(amino_acid_list)):
+                if real_ion_type[0] in "abc":
+                    peak_annotation = ion_type + ":" + str(i+1) + ":" + str(charge)
+                    peak_mass = mass.fast_mass("".join(only_letters_list[:i+1]), ion_type=real_ion_type, charge=charge) + sum(only_mods_mass_add_list[:i+1])/(float(charge)) + iso_topic_added_mass
+                else:
+                    peak_annotation = ion_type + ":" + str(len(amino_acid_list) - i) + ":" + str(charge)
+                    peak_mass = mass.fast_mass("".join(only_letters_list[i:]), ion_type=real_ion_type, charge=charge) + sum(only_mods_mass_add_list[i:])/(float(charge)) + iso_topic_added_mass
+                ion_to_mass_mapping[peak_annotation] = peak_mass
+
+    return ion_to_mass_mapping
+
+@pytest.mark.parametrize("peptide", ["PEPTIDE", "K", "PEPS+79.966TIDEK", "+42.011AC+57.021DEFGHIK", "M+15.995NQWYVLR-17.027", "GGGGGGGGGGGGGGGGGGGGGGGGGGGGGGR"])
+@pytest.mark.parametrize("charge_set", [[1], [1, 2, 3]])
+def test_theoretical_peak_map_matches_reference(peptide, charge_set):
+    peak_map = ming_psm_library.create_theoretical_peak_map(peptide, ION_TYPES, charge_set=charge_set)
+    reference_peak_map = _reference_theoretical_peak_map(peptide, ION_TYPES, charge_set)
+
+    assert sorted(peak_map.keys()) == sorted(reference_peak_map.keys())
+    for peak_annotation in reference_peak_map:
+        assert peak_map[peak_annotation] == pytest.approx(reference_peak_map[peak_annotation], abs=1e-9)
+
+def test_theoretical_peak_map_returns_a_copy():
+    peak_map = ming_psm_library.create_theoretical_peak_map("PEPTIDE", ["b", "y"])
+    peak_map["b:1:1"] = 0.0
+    assert ming_psm_library.create_theoretical_peak_map("PEPTIDE", ["b", "y"])["b:1:1"] != 0.0